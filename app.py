@@ -1,17 +1,32 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify, render_template_string, Response, stream_with_context, g, has_request_context
 import sqlite3
 import os
 import logging
 import json
+import csv
+import io
+import base64
 import re
-import requests
+import unicodedata
 import time
+import threading
+import queue
+import heapq
+import itertools
+import bisect
+import zlib
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict, deque
 from datetime import datetime
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
 load_dotenv()
 
+# Cliente HTTP compartido (lee su configuración del entorno ya cargado)
+from http_client import http_client, CONNECT_TIMEOUT
+from metrics import Counter, Gauge, Histogram, REGISTRY as METRICS_REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
 # Configurar logging
 logging.basicConfig(
     level=logging.DEBUG,
@@ -24,12 +39,326 @@ logging.basicConfig(
 
 app = Flask(__name__)
 
+# Métricas del pipeline de cada turno (expuestas en /metrics)
+STAGE_SECONDS = Histogram(
+    'bot_stage_seconds',
+    'Duración de cada etapa del turno (response_build incluye history y detection)',
+    ['stage']
+)
+ARTIFICIAL_DELAY_SECONDS = Histogram(
+    'bot_artificial_delay_seconds', 'Retrasos artificiales aplicados antes de responder', ['kind']
+)
+DELIVERY_LAG_SECONDS = Histogram(
+    'bot_delivery_lag_seconds', 'Atraso de los envíos programados respecto a su hora prevista'
+)
+MESSAGES_TOTAL = Counter('bot_messages_total', 'Mensajes entrantes procesados', ['platform'])
+DUPLICATE_MESSAGES_TOTAL = Counter('bot_duplicate_messages_total', 'Reentregas de webhooks ignoradas', ['platform'])
+LEADS_TOTAL = Counter('bot_leads_total', 'Leads guardados')
+OWNER_NOTIFICATIONS_TOTAL = Counter(
+    'bot_owner_notifications_total', 'Intentos de notificación al dueño', ['result']
+)
+HTTP_REQUESTS_TOTAL = Counter('bot_http_requests_total', 'Peticiones HTTP atendidas', ['endpoint', 'status'])
+HTTP_REQUEST_SECONDS = Histogram('bot_http_request_seconds', 'Duración de las peticiones HTTP atendidas', ['endpoint'])
+IN_FLIGHT_REQUESTS = Gauge('bot_in_flight_requests', 'Peticiones HTTP en curso')
+Gauge('bot_message_queue_depth', 'Lotes esperando en los carriles de procesamiento',
+      function=lambda: sum(lane.queue.qsize() for lane in _message_lanes))
+Gauge('bot_scheduled_deliveries', 'Envíos programados que aún no vencen',
+      function=lambda: delivery_scheduler.pending())
+
+@app.before_request
+def track_request_start():
+    """Contar la petición como en curso y registrar su inicio"""
+    IN_FLIGHT_REQUESTS.inc()
+    request.environ['bot.start_time'] = time.perf_counter()
+
+@app.after_request
+def track_request_end(response):
+    """Registrar duración y estado por endpoint"""
+    endpoint = request.endpoint or 'desconocido'
+    HTTP_REQUESTS_TOTAL.labels(endpoint, response.status_code).inc()
+    start = request.environ.get('bot.start_time')
+    if start is not None:
+        HTTP_REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+    return response
+
+@app.teardown_request
+def track_request_done(exception=None):
+    IN_FLIGHT_REQUESTS.dec()
+
+# Credenciales de Facebook y WhatsApp (se leen una sola vez al iniciar)
+VERIFY_TOKEN = os.getenv('VERIFY_TOKEN', 'mi_token_secreto')
+PAGE_ACCESS_TOKEN = os.getenv('PAGE_ACCESS_TOKEN', '')
+ULTRAMSG_TOKEN = os.getenv('ULTRAMSG_TOKEN', '')
+ULTRAMSG_INSTANCE = os.getenv('ULTRAMSG_INSTANCE', '')
+CALLMEBOT_API_KEY = os.getenv('CALLMEBOT_API_KEY', '')
+
+GRAPH_API_MESSAGES_URL = "https://graph.facebook.com/v18.0/me/messages"
+
+def facebook_configured():
+    """True si hay un PAGE_ACCESS_TOKEN real configurado"""
+    return bool(PAGE_ACCESS_TOKEN) and PAGE_ACCESS_TOKEN != 'PEGA_AQUI_TU_PAGE_ACCESS_TOKEN'
+
 # Base de datos SQLite
 DATABASE = 'marketplace_bot.db'
 
+# Ajustes de SQLite para webhooks concurrentes
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+
+# Perfilado de consultas (opcional): conteo por petición y log de consultas lentas
+DB_PROFILE = os.getenv('DB_PROFILE', 'False').lower() == 'true'
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', 'slow_queries.log')
+
+DB_QUERIES_TOTAL = Counter('bot_db_queries_total', 'Consultas SQL ejecutadas (con DB_PROFILE)', ['endpoint'])
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Duración de las consultas SQL (con DB_PROFILE)', ['operation'])
+DB_QUERIES_PER_REQUEST = Histogram(
+    'bot_db_queries_per_request', 'Consultas SQL por petición HTTP (con DB_PROFILE)', ['endpoint'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 250, 1000)
+)
+
+_slow_query_logger = None
+
+def get_slow_query_logger():
+    """Logger propio para consultas lentas (archivo aparte de bot.log)"""
+    global _slow_query_logger
+    if _slow_query_logger is None:
+        logger = logging.getLogger('slow_queries')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        handler = logging.FileHandler(SLOW_QUERY_LOG, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        logger.addHandler(handler)
+        _slow_query_logger = logger
+    return _slow_query_logger
+
+def explain_query(conn, sql, params):
+    """Plan de ejecución de una consulta (vacío si la sentencia no admite EXPLAIN)"""
+    if sql.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH'):
+        return []
+    try:
+        rows = sqlite3.Connection.execute(conn, f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    except sqlite3.Error:
+        return []
+    return [row[-1] for row in rows]
+
+def record_query(conn, sql, params, seconds):
+    """Contar la consulta en la petición actual y registrarla si supera SLOW_QUERY_MS"""
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'VACIA'
+    DB_QUERY_SECONDS.labels(operation).observe(seconds)
+    
+    if has_request_context():
+        endpoint = request.endpoint or 'desconocido'
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_seconds = g.get('db_seconds', 0.0) + seconds
+    else:
+        endpoint = 'background'
+    DB_QUERIES_TOTAL.labels(endpoint).inc()
+    
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        plan = explain_query(conn, sql, params)
+        get_slow_query_logger().info(
+            f"{seconds * 1000:.1f} ms [{endpoint}] {' '.join(sql.split())} | params={params!r} | "
+            f"plan={' ; '.join(plan) or '-'}"
+        )
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor que mide cada sentencia (el tiempo de fetch posterior no se incluye)"""
+    
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_query(self.connection, sql, params, time.perf_counter() - start)
+    
+    def executemany(self, sql, seq_of_params):
+        # Se materializa para poder usar la primera fila en EXPLAIN
+        seq_of_params = list(seq_of_params)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            record_query(self.connection, sql, seq_of_params[0] if seq_of_params else (),
+                         time.perf_counter() - start)
+    
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record_query(self.connection, sql_script, (), time.perf_counter() - start)
+
+class ProfiledConnection(sqlite3.Connection):
+    """Conexión cuyos cursores (incluidos los de conn.execute) pasan por ProfiledCursor"""
+    
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+    
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+    
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+@app.after_request
+def track_request_queries(response):
+    """Consultas SQL de la petición: histograma por endpoint y cabecera X-DB-Queries"""
+    if DB_PROFILE:
+        queries = g.get('db_queries', 0)
+        DB_QUERIES_PER_REQUEST.labels(request.endpoint or 'desconocido').observe(queries)
+        response.headers['X-DB-Queries'] = str(queries)
+        response.headers['X-DB-Time-Ms'] = f"{g.get('db_seconds', 0.0) * 1000:.1f}"
+    return response
+
+def connection_factory():
+    return ProfiledConnection if DB_PROFILE else sqlite3.Connection
+
+# Una conexión por hilo, reutilizada entre peticiones
+_db_local = threading.local()
+
+def get_db():
+    """Obtener la conexión SQLite del hilo actual (modo WAL, se abre una sola vez por hilo)"""
+    conn = getattr(_db_local, 'conn', None)
+    
+    # Reabrir si cambió la ruta de la base de datos o el perfilado (por ejemplo en tests)
+    if conn is not None and (_db_local.path != DATABASE or type(conn) is not connection_factory()):
+        conn.close()
+        conn = None
+    
+    if conn is None:
+        conn = sqlite3.connect(DATABASE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, factory=connection_factory())
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        _db_local.conn = conn
+        _db_local.path = DATABASE
+    
+    return conn
+
+def close_db():
+    """Cerrar la conexión del hilo actual (al terminar un hilo de trabajo)"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _db_local.conn = None
+
+@app.teardown_request
+def rollback_open_transaction(exception=None):
+    """Descartar transacciones que un handler dejó abiertas por un error"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# Índices secundarios; el rowid (id) va implícito al final de cada índice
+INDEXES = [
+    # Historial reciente: WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT n
+    'CREATE INDEX IF NOT EXISTS idx_conversations_user_timestamp ON conversations(user_id, timestamp)',
+    # Listados del panel de administración ordenados por fecha
+    'CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations(timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_leads_timestamp ON leads(timestamp)',
+    # Listado de leads filtrado por estado (paginación por cursor)
+    'CREATE INDEX IF NOT EXISTS idx_leads_status_timestamp ON leads(status, timestamp)',
+    # Despachador del outbox: pendientes por vencimiento
+    'CREATE INDEX IF NOT EXISTS idx_outbox_status_due ON notification_outbox(status, next_attempt_at)',
+    # Purga de identificadores de mensajes vencidos
+    'CREATE INDEX IF NOT EXISTS idx_processed_messages_received ON processed_messages(received_at)',
+    # Ranking de productos más cotizados en /analytics
+    'CREATE INDEX IF NOT EXISTS idx_stats_product_quotes ON stats_product_quotes(quotes)',
+]
+
+# Consultas del camino caliente; el código y audit_query_plans usan el mismo texto.
+# El id desempata filas con el mismo timestamp (resolución de un segundo)
+RECENT_HISTORY_SQL = '''
+    SELECT message, bot_response FROM conversations 
+    WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?
+'''
+
+USER_SESSION_SQL = '''
+    SELECT message_count, bot_message_count, last_product_key, last_product_at,
+           last_quantity, last_bot_response
+    FROM user_sessions WHERE user_id = ?
+'''
+
+OUTBOX_DUE_SQL = '''
+    SELECT id, phone_number, products, message, attempts FROM notification_outbox
+    WHERE status = 'pending' AND next_attempt_at <= ?
+    ORDER BY next_attempt_at LIMIT ?
+'''
+
+STATS_DAILY_SQL = '''
+    SELECT day, conversations 
+    FROM stats_daily 
+    ORDER BY day DESC
+    LIMIT 7
+'''
+
+STATS_PRODUCT_QUOTES_SQL = '''
+    SELECT product_key, quotes 
+    FROM stats_product_quotes 
+    ORDER BY quotes DESC
+'''
+
+# Listados paginados del panel de administración (fetch_page): más recientes primero,
+# continuando desde el cursor (timestamp, id) sin OFFSET
+LEADS_PAGE_COLUMNS = ['user_id', 'phone_number', 'products_interested', 'status']
+CONVERSATIONS_PAGE_COLUMNS = ['user_id', 'message', 'bot_response', 'phone_number']
+PAGE_CURSOR_CONDITION = '(timestamp, id) < (?, ?)'
+
+def build_page_sql(table, columns, conditions=()):
+    """SELECT de una página de `table`; el último parámetro es el LIMIT"""
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f'''
+        SELECT id, timestamp, {', '.join(columns)} FROM {table}
+        {where}
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ?
+    '''
+
+# Consultas que nunca deben recorrer una tabla completa
+HOT_QUERIES = [
+    ('historial_usuario', RECENT_HISTORY_SQL, ('user', 20)),
+    ('sesion_usuario', USER_SESSION_SQL, ('user',)),
+    ('admin_conversaciones_pagina', build_page_sql('conversations', CONVERSATIONS_PAGE_COLUMNS,
+                                                   [PAGE_CURSOR_CONDITION]), ('2100-01-01', 0, 51)),
+    ('admin_conversaciones_usuario', build_page_sql('conversations', CONVERSATIONS_PAGE_COLUMNS,
+                                                    ['user_id = ?', PAGE_CURSOR_CONDITION]),
+     ('user', '2100-01-01', 0, 51)),
+    ('outbox_pendientes', OUTBOX_DUE_SQL, (0, 20)),
+    ('stats_diarias', STATS_DAILY_SQL, ()),
+    ('stats_productos', STATS_PRODUCT_QUOTES_SQL, ()),
+    ('admin_leads_pagina', build_page_sql('leads', LEADS_PAGE_COLUMNS, [PAGE_CURSOR_CONDITION]),
+     ('2100-01-01', 0, 51)),
+    ('admin_leads_estado', build_page_sql('leads', LEADS_PAGE_COLUMNS,
+                                          ['status = ?', 'timestamp >= ?', PAGE_CURSOR_CONDITION]),
+     ('new', '2024-01-01', '2100-01-01', 0, 51)),
+]
+
+def is_full_scan(plan_detail):
+    """True si un paso de EXPLAIN QUERY PLAN recorre la tabla u ordena en memoria"""
+    if plan_detail.startswith('SCAN') and 'USING' not in plan_detail:
+        return True
+    return 'USE TEMP B-TREE' in plan_detail
+
+def audit_query_plans(conn=None):
+    """Revisar el plan de cada consulta caliente; devuelve [(nombre, paso)] de los problemas"""
+    conn = conn or get_db()
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params):
+            detail = row[-1]
+            if is_full_scan(detail):
+                problems.append((name, detail))
+    return problems
+
 def init_db():
     """Inicializar la base de datos SQLite"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -55,6 +384,81 @@ def init_db():
         )
     ''')
     
+    # Estado de conversación por usuario, mantenido al guardar cada mensaje
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_sessions'")
+    sessions_exist = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            bot_message_count INTEGER NOT NULL DEFAULT 0,
+            last_product_key TEXT,
+            last_product_at INTEGER,  -- message_count del mensaje que mencionó el producto
+            last_quantity INTEGER,
+            last_bot_response TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Outbox de notificaciones al dueño (pending -> sent | dead)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            phone_number TEXT,
+            products TEXT,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            channel TEXT,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Agregados mantenidos en cada escritura para /analytics y /admin
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_totals'")
+    stats_exist = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            conversations INTEGER NOT NULL DEFAULT 0,
+            quotes INTEGER NOT NULL DEFAULT 0,
+            leads INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_product_quotes (
+            product_key TEXT PRIMARY KEY,
+            quotes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Identificadores de mensajes ya recibidos (deduplicación de reentregas de webhooks)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            message_id TEXT PRIMARY KEY,
+            platform TEXT NOT NULL,
+            received_at REAL NOT NULL
+        )
+    ''')
+    
+    # Índices para las consultas calientes (ver HOT_QUERIES / audit_query_plans)
+    for index_sql in INDEXES:
+        cursor.execute(index_sql)
+    
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -113,53 +517,448 @@ def init_db():
         logging.error(f"Error en migración de base de datos: {e}")
         conn.rollback()
     
-    conn.close()
+    # Versión del catálogo en la base: la incrementan triggers en cada escritura a products,
+    # también las de otros procesos (setup_promotions.py, update_database.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS products_version_{event.lower()}
+            AFTER {event} ON products
+            BEGIN
+                UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+    conn.commit()
+    
+    invalidate_product_cache()
+    conversation_cache.clear()
+    seen_messages.clear()
+    
+    if not sessions_exist:
+        backfill_user_sessions()
+    
+    if not stats_exist:
+        rebuild_stats()
+    
     logging.info("Base de datos inicializada correctamente")
 
-def save_conversation(user_id, message, bot_response, phone_number=None):
-    """Guardar conversación en la base de datos"""
-    conn = sqlite3.connect(DATABASE)
+# Caché de historial reciente por usuario (LRU + TTL) para evitar consultas en cada turno
+HISTORY_WINDOW = 20  # Máximo de mensajes que necesita cualquier helper
+HISTORY_CACHE_USERS = int(os.getenv('HISTORY_CACHE_USERS', 5000))
+HISTORY_CACHE_TTL = int(os.getenv('HISTORY_CACHE_TTL', 1800))
+
+class ConversationTurn:
+    """Un par (mensaje, respuesta) del historial; se desempaqueta como tupla"""
+    __slots__ = ('message', 'bot_response', 'name_hits')
+    
+    def __init__(self, message, bot_response):
+        self.message = message
+        self.bot_response = bot_response
+        self.name_hits = count_name_hits(message)  # (femeninos, masculinos)
+    
+    def __iter__(self):
+        yield self.message
+        yield self.bot_response
+
+class UserSession:
+    """Ventana de los últimos turnos de un usuario, del más reciente al más antiguo
+
+    Mantiene el total de nombres femeninos/masculinos de la ventana para no
+    volver a escanear el historial al detectar el género.
+    """
+    __slots__ = ('turns', 'touched_at', 'female_hits', 'male_hits')
+    
+    def __init__(self, turns):
+        self.turns = deque(turns, maxlen=HISTORY_WINDOW)
+        self.touched_at = time.monotonic()
+        self.female_hits = sum(turn.name_hits[0] for turn in self.turns)
+        self.male_hits = sum(turn.name_hits[1] for turn in self.turns)
+    
+    def add_turn(self, turn):
+        """Agregar el turno más reciente descontando el que sale de la ventana"""
+        if len(self.turns) == self.turns.maxlen:
+            evicted = self.turns[-1]
+            self.female_hits -= evicted.name_hits[0]
+            self.male_hits -= evicted.name_hits[1]
+        self.turns.appendleft(turn)
+        self.female_hits += turn.name_hits[0]
+        self.male_hits += turn.name_hits[1]
+    
+    def gender(self):
+        """'female', 'male' o 'neutral' según los nombres mencionados en la ventana"""
+        if self.female_hits > self.male_hits:
+            return 'female'
+        elif self.male_hits > self.female_hits:
+            return 'male'
+        return 'neutral'
+
+class ConversationCache:
+    """Sesiones de usuarios activos acotadas por cantidad de usuarios y antigüedad"""
+    
+    def __init__(self, max_users, ttl_seconds):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id):
+        """Sesión vigente del usuario o None si no está en caché"""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return None
+            now = time.monotonic()
+            if now - session.touched_at > self.ttl_seconds:
+                del self._sessions[user_id]
+                return None
+            session.touched_at = now
+            self._sessions.move_to_end(user_id)
+            return session
+    
+    def put(self, user_id, rows):
+        """Cargar la ventana de un usuario desde filas (mensaje, respuesta) más recientes primero"""
+        session = UserSession(ConversationTurn(message, bot_response) for message, bot_response in rows)
+        with self._lock:
+            self._sessions[user_id] = session
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.max_users:
+                self._sessions.popitem(last=False)
+        return session
+    
+    def append(self, user_id, message, bot_response):
+        """Registrar un turno nuevo si el usuario ya está en caché"""
+        turn = ConversationTurn(message, bot_response)
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                session.add_turn(turn)
+    
+    def discard(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+conversation_cache = ConversationCache(HISTORY_CACHE_USERS, HISTORY_CACHE_TTL)
+
+def get_conversation_window(user_id):
+    """Sesión en memoria del usuario, cargándola desde la base de datos si no está en caché"""
+    session = conversation_cache.get(user_id)
+    
+    if session is None:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute(RECENT_HISTORY_SQL, (user_id, HISTORY_WINDOW))
+        session = conversation_cache.put(user_id, cursor.fetchall())
+    
+    return session
+
+def get_recent_conversations(user_id, limit=HISTORY_WINDOW):
+    """Últimos `limit` turnos del usuario (más reciente primero), desde caché si es posible"""
+    return list(itertools.islice(get_conversation_window(user_id).turns, limit))
+
+def record_quote(quote, quantity, total):
+    """Anotar la cotización de esta respuesta para guardarla junto con la conversación"""
+    if quote is not None:
+        quote['quantity'] = quantity
+        quote['total'] = total
+
+def save_conversation(user_id, message, bot_response, phone_number=None, quote=None):
+    """Guardar conversación y actualizar la sesión del usuario en la misma transacción
+
+    quote: dict llenado por get_bot_response() si la respuesta cotizó una cantidad.
+    """
+    save_conversations_batch([(user_id, message, bot_response, phone_number, quote)])
+    
+    logging.info(f"Conversación guardada - User: {user_id}, Message: {message}, Response: {bot_response}")
+
+@STAGE_SECONDS.labels('save_conversation').time()
+def save_conversations_batch(rows):
+    """Guardar varias conversaciones (user_id, mensaje, respuesta, teléfono, cotización) en una sola transacción"""
+    conn = get_db()
     cursor = conn.cursor()
     
-    lead_captured = phone_number is not None
+    user_ids = list(dict.fromkeys(row[0] for row in rows))
     
-    cursor.execute('''
-        INSERT INTO conversations (user_id, message, bot_response, lead_captured, phone_number)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, message, bot_response, lead_captured, phone_number))
+    try:
+        cursor.executemany('''
+            INSERT INTO conversations (user_id, message, bot_response, lead_captured, phone_number)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(user_id, message, bot_response, phone_number is not None, phone_number)
+              for user_id, message, bot_response, phone_number, _ in rows])
+        
+        # Sesiones existentes: usuarios nuevos y último producto para atribuir cotizaciones
+        placeholders = ','.join('?' * len(user_ids))
+        cursor.execute(f'SELECT user_id, last_product_key FROM user_sessions WHERE user_id IN ({placeholders})',
+                       user_ids)
+        last_products = dict(cursor.fetchall())
+        new_users = len(user_ids) - len(last_products)
+        
+        session_rows = []
+        product_quotes = {}
+        for user_id, message, bot_response, phone_number, quote in rows:
+            # La ventana en memoria ve la fila recién insertada (misma conexión)
+            conversation_cache.append(user_id, message, bot_response)
+            product_key, _ = detect_product(message)
+            if product_key:
+                last_products[user_id] = product_key
+            if 'bs' in bot_response.lower() and last_products.get(user_id):
+                quoted_key = last_products[user_id]
+                product_quotes[quoted_key] = product_quotes.get(quoted_key, 0) + 1
+            quantity = quote.get('quantity') if quote else None
+            session_rows.append((user_id, 1 if bot_response != '' else 0, product_key, product_key,
+                                 quantity, bot_response))
+        
+        # last_product_at guarda el número de mensaje para que el producto caduque
+        cursor.executemany('''
+            INSERT INTO user_sessions (user_id, message_count, bot_message_count, last_product_key,
+                                       last_product_at, last_quantity, last_bot_response, updated_at)
+            VALUES (?, 1, ?, ?, CASE WHEN ? IS NOT NULL THEN 1 END, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET
+                message_count = message_count + 1,
+                bot_message_count = bot_message_count + excluded.bot_message_count,
+                last_product_key = COALESCE(excluded.last_product_key, last_product_key),
+                last_product_at = CASE WHEN excluded.last_product_key IS NOT NULL
+                                       THEN message_count + 1 ELSE last_product_at END,
+                last_quantity = COALESCE(excluded.last_quantity, last_quantity),
+                last_bot_response = excluded.last_bot_response,
+                updated_at = CURRENT_TIMESTAMP
+        ''', session_rows)
+        
+        update_stats(cursor, conversations=len(rows), new_users=new_users, product_quotes=product_quotes)
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        for user_id in user_ids:
+            conversation_cache.discard(user_id)
+        raise
+
+def update_stats(cursor, conversations=0, leads=0, new_users=0, product_quotes=None):
+    """Sumar a los agregados de /analytics y /admin (dentro de la transacción del llamador)"""
+    product_quotes = product_quotes or {}
+    quotes = sum(product_quotes.values())
+    
+    cursor.executemany('''
+        INSERT INTO stats_totals (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    ''', [(name, value) for name, value in (('conversations', conversations), ('leads', leads),
+                                             ('unique_users', new_users)) if value])
+    
+    if conversations or quotes or leads:
+        # DATE('now') en UTC, igual que DATE(timestamp) sobre CURRENT_TIMESTAMP
+        cursor.execute('''
+            INSERT INTO stats_daily (day, conversations, quotes, leads) VALUES (DATE('now'), ?, ?, ?)
+            ON CONFLICT(day) DO UPDATE SET
+                conversations = conversations + excluded.conversations,
+                quotes = quotes + excluded.quotes,
+                leads = leads + excluded.leads
+        ''', (conversations, quotes, leads))
+    
+    cursor.executemany('''
+        INSERT INTO stats_product_quotes (product_key, quotes) VALUES (?, ?)
+        ON CONFLICT(product_key) DO UPDATE SET quotes = quotes + excluded.quotes
+    ''', list(product_quotes.items()))
+
+def get_stats_totals():
+    """Totales de conversaciones, leads y usuarios únicos desde los agregados"""
+    totals = {'conversations': 0, 'leads': 0, 'unique_users': 0}
+    totals.update(get_db().execute('SELECT name, value FROM stats_totals').fetchall())
+    return totals
+
+def rebuild_stats():
+    """Recalcular todos los agregados desde conversations (incluidos los archivos) y leads
+
+    El recorrido completo se hace sin transacción abierta (en WAL no bloquea a los
+    webhooks); solo el reemplazo final de las tablas stats_* toma el bloqueo de escritura.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
     
-    conn.commit()
-    conn.close()
+    # Conversaciones (vivas y archivadas) en orden; cotizaciones con la misma
+    # atribución que save_conversations_batch
+    totals = {'conversations': 0}
+    users = set()
+    daily_conversations = {}
+    last_products = {}
+    product_quotes = {}
+    daily_quotes = {}
+    
+    def accumulate(rows):
+        for user_id, message, bot_response, timestamp in rows:
+            day = timestamp[:10]
+            totals['conversations'] += 1
+            users.add(user_id)
+            daily_conversations[day] = daily_conversations.get(day, 0) + 1
+            
+            product_key, _ = detect_product(message)
+            if product_key:
+                last_products[user_id] = product_key
+            if 'bs' in bot_response.lower() and last_products.get(user_id):
+                quoted_key = last_products[user_id]
+                product_quotes[quoted_key] = product_quotes.get(quoted_key, 0) + 1
+                daily_quotes[day] = daily_quotes.get(day, 0) + 1
     
-    logging.info(f"Conversación guardada - User: {user_id}, Message: {message}, Response: {bot_response}")
+    scanned_max_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM conversations').fetchone()[0]
+    accumulate(iter_all_conversations(up_to_id=scanned_max_id))
+    
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        # Conversaciones guardadas durante el recorrido (ya sumadas a los agregados que se reemplazan)
+        accumulate(cursor.execute('''
+            SELECT user_id, message, bot_response, timestamp FROM conversations WHERE id > ? ORDER BY id
+        ''', (scanned_max_id,)).fetchall())
+        
+        cursor.execute('DELETE FROM stats_totals')
+        cursor.execute('DELETE FROM stats_daily')
+        cursor.execute('DELETE FROM stats_product_quotes')
+        
+        cursor.execute("INSERT INTO stats_totals (name, value) SELECT 'leads', COUNT(*) FROM leads")
+        cursor.execute('''
+            INSERT INTO stats_daily (day, leads)
+            SELECT DATE(timestamp), COUNT(*) FROM leads GROUP BY DATE(timestamp)
+        ''')
+        cursor.executemany('INSERT INTO stats_totals (name, value) VALUES (?, ?)',
+                           [('conversations', totals['conversations']), ('unique_users', len(users))])
+        cursor.executemany('''
+            INSERT INTO stats_daily (day, conversations, quotes) VALUES (?, ?, ?)
+            ON CONFLICT(day) DO UPDATE SET conversations = excluded.conversations, quotes = excluded.quotes
+        ''', [(day, count, daily_quotes.get(day, 0)) for day, count in daily_conversations.items()])
+        cursor.executemany('INSERT INTO stats_product_quotes (product_key, quotes) VALUES (?, ?)',
+                           list(product_quotes.items()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    logging.info(f"Agregados recalculados ({sum(product_quotes.values())} cotizaciones)")
 
-def get_bot_message_count(user_id):
-    """Contar cuántos mensajes ha enviado el bot a este usuario"""
-    conn = sqlite3.connect(DATABASE)
+def get_user_session(user_id):
+    """Estado de conversación del usuario (una búsqueda por clave primaria)"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute(USER_SESSION_SQL, (user_id,))
+    row = cursor.fetchone()
+    
+    if row is None:
+        return {
+            'message_count': 0,
+            'bot_message_count': 0,
+            'last_product_key': None,
+            'last_product_at': None,
+            'last_quantity': None,
+            'last_bot_response': ''
+        }
+    
+    message_count, bot_message_count, last_product_key, last_product_at, last_quantity, last_bot_response = row
+    return {
+        'message_count': message_count,
+        'bot_message_count': bot_message_count,
+        'last_product_key': last_product_key,
+        'last_product_at': last_product_at,
+        'last_quantity': last_quantity,
+        'last_bot_response': last_bot_response or ''
+    }
+
+LAST_PRODUCT_WINDOW = 5  # El último producto sigue vigente durante 5 mensajes del usuario
+
+def get_last_product(user_id, session):
+    """Último producto activo mencionado en los últimos LAST_PRODUCT_WINDOW mensajes
+
+    Usa el producto de la sesión; si se desactivó, busca otro en esos mensajes.
+    """
+    last_product_at = session['last_product_at']
+    if last_product_at is None or session['message_count'] - last_product_at >= LAST_PRODUCT_WINDOW:
+        return None
+    
+    product_info = get_active_products().get(session['last_product_key'])
+    if product_info:
+        return product_info
+    
+    for conv_msg, _ in get_recent_conversations(user_id, LAST_PRODUCT_WINDOW):
+        product_key, product_info = detect_product(conv_msg)
+        if product_key:
+            return product_info
+    return None
+
+def backfill_user_sessions():
+    """Poblar user_sessions a partir del historial existente (migración única)"""
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
-        SELECT COUNT(*) FROM conversations 
-        WHERE user_id = ? AND bot_response != ''
-    ''', (user_id,))
+        INSERT OR IGNORE INTO user_sessions (user_id, message_count, bot_message_count)
+        SELECT user_id, COUNT(*), SUM(CASE WHEN bot_response != '' THEN 1 ELSE 0 END)
+        FROM conversations
+        GROUP BY user_id
+    ''')
     
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    # Última respuesta del bot y último producto de los mensajes más recientes de cada usuario
+    cursor.execute('''
+        SELECT user_id, message, bot_response, position FROM (
+            SELECT user_id, message, bot_response,
+                   ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC, id DESC) AS position
+            FROM conversations
+        )
+        WHERE position <= ?
+        ORDER BY user_id, position
+    ''', (LAST_PRODUCT_WINDOW,))
+    sessions = {}
+    for user_id, message, bot_response, position in cursor.fetchall():
+        if position == 1:
+            sessions[user_id] = [bot_response, None, None]
+        if sessions[user_id][1] is None:
+            product_key, _ = detect_product(message)
+            if product_key:
+                sessions[user_id][1:] = [product_key, position]
+    
+    # position 1 es el último mensaje: last_product_at = message_count - position + 1
+    cursor.executemany('''
+        UPDATE user_sessions
+        SET last_bot_response = ?, last_product_key = ?, last_product_at = message_count + 1 - ?
+        WHERE user_id = ?
+    ''', [(bot_response, product_key, position, user_id)
+          for user_id, (bot_response, product_key, position) in sessions.items()])
+    conn.commit()
+    with_product = sum(1 for _, product_key, _ in sessions.values() if product_key)
+    logging.info(f"Sesiones de usuario migradas desde el historial ({with_product} con producto)")
 
-def apply_response_delay(user_id):
-    """Aplicar retraso de 4 segundos a partir del 3er mensaje del bot"""
+def get_bot_message_count(user_id):
+    """Contar cuántos mensajes ha enviado el bot a este usuario"""
+    return get_user_session(user_id)['bot_message_count']
+
+RESPONSE_DELAY_SECONDS = 4  # Retraso a partir del 3er mensaje del bot
+
+def get_response_delay(user_id):
+    """Segundos de retraso antes de responder: 4s a partir del 3er mensaje del bot"""
     message_count = get_bot_message_count(user_id)
     
     # A partir del mensaje #3 del bot, agregar retraso
     if message_count >= 2:  # >= 2 porque estamos por enviar el 3er mensaje
-        logging.info(f"🕐 Aplicando retraso de 4s (mensaje #{message_count + 1} para usuario {user_id})")
-        time.sleep(4)
+        logging.info(f"🕐 Aplicando retraso de {RESPONSE_DELAY_SECONDS}s (mensaje #{message_count + 1} para usuario {user_id})")
+        return RESPONSE_DELAY_SECONDS
+    return 0
 
-def send_whatsapp_notification(lead_info):
-    """Enviar notificación a WhatsApp cuando se capture un lead"""
-    owner_phone = "+59178056048"  # Tu número de WhatsApp
-    
+def apply_response_delay(user_id):
+    """Aplicar el retraso durmiendo el hilo (solo para los endpoints de prueba síncronos)"""
+    delay = get_response_delay(user_id)
+    if delay:
+        ARTIFICIAL_DELAY_SECONDS.labels('response_sleep').observe(delay)
+        time.sleep(delay)
+
+OWNER_PHONE = "+59178056048"  # Tu número de WhatsApp
+
+def format_lead_notification(lead_info):
+    """Armar el mensaje de WhatsApp para el dueño cuando se captura un lead"""
     # Crear mensaje detallado con información del pedido
     message = f"🔔 *NUEVO PEDIDO CAPTURADO!*\n\n"
     message += f"📱 *Cliente:* {lead_info['phone']}\n"
@@ -179,12 +978,13 @@ def send_whatsapp_notification(lead_info):
         
         # Calcular total si hay cantidad
         if 'order_details' in lead_info and lead_info['order_details']:
-            total = 0
-            for product in lead_info['order_details']:
-                calc = calculate_discount_and_total(lead_info['quantity'], product['price'], product.get('product_info'))
-                total += calc['total']
+            calcs = calculate_totals_batch(
+                (lead_info['quantity'], product['price'], product.get('product_info'))
+                for product in lead_info['order_details']
+            )
+            total = sum(calc['total'] for calc in calcs)
             message += f"💰 *Total estimado:* {total}bs"
-            if calc.get('has_discount'):
+            if any(calc['has_discount'] for calc in calcs):
                 message += f" (con descuento)"
             message += f"\n"
     
@@ -202,90 +1002,178 @@ def send_whatsapp_notification(lead_info):
     message += f"📞 Llamar: {lead_info['phone']}\n"
     message += f"📱 WhatsApp: wa.me/591{lead_info['phone']}"
     
-    # Opción 1: WhatsApp Business API gratuito (ultramsg.com)
-    try:
-        ultramsg_token = os.getenv('ULTRAMSG_TOKEN', '')
-        ultramsg_instance = os.getenv('ULTRAMSG_INSTANCE', '')
-        
-        logging.info(f"🔍 DEBUG - UltraMsg Token: {'✅ Configurado' if ultramsg_token else '❌ No encontrado'}")
-        logging.info(f"🔍 DEBUG - UltraMsg Instance: {'✅ Configurado' if ultramsg_instance else '❌ No encontrado'}")
-        
-        if ultramsg_token and ultramsg_instance:
-            url = f"https://api.ultramsg.com/{ultramsg_instance}/messages/chat"
-            payload = {
-                "token": ultramsg_token,
-                "to": owner_phone.replace('+', ''),
-                "body": message
-            }
-            
-            logging.info(f"📤 Intentando enviar WhatsApp a: {owner_phone}")
-            logging.info(f"📤 URL: {url}")
-            
-            response = requests.post(url, data=payload, timeout=10)
-            logging.info(f"📥 Respuesta UltraMsg: Status {response.status_code} - {response.text}")
-            
-            if response.status_code == 200:
-                logging.info(f"✅ Notificación WhatsApp enviada exitosamente")
-                return True
-            else:
-                logging.warning(f"❌ Error enviando WhatsApp via UltraMsg: {response.status_code} - {response.text}")
-        else:
-            logging.warning(f"⚠️ Variables UltraMsg no configuradas en el servidor")
-    except Exception as e:
-        logging.error(f"💥 Error enviando notificación WhatsApp: {e}")
-        import traceback
-        logging.error(f"💥 Traceback: {traceback.format_exc()}")
+    return message
+
+def send_owner_notification_ultramsg(message):
+    """Opción 1: WhatsApp Business API gratuito (ultramsg.com)"""
+    if not ULTRAMSG_TOKEN or not ULTRAMSG_INSTANCE:
+        return None  # Canal no configurado
     
-    # Opción 2: CallMeBot (backup)
-    try:
-        callmebot_key = os.getenv('CALLMEBOT_API_KEY', '')
-        if callmebot_key:
-            callmebot_url = f"https://api.callmebot.com/whatsapp.php"
-            params = {
-                'phone': owner_phone.replace('+', ''),
-                'text': message,
-                'apikey': callmebot_key
-            }
-            
-            response = requests.get(callmebot_url, params=params)
-            if response.status_code == 200:
-                logging.info(f"✅ Notificación WhatsApp enviada via CallMeBot")
-                return True
-    except Exception as e:
-        logging.error(f"Error con CallMeBot: {e}")
+    url = f"https://api.ultramsg.com/{ULTRAMSG_INSTANCE}/messages/chat"
+    payload = {
+        "token": ULTRAMSG_TOKEN,
+        "to": OWNER_PHONE.replace('+', ''),
+        "body": message
+    }
+    
+    logging.info(f"📤 Intentando enviar WhatsApp a: {OWNER_PHONE}")
+    
+    response = http_client.post(url, data=payload)
+    logging.info(f"📥 Respuesta UltraMsg: Status {response.status_code} - {response.text}")
+    
+    if response.status_code != 200:
+        raise RuntimeError(f"UltraMsg {response.status_code}: {response.text[:200]}")
+    return True
+
+def send_owner_notification_callmebot(message):
+    """Opción 2: CallMeBot (backup)"""
+    if not CALLMEBOT_API_KEY:
+        return None  # Canal no configurado
+    
+    callmebot_url = f"https://api.callmebot.com/whatsapp.php"
+    params = {
+        'phone': OWNER_PHONE.replace('+', ''),
+        'text': message,
+        'apikey': CALLMEBOT_API_KEY
+    }
     
-    # Opción 3: Log detallado para monitoreo manual
-    logging.info(f"🔔🔔🔔 LEAD CAPTURADO - CONTACTAR CLIENTE: {lead_info['phone']} - PRODUCTOS: {', '.join(lead_info['products'])} 🔔🔔🔔")
+    response = http_client.get(callmebot_url, params=params)
+    if response.status_code != 200:
+        raise RuntimeError(f"CallMeBot {response.status_code}: {response.text[:200]}")
+    return True
+
+# Canales de notificación al dueño, en orden de preferencia
+NOTIFICATION_CHANNELS = [
+    ('ultramsg', send_owner_notification_ultramsg),
+    ('callmebot', send_owner_notification_callmebot),
+]
+
+def deliver_owner_notification(message):
+    """Intentar cada canal en orden; devuelve (canal, None) si se envió o (None, error)"""
+    errors = []
+    
+    for channel, send in NOTIFICATION_CHANNELS:
+        try:
+            if send(message) is None:
+                continue
+            logging.info(f"✅ Notificación WhatsApp enviada via {channel}")
+            return channel, None
+        except Exception as e:
+            logging.warning(f"❌ Error enviando notificación via {channel}: {e}")
+            errors.append(f"{channel}: {e}")
     
-    # Opción 4: Escribir a archivo para monitoreo
+    return None, '; '.join(errors) or 'sin canales configurados'
+
+# Outbox de notificaciones: se escribe junto con el lead y se entrega en segundo plano
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 6))
+OUTBOX_BASE_BACKOFF = float(os.getenv('OUTBOX_BASE_BACKOFF', 30))   # segundos
+OUTBOX_MAX_BACKOFF = float(os.getenv('OUTBOX_MAX_BACKOFF', 3600))
+OUTBOX_POLL_INTERVAL = 60  # Revisión periódica aunque nadie despierte al despachador
+
+_outbox_wakeup = threading.Event()
+_outbox_dispatcher = None
+_outbox_dispatcher_lock = threading.Lock()
+
+def enqueue_lead_notification(cursor, lead_info):
+    """Insertar la notificación en el outbox (dentro de la transacción del lead)"""
+    cursor.execute('''
+        INSERT INTO notification_outbox (user_id, phone_number, products, message, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (lead_info['user_id'], lead_info['phone'], json.dumps(lead_info['products']),
+          format_lead_notification(lead_info), time.time()))
+
+def write_urgent_lead_file(phone_number, products):
+    """Último recurso: dejar el lead en un archivo para monitoreo manual"""
+    logging.info(f"🔔🔔🔔 LEAD CAPTURADO - CONTACTAR CLIENTE: {phone_number} - PRODUCTOS: {', '.join(products)} 🔔🔔🔔")
     try:
         with open('leads_urgentes.txt', 'a', encoding='utf-8') as f:
-            f.write(f"{datetime.now().strftime('%H:%M %d/%m/%Y')} - CLIENTE: {lead_info['phone']} - PRODUCTOS: {', '.join(lead_info['products'])}\n")
+            f.write(f"{datetime.now().strftime('%H:%M %d/%m/%Y')} - CLIENTE: {phone_number} - PRODUCTOS: {', '.join(products)}\n")
     except Exception as e:
         logging.error(f"Error escribiendo archivo leads: {e}")
+
+def dispatch_outbox_once(batch_size=20):
+    """Entregar las notificaciones vencidas; devuelve la espera hasta la próxima (segundos)"""
+    conn = get_db()
+    cursor = conn.cursor()
     
-    return False
+    cursor.execute(OUTBOX_DUE_SQL, (time.time(), batch_size))
+    
+    for outbox_id, phone_number, products, message, attempts in cursor.fetchall():
+        channel, error = deliver_owner_notification(message)
+        attempts += 1
+        
+        OWNER_NOTIFICATIONS_TOTAL.labels('sent' if channel else 'failed').inc()
+        if channel:
+            cursor.execute('''
+                UPDATE notification_outbox
+                SET status = 'sent', attempts = ?, channel = ?, last_error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (attempts, channel, outbox_id))
+        elif attempts >= OUTBOX_MAX_ATTEMPTS or error == 'sin canales configurados':
+            # Dead letter: visible en /admin y en leads_urgentes.txt
+            cursor.execute('''
+                UPDATE notification_outbox
+                SET status = 'dead', attempts = ?, last_error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (attempts, error, outbox_id))
+            logging.error(f"☠️ Notificación {outbox_id} descartada tras {attempts} intento(s): {error}")
+            write_urgent_lead_file(phone_number, json.loads(products or '[]'))
+        else:
+            backoff = min(OUTBOX_BASE_BACKOFF * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF)
+            cursor.execute('''
+                UPDATE notification_outbox
+                SET attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (attempts, time.time() + backoff, error, outbox_id))
+            logging.warning(f"🔁 Notificación {outbox_id} reintentará en {backoff:.0f}s (intento {attempts})")
+        conn.commit()
+    
+    cursor.execute("SELECT MIN(next_attempt_at) FROM notification_outbox WHERE status = 'pending'")
+    next_due = cursor.fetchone()[0]
+    if next_due is None:
+        return OUTBOX_POLL_INTERVAL
+    return min(max(next_due - time.time(), 0), OUTBOX_POLL_INTERVAL)
+
+def outbox_dispatcher():
+    """Hilo despachador del outbox de notificaciones"""
+    while True:
+        try:
+            wait_time = dispatch_outbox_once()
+        except Exception as e:
+            logging.error(f"💥 Error en despachador de notificaciones: {e}")
+            conn = getattr(_db_local, 'conn', None)
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
+            wait_time = OUTBOX_POLL_INTERVAL
+        _outbox_wakeup.wait(wait_time)
+        _outbox_wakeup.clear()
 
+def start_notification_dispatcher():
+    """Arrancar el despachador del outbox (una sola vez)"""
+    global _outbox_dispatcher
+    with _outbox_dispatcher_lock:
+        if _outbox_dispatcher is None:
+            _outbox_dispatcher = threading.Thread(target=outbox_dispatcher, name='outbox-dispatcher', daemon=True)
+            _outbox_dispatcher.start()
+
+@STAGE_SECONDS.labels('save_lead').time()
 def save_lead(user_id, phone_number, products_interested):
-    """Guardar lead en la base de datos"""
-    conn = sqlite3.connect(DATABASE)
+    """Guardar lead en la base de datos y encolar la notificación al dueño"""
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
+        cursor.execute('SELECT 1 FROM leads WHERE user_id = ?', (user_id,))
+        if cursor.fetchone() is None:
+            update_stats(cursor, leads=1)
+        
         cursor.execute('''
             INSERT OR REPLACE INTO leads (user_id, phone_number, products_interested)
             VALUES (?, ?, ?)
         ''', (user_id, phone_number, json.dumps(products_interested)))
         
-        conn.commit()
-        logging.info(f"Lead capturado - User: {user_id}, Phone: {phone_number}, Products: {products_interested}")
-        
         # Obtener información detallada de la conversación
-        cursor.execute('''
-            SELECT message, bot_response FROM conversations 
-            WHERE user_id = ? ORDER BY timestamp DESC LIMIT 10
-        ''', (user_id,))
-        conversation_history = cursor.fetchall()
+        conversation_history = get_recent_conversations(user_id, 10)
         
         # Obtener información de productos con precios
         products = get_active_products()
@@ -303,8 +1191,8 @@ def save_lead(user_id, phone_number, products_interested):
                 })
                 total_estimated += product_info['price']  # Estimado para 1 unidad
         
-        # Detectar cantidad mencionada en la conversación
-        quantity_detected = None
+        # Cantidad: la última cotizada en la sesión o la mencionada en la conversación
+        quantity_detected = get_user_session(user_id)['last_quantity']
         delivery_preference = "No especificado"
         
         for msg, bot_resp in conversation_history:
@@ -320,7 +1208,7 @@ def save_lead(user_id, phone_number, products_interested):
             elif any(keyword in msg_lower for keyword in ['recoger', 'pasar a recoger', 'recojo']):
                 delivery_preference = "Recoger en almacén"
         
-        # Enviar notificación a WhatsApp del dueño
+        # Notificación a WhatsApp del dueño: se encola en la misma transacción del lead
         lead_info = {
             'phone': phone_number,
             'products': products_interested,
@@ -331,16 +1219,161 @@ def save_lead(user_id, phone_number, products_interested):
             'total_estimated': total_estimated,
             'conversation_history': conversation_history[:5]  # Últimas 5 interacciones
         }
-        send_whatsapp_notification(lead_info)
+        enqueue_lead_notification(cursor, lead_info)
+        
+        conn.commit()
+        LEADS_TOTAL.inc()
+        logging.info(f"Lead capturado - User: {user_id}, Phone: {phone_number}, Products: {products_interested}")
+        
+        start_notification_dispatcher()
+        _outbox_wakeup.set()
         
     except Exception as e:
         logging.error(f"Error guardando lead: {e}")
-    finally:
-        conn.close()
+        conn.rollback()
+
+# Caché en memoria del catálogo: se recarga solo cuando cambia la tabla products
+_catalog_lock = threading.Lock()
+_catalog_cache = {
+    'version': 0,          # Se incrementa con cada cambio en products
+    'loaded_version': -1,  # Versión con la que se construyó el caché
+    'db_version': None,    # catalog_version de la base al cargar (cambios de otros procesos)
+    'checked_at': 0.0,     # Última consulta de catalog_version (time.monotonic())
+    'catalog': ({}, None)  # (productos, autómata de palabras clave)
+}
+
+# Cada cuántos segundos se consulta catalog_version (0 = antes de cada uso del caché)
+CATALOG_CHECK_INTERVAL = float(os.getenv('CATALOG_CHECK_INTERVAL', 1.0))
+
+class KeywordAutomaton:
+    """Autómata Aho-Corasick: encuentra todas las palabras clave de un texto en una sola pasada"""
+    
+    def __init__(self, keywords):
+        """keywords: iterable de pares (palabra, valor) ya normalizados"""
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]  # Por estado: lista de (longitud, valor)
+        
+        for keyword, value in keywords:
+            self._add(keyword, value)
+        self._build_failure_links()
+    
+    def _add(self, keyword, value):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((len(keyword), value))
+    
+    def _build_failure_links(self):
+        # Recorrido en anchura: cada estado hereda las salidas de su enlace de fallo
+        queue = list(self._goto[0].values())
+        while queue:
+            next_queue = []
+            for state in queue:
+                for char, child in self._goto[state].items():
+                    fallback = self._fail[state]
+                    while fallback and char not in self._goto[fallback]:
+                        fallback = self._fail[fallback]
+                    self._fail[child] = self._goto[fallback].get(char, 0)
+                    self._output[child] = self._output[child] + self._output[self._fail[child]]
+                    next_queue.append(child)
+            queue = next_queue
+    
+    def find_all(self, text):
+        """Generar (inicio, fin, valor) para cada coincidencia, incluidas las solapadas"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in output[state]:
+                yield index - length + 1, index + 1, value
+
+def build_product_automaton(products):
+    """Compilar las palabras clave de todo el catálogo en un único autómata"""
+    entries = []
+    for order, (product_key, product_info) in enumerate(products.items()):
+        for keyword in product_info['keywords']:
+            keyword = keyword.strip().lower()
+            if keyword:
+                entries.append((keyword, (order, product_key)))
+    return KeywordAutomaton(entries)
+
+def invalidate_product_cache():
+    """Marcar el catálogo en memoria como desactualizado tras escribir en products"""
+    with _catalog_lock:
+        _catalog_cache['version'] += 1
+        version = _catalog_cache['version']
+    logging.info(f"Caché de productos invalidado (versión {version})")
+
+def get_catalog_version():
+    """Versión actual del catálogo (cambia con cada escritura en products)"""
+    return _catalog_cache['version']
+
+def read_catalog_db_version():
+    """Versión del catálogo guardada en la base (None si la tabla aún no existe)"""
+    try:
+        row = get_db().execute('SELECT version FROM catalog_version WHERE id = 1').fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+def check_catalog_db_version():
+    """Invalidar el caché si otro proceso escribió en products (a lo sumo cada CATALOG_CHECK_INTERVAL s)"""
+    now = time.monotonic()
+    if CATALOG_CHECK_INTERVAL and now - _catalog_cache['checked_at'] < CATALOG_CHECK_INTERVAL:
+        return
+    _catalog_cache['checked_at'] = now
+    
+    db_version = read_catalog_db_version()
+    if db_version is not None and db_version != _catalog_cache['db_version']:
+        with _catalog_lock:
+            _catalog_cache['version'] += 1
+
+def get_product_catalog():
+    """Obtener (productos, autómata) desde el caché en memoria, recargando solo si cambió la versión
+
+    Los objetos devueltos son compartidos: los llamadores no deben modificarlos.
+    """
+    check_catalog_db_version()
+    if _catalog_cache['loaded_version'] == _catalog_cache['version']:
+        return _catalog_cache['catalog']
+    
+    with _catalog_lock:
+        # Otro hilo pudo haber recargado mientras esperábamos el lock
+        version = _catalog_cache['version']
+        if _catalog_cache['loaded_version'] != version:
+            # La versión se lee antes de cargar: un cambio concurrente provoca otra recarga, no una pérdida
+            db_version = read_catalog_db_version()
+            try:
+                products = load_active_products()
+            except sqlite3.Error:
+                # Seguir con el catálogo anterior; la versión queda pendiente y se reintenta en la próxima llamada
+                return _catalog_cache['catalog']
+            # Precompilar los escalones de descuento fuera del camino de respuesta
+            for product in products.values():
+                product['discount_tiers'] = compile_discount_tiers(product.get('bulk_discounts', '{}'))
+            _catalog_cache['catalog'] = (products, build_product_automaton(products))
+            _catalog_cache['db_version'] = db_version
+            _catalog_cache['loaded_version'] = version
+            logging.info(f"Catálogo cargado en memoria: {len(products)} productos (versión {version})")
+        return _catalog_cache['catalog']
 
 def get_active_products():
+    """Obtener productos activos desde el caché en memoria (sin acceso a la BD si está vigente)"""
+    return get_product_catalog()[0]
+
+def load_active_products():
     """Obtener productos activos y en stock desde la base de datos con información de promociones"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Verificar qué columnas existen para compatibilidad con BD antigua
@@ -404,39 +1437,85 @@ def get_active_products():
     
     except Exception as e:
         logging.error(f"Error obteniendo productos: {e}")
-        products = {}
+        raise
     
-    conn.close()
     return products
 
 def detect_product(message):
     """Detectar qué producto menciona el usuario (usando base de datos)"""
-    message_lower = message.lower()
-    products = get_active_products()
+    products, automaton = get_product_catalog()
     
-    for product_key, product_info in products.items():
-        for keyword in product_info['keywords']:
-            if keyword.strip().lower() in message_lower:
-                return product_key, product_info
+    # Preferir la coincidencia más larga ("plato hondo" antes que "plato"),
+    # luego la que aparece primero y por último el orden del catálogo
+    best = None
+    for start, end, (order, product_key) in automaton.find_all(message.lower()):
+        rank = (start - end, start, order)
+        if best is None or rank < best[0]:
+            best = (rank, product_key)
+    
+    if best:
+        product_key = best[1]
+        return product_key, products[product_key]
+    
+    return None, None
+
+# Extractor de teléfonos bolivianos: una sola expresión precompilada, una sola pasada
+PHONE_TEXT_NORMALIZATION = str.maketrans({
+    '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2013': '-', '\u2014': '-', '\u2212': '-',
+    '\u00a0': ' ', '(': ' ', ')': ' ', '/': ' '
+})
+
+PHONE_PATTERN = re.compile(r'''
+    (?<![\d+])                           # No empezar a mitad de otro número
+    (?P<prefix>(?:\+|00)\s?591|591)?      # Código de país opcional
+    [\s-]?
+    (?P<number>                          # Solo las formas reales, con un separador como máximo:
+        \d{4}[\s.-]\d{4}                 #   7805 6048
+        | \d{3}[\s-]\d{5}                 #   780 56048
+        | [234][\s-]\d{7}                 #   3 3456789 (código de área + fijo)
+        | \d{7,8}                        #   78056048 / 3345678
+    )
+    (?![\d.,-]?\d)                       # Fechas, montos y listas de números no son teléfonos
+''', re.VERBOSE)
+
+PHONE_MIN_CONFIDENCE = 0.4  # Confianza mínima para tratar un candidato como lead
+
+def extract_phone_candidates(message):
+    """Extraer todos los posibles teléfonos del mensaje con su tipo y nivel de confianza"""
+    candidates = []
+    
+    for match in PHONE_PATTERN.finditer(message.translate(PHONE_TEXT_NORMALIZATION)):
+        raw_number = match.group('number')
+        digits = re.sub(r'\D', '', raw_number)
+        has_prefix = match.group('prefix') is not None
+        
+        if len(digits) == 8 and digits[0] in '67':
+            phone_type, confidence = 'mobile', 0.95 if has_prefix else 0.9
+        elif len(digits) == 8 and digits[0] in '234':
+            # Fijo con código de área (2: La Paz, 3: Santa Cruz, 4: Cochabamba)
+            phone_type, confidence = 'landline', 0.85 if has_prefix else 0.75
+        elif len(digits) == 8:
+            phone_type, confidence = 'unknown', 0.4
+        else:
+            # 7 dígitos: fijo local sin código de área
+            phone_type, confidence = 'landline_local', 0.3
+        
+        candidates.append({
+            'number': digits,
+            'type': phone_type,
+            'confidence': round(confidence, 2)
+        })
     
-    return None, None
+    return candidates
 
 def detect_phone_number(message):
-    """Detectar número de teléfono en el mensaje"""
-    # Patrones para detectar teléfonos bolivianos
-    patterns = [
-        r'\b(\d{8})\b',  # 8 dígitos seguidos
-        r'\b(\d{4}[-\s]?\d{4})\b',  # 4-4 dígitos con guión o espacio
-        r'\b7[0-9]{7}\b',  # Celulares que empiezan con 7
-        r'\b6[0-9]{7}\b',  # Celulares que empiezan con 6
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, message)
-        if match:
-            return match.group(1).replace('-', '').replace(' ', '')
+    """Detectar número de teléfono en el mensaje (el candidato más confiable)"""
+    best = None
+    for candidate in extract_phone_candidates(message):
+        if candidate['confidence'] >= PHONE_MIN_CONFIDENCE and (best is None or candidate['confidence'] > best['confidence']):
+            best = candidate
     
-    return None
+    return best['number'] if best else None
 
 def detect_quantity(message):
     """Detectar cantidad en el mensaje"""
@@ -459,36 +1538,80 @@ def detect_quantity(message):
     
     return None
 
-def is_quantity_inquiry(message):
-    """Detectar si es una consulta de cantidad (no una compra definitiva)"""
-    message_lower = message.lower()
-    
-    # Palabras que indican consulta/pregunta
-    inquiry_keywords = [
+# Palabras clave por intención, en el orden de prioridad de get_bot_response()
+INTENT_KEYWORDS = {
+    'negotiation': [
+        'nada menos', 'descuento', 'rebaja', 'barato', 'más barato', 'mas barato',
+        'promocion', 'promoción', 'oferta', 'menos precio', 'precio mejor',
+        'más económico', 'mas economico', 'algo menos', 'no hay descuento'
+    ],
+    'delivery': ['entrega', 'delivery', 'domicilio', 'entregan', 'envio', 'envío', 'traen'],
+    'pickup': ['recoger', 'pasar a recoger', 'puedo pasar', 'voy a recoger', 'recojo'],
+    'phone_request': ['su telefono', 'tu telefono', 'mandeme su telefono', 'dame tu numero'],
+    'confirmation': ['ok', 'okey', 'okay', 'oki', 'okis', 'está bien', 'esta bien', 'bueno', 'dale', 'sale', 'si me parece', 'me parece bien'],
+    'thanks': ['gracias', 'graciad', 'grax', 'thank'],
+    'goodbye': ['chau', 'chaucito', 'adiós', 'adios', 'hasta luego', 'nos vemos', 'bye', 'byebye', 'goodbye'],
+    'price': [
+        'precio', 'cuesta', 'vale', 'cuanto', 'cuánto', 'costa', 'costo',
+        'están', 'estan', 'cuanto sale', 'cuánto sale', 'a cuanto', 'a cuánto',
+        'que precio', 'qué precio', 'cuanto vale', 'cuánto vale', 'que cuesta',
+        'qué cuesta', 'cuanto cuesta', 'cuánto cuesta'
+    ],
+    'greeting': ['hola', 'holas', 'holi', 'buenos', 'buenas', 'saludos'],
+    'interest': ['busco', 'necesito', 'quiero comprar', 'me interesa', 'quisiera'],
+    # Consulta de cantidad (no una compra definitiva), ver is_quantity_inquiry()
+    'quantity_inquiry': [
         'no me hace precio', 'me hace precio', 'precio', 'cuanto', 'cuánto',
         'en cuanto', 'sale', 'vale', 'cuesta', '?'
     ]
-    
-    return any(keyword in message_lower for keyword in inquiry_keywords)
+}
+
+# Palabras cortas ('ok', 'sale', 'vale'...) solo cuentan como palabra completa,
+# por eso sus variantes de chat ('oki', 'holi', 'chaucito', 'goodbye') van explícitas en la lista
+WHOLE_WORD_MAX_LENGTH = 4
+
+def build_intent_automaton(intent_keywords):
+    """Compilar todas las listas de intención en un único autómata"""
+    entries = []
+    for intent, keywords in intent_keywords.items():
+        for keyword in keywords:
+            whole_word = len(keyword) <= WHOLE_WORD_MAX_LENGTH and keyword.isalnum()
+            entries.append((keyword, (intent, whole_word)))
+    return KeywordAutomaton(entries)
+
+_intent_automaton = build_intent_automaton(INTENT_KEYWORDS)
+
+def classify_intents(message_lower):
+    """Todas las intenciones presentes en el mensaje (ya en minúsculas), en una sola pasada"""
+    intents = set()
+    for start, end, (intent, whole_word) in _intent_automaton.find_all(message_lower):
+        if whole_word:
+            # Se toleran letras finales repetidas del chat ("holaaa", "okk")
+            stop = end
+            while stop < len(message_lower) and message_lower[stop] == message_lower[end - 1]:
+                stop += 1
+            if (start > 0 and message_lower[start - 1].isalnum()) or \
+                    (stop < len(message_lower) and message_lower[stop].isalnum()):
+                continue
+        intents.add(intent)
+    return intents
+
+def is_quantity_inquiry(message):
+    """Detectar si es una consulta de cantidad (no una compra definitiva)"""
+    return 'quantity_inquiry' in classify_intents(message.lower())
 
 def send_facebook_typing_indicator(recipient_id, action="typing_on"):
     """Enviar indicador de escritura a Facebook Messenger"""
-    page_access_token = os.getenv('PAGE_ACCESS_TOKEN')
-    
-    if not page_access_token or page_access_token == 'PEGA_AQUI_TU_PAGE_ACCESS_TOKEN':
+    if not facebook_configured():
         return False
     
-    url = f"https://graph.facebook.com/v18.0/me/messages?access_token={page_access_token}"
-    
     payload = {
         'recipient': {'id': recipient_id},
         'sender_action': action  # "typing_on", "typing_off", o "mark_seen"
     }
     
-    headers = {'Content-Type': 'application/json'}
-    
     try:
-        response = requests.post(url, data=json.dumps(payload), headers=headers)
+        response = http_client.post(GRAPH_API_MESSAGES_URL, params={'access_token': PAGE_ACCESS_TOKEN}, json=payload)
         if response.status_code == 200:
             logging.info(f"Indicador de escritura enviado: {action}")
             return True
@@ -501,23 +1624,17 @@ def send_facebook_typing_indicator(recipient_id, action="typing_on"):
 
 def send_facebook_message(recipient_id, message_text):
     """Enviar mensaje de respuesta a Facebook Messenger"""
-    page_access_token = os.getenv('PAGE_ACCESS_TOKEN')
-    
-    if not page_access_token or page_access_token == 'PEGA_AQUI_TU_PAGE_ACCESS_TOKEN':
+    if not facebook_configured():
         logging.warning("PAGE_ACCESS_TOKEN no configurado. No se puede enviar mensaje a Facebook.")
         return False
     
-    url = f"https://graph.facebook.com/v18.0/me/messages?access_token={page_access_token}"
-    
     payload = {
         'recipient': {'id': recipient_id},
         'message': {'text': message_text}
     }
     
-    headers = {'Content-Type': 'application/json'}
-    
     try:
-        response = requests.post(url, data=json.dumps(payload), headers=headers)
+        response = http_client.post(GRAPH_API_MESSAGES_URL, params={'access_token': PAGE_ACCESS_TOKEN}, json=payload)
         
         if response.status_code == 200:
             logging.info(f"Mensaje enviado a Facebook: {message_text}")
@@ -533,10 +1650,7 @@ def send_facebook_message(recipient_id, message_text):
 def send_whatsapp_typing_indicator(recipient_phone, action="recording"):
     """Enviar indicador de escritura a WhatsApp via UltraMsg"""
     try:
-        ultramsg_token = os.getenv('ULTRAMSG_TOKEN', '')
-        ultramsg_instance = os.getenv('ULTRAMSG_INSTANCE', '')
-        
-        if not ultramsg_token or not ultramsg_instance:
+        if not ULTRAMSG_TOKEN or not ULTRAMSG_INSTANCE:
             return False
         
         # Asegurar formato correcto del número
@@ -545,14 +1659,14 @@ def send_whatsapp_typing_indicator(recipient_phone, action="recording"):
             clean_phone = '591' + clean_phone
         
         # UltraMsg permite "typing" o "recording"
-        url = f"https://api.ultramsg.com/{ultramsg_instance}/messages/action"
+        url = f"https://api.ultramsg.com/{ULTRAMSG_INSTANCE}/messages/action"
         payload = {
-            "token": ultramsg_token,
+            "token": ULTRAMSG_TOKEN,
             "to": clean_phone,
             "action": action  # "typing" o "recording"
         }
         
-        response = requests.post(url, data=payload, timeout=5)
+        response = http_client.post(url, data=payload, timeout=(CONNECT_TIMEOUT, 5))
         
         if response.status_code == 200:
             logging.info(f"Indicador WhatsApp enviado: {action} a {clean_phone}")
@@ -568,10 +1682,7 @@ def send_whatsapp_typing_indicator(recipient_phone, action="recording"):
 def send_whatsapp_response(recipient_phone, message_text):
     """Enviar mensaje de respuesta a WhatsApp via UltraMsg"""
     try:
-        ultramsg_token = os.getenv('ULTRAMSG_TOKEN', '')
-        ultramsg_instance = os.getenv('ULTRAMSG_INSTANCE', '')
-        
-        if not ultramsg_token or not ultramsg_instance:
+        if not ULTRAMSG_TOKEN or not ULTRAMSG_INSTANCE:
             logging.warning("⚠️ UltraMsg no configurado para enviar respuestas")
             return False
         
@@ -580,16 +1691,16 @@ def send_whatsapp_response(recipient_phone, message_text):
         if not clean_phone.startswith('591'):
             clean_phone = '591' + clean_phone
             
-        url = f"https://api.ultramsg.com/{ultramsg_instance}/messages/chat"
+        url = f"https://api.ultramsg.com/{ULTRAMSG_INSTANCE}/messages/chat"
         payload = {
-            "token": ultramsg_token,
+            "token": ULTRAMSG_TOKEN,
             "to": clean_phone,
             "body": message_text
         }
         
         logging.info(f"📤 Enviando respuesta WhatsApp a: {clean_phone}")
         
-        response = requests.post(url, data=payload, timeout=10)
+        response = http_client.post(url, data=payload)
         
         if response.status_code == 200:
             response_data = response.json()
@@ -605,56 +1716,47 @@ def send_whatsapp_response(recipient_phone, message_text):
         logging.error(f"💥 Traceback: {traceback.format_exc()}")
         return False
 
+# Léxico de nombres para detectar género (cargado una sola vez)
+NAME_LEXICON_PATH = os.getenv('NAME_LEXICON_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nombres_genero.json'))
+WORD_PATTERN = re.compile(r'[^\W\d_]+')
+
+def strip_accents(text):
+    """Quitar tildes para comparar 'maría' con 'maria'"""
+    return ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+
+def load_name_lexicon(path):
+    """Cargar nombres femeninos y masculinos desde un JSON {"female": [...], "male": [...]}"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            lexicon = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"No se pudo cargar el léxico de nombres {path}: {e}")
+        return frozenset(), frozenset()
+    
+    female = frozenset(strip_accents(name.strip().lower()) for name in lexicon.get('female', []))
+    male = frozenset(strip_accents(name.strip().lower()) for name in lexicon.get('male', []))
+    logging.info(f"Léxico de nombres cargado: {len(female)} femeninos, {len(male)} masculinos")
+    return female, male
+
+FEMALE_NAMES, MALE_NAMES = load_name_lexicon(NAME_LEXICON_PATH)
+
+def count_name_hits(message):
+    """Contar palabras del mensaje que son nombres femeninos y masculinos"""
+    female_count = male_count = 0
+    for token in WORD_PATTERN.findall(strip_accents(message.lower())):
+        if token in FEMALE_NAMES:
+            female_count += 1
+        elif token in MALE_NAMES:
+            male_count += 1
+    return female_count, male_count
+
 def detect_gender_from_conversations(user_id):
-    """Detectar género basado en nombres mencionados en conversaciones"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # Buscar mensajes que podrían contener nombres
-    cursor.execute('''
-        SELECT message FROM conversations 
-        WHERE user_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT 20
-    ''', (user_id,))
-    
-    messages = cursor.fetchall()
-    conn.close()
-    
-    # Base de datos de nombres femeninos comunes en Bolivia
-    female_names = [
-        'maria', 'ana', 'rosa', 'carmen', 'elena', 'patricia', 'laura', 'sofia', 'daniela',
-        'andrea', 'veronica', 'monica', 'gabriela', 'alejandra', 'claudia', 'silvia',
-        'martha', 'gloria', 'teresa', 'beatriz', 'lucia', 'cristina', 'diana', 'rocio',
-        'paola', 'carla', 'sandra', 'janet', 'yolanda', 'norma', 'lidia', 'susana',
-        'marcela', 'karen', 'fernanda', 'vanessa', 'jessica', 'leslie', 'nicole',
-        'valeria', 'natalia', 'carolina', 'adriana', 'karina', 'viviana', 'lorena'
-    ]
-    
-    # Base de datos de nombres masculinos comunes en Bolivia
-    male_names = [
-        'juan', 'carlos', 'luis', 'jose', 'antonio', 'francisco', 'miguel', 'pedro',
-        'jorge', 'roberto', 'ricardo', 'fernando', 'daniel', 'david', 'mario',
-        'sergio', 'alejandro', 'manuel', 'raul', 'eduardo', 'pablo', 'oscar',
-        'rafael', 'marco', 'hugo', 'ivan', 'cesar', 'gabriel', 'javier', 'martin',
-        'diego', 'andres', 'cristian', 'walter', 'erick', 'ronald', 'fabian',
-        'adrian', 'orlando', 'nelson', 'wilson', 'freddy', 'ramiro', 'aldo'
-    ]
-    
-    # Analizar mensajes buscando nombres
-    all_text = ' '.join([msg[0].lower() for msg in messages])
-    
-    # Contar nombres femeninos y masculinos encontrados
-    female_count = sum(1 for name in female_names if name in all_text)
-    male_count = sum(1 for name in male_names if name in all_text)
-    
-    # Decidir género basado en nombres encontrados
-    if female_count > male_count:
-        return 'female'
-    elif male_count > female_count:
-        return 'male'
-    else:
-        return 'neutral'  # No se pudo determinar
+    """Detectar género basado en nombres mencionados en las últimas conversaciones
+
+    El conteo se mantiene en la sesión en memoria y se actualiza con cada mensaje
+    nuevo, así que aquí no se vuelve a escanear el historial.
+    """
+    return get_conversation_window(user_id).gender()
 
 def get_gendered_greeting(user_id):
     """Obtener saludo con género correcto"""
@@ -692,39 +1794,161 @@ def calculate_realistic_typing_time(message_text):
     
     return round(final_time, 1)
 
-def send_message_with_typing(platform, recipient_id, message_text):
-    """Enviar mensaje con indicador de escritura realista"""
+class DeliveryScheduler:
+    """Planificador de envíos diferidos: un solo hilo mantiene todas las respuestas pendientes
+
+    Cada evento es una tupla en un heap ordenado por hora de vencimiento; al vencer,
+    la llamada HTTP se ejecuta en un pool pequeño para no bloquear el planificador.
+    """
+    
+    def __init__(self, delivery_workers):
+        self._heap = []
+        self._sequence = itertools.count()  # Desempate estable para eventos simultáneos
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=delivery_workers, thread_name_prefix='delivery')
+    
+    def schedule(self, delay, func, *args):
+        """Ejecutar func(*args) dentro de `delay` segundos sin bloquear ningún hilo"""
+        self.schedule_at(time.monotonic() + max(delay, 0), func, *args)
+    
+    def schedule_at(self, due, func, *args):
+        """Ejecutar func(*args) en el instante `due` (reloj time.monotonic())"""
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='delivery-scheduler', daemon=True)
+                self._thread.start()
+            sequence = next(self._sequence)
+            heapq.heappush(self._heap, (due, sequence, func, args))
+            # Despertar al planificador solo si el nuevo evento es el más próximo
+            if self._heap[0][1] == sequence:
+                self._condition.notify()
+    
+    def pending(self):
+        """Cantidad de eventos programados que aún no vencen"""
+        return len(self._heap)
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                wait_time = self._heap[0][0] - time.monotonic()
+                if wait_time > 0:
+                    self._condition.wait(wait_time)
+                    continue
+                due, _, func, args = heapq.heappop(self._heap)
+            DELIVERY_LAG_SECONDS.observe(time.monotonic() - due)
+            self._executor.submit(self._call, func, args)
+    
+    @staticmethod
+    def _call(func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            logging.error(f"💥 Error en envío programado {func.__name__}: {e}")
+
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 8))
+delivery_scheduler = DeliveryScheduler(DELIVERY_WORKERS)
+
+# Orden por remitente: cada respuesta sale después de la anterior al mismo destinatario
+REPLY_GAP_SECONDS = 1.0  # Separación mínima entre dos respuestas seguidas
+_last_delivery_due = {}  # (plataforma, destinatario) -> vencimiento del último texto programado
+_last_delivery_lock = threading.Lock()
+
+def reserve_delivery_slot(platform, recipient_id, initial_delay, typing_time):
+    """Instantes (escribiendo, texto) para la respuesta, nunca antes de la anterior del mismo remitente"""
+    now = time.monotonic()
+    key = (platform, recipient_id)
+    with _last_delivery_lock:
+        previous_due = _last_delivery_due.get(key)
+        typing_due = now + max(initial_delay, 0)
+        if previous_due is not None:
+            typing_due = max(typing_due, previous_due + REPLY_GAP_SECONDS)
+        text_due = typing_due + typing_time
+        _last_delivery_due[key] = text_due
+        
+        # Descartar destinatarios cuyas respuestas ya salieron
+        if len(_last_delivery_due) > 1000:
+            for stale_key in [k for k, due in _last_delivery_due.items() if due < now]:
+                del _last_delivery_due[stale_key]
+    return typing_due, text_due
+
+def deliver_facebook_message(recipient_id, message_text):
+    """Enviar el mensaje y apagar el indicador de escritura"""
+    success = send_facebook_message(recipient_id, message_text)
+    
+    # Opcional: desactivar indicador (se desactiva automáticamente al enviar mensaje)
+    send_facebook_typing_indicator(recipient_id, "typing_off")
+    
+    return success
+
+def send_message_with_typing(platform, recipient_id, message_text, initial_delay=0):
+    """Programar mensaje con indicador de escritura realista (sin dormir el hilo actual)
+
+    Muestra "escribiendo..." tras `initial_delay` segundos (o al terminar la respuesta
+    anterior al mismo destinatario) y envía el texto después del tiempo de escritura.
+    Devuelve True si el envío quedó programado.
+    """
     typing_time = calculate_realistic_typing_time(message_text)
+    ARTIFICIAL_DELAY_SECONDS.labels('response').observe(initial_delay)
+    ARTIFICIAL_DELAY_SECONDS.labels('typing').observe(typing_time)
     
     if platform == 'facebook':
-        # Mostrar "escribiendo..."
-        send_facebook_typing_indicator(recipient_id, "typing_on")
-        
-        # Esperar tiempo realista
-        time.sleep(typing_time)
-        
-        # Enviar mensaje
-        success = send_facebook_message(recipient_id, message_text)
-        
-        # Opcional: desactivar indicador (se desactiva automáticamente al enviar mensaje)
-        send_facebook_typing_indicator(recipient_id, "typing_off")
-        
-        return success
+        typing_due, text_due = reserve_delivery_slot(platform, recipient_id, initial_delay, typing_time)
+        delivery_scheduler.schedule_at(typing_due, send_facebook_typing_indicator, recipient_id, "typing_on")
+        delivery_scheduler.schedule_at(text_due, deliver_facebook_message, recipient_id, message_text)
+        return True
         
     elif platform == 'whatsapp':
-        # Mostrar "escribiendo..."
-        send_whatsapp_typing_indicator(recipient_id, "typing")
-        
-        # Esperar tiempo realista
-        time.sleep(typing_time)
-        
-        # Enviar mensaje
-        success = send_whatsapp_response(recipient_id, message_text)
-        
-        return success
+        typing_due, text_due = reserve_delivery_slot(platform, recipient_id, initial_delay, typing_time)
+        delivery_scheduler.schedule_at(typing_due, send_whatsapp_typing_indicator, recipient_id, "typing")
+        delivery_scheduler.schedule_at(text_due, send_whatsapp_response, recipient_id, message_text)
+        return True
     
     return False
 
+def compile_discount_tiers(bulk_discounts):
+    """Compilar el JSON de descuentos escalonados en (umbrales ordenados, mejor descuento acumulado)
+
+    get_product_catalog() lo hace una vez por producto al cargar y lo guarda en 'discount_tiers'.
+    """
+    try:
+        raw_tiers = json.loads(bulk_discounts or '{}').items()
+    except (TypeError, ValueError, AttributeError):
+        return (), ()
+    
+    tiers = []
+    for quantity, discount in raw_tiers:
+        try:
+            discount = float(discount)
+            # Los porcentajes enteros quedan int para mostrar "15%" y no "15.0%"
+            tiers.append((int(quantity), int(discount) if discount.is_integer() else discount))
+        except (TypeError, ValueError):
+            # Escalón guardado antes de la validación de product_params (p. ej. {"3": "mucho"}): se ignora
+            continue
+    tiers.sort()
+    
+    thresholds = []
+    best_discounts = []
+    best = 0
+    for quantity, discount in tiers:
+        best = max(best, discount)
+        thresholds.append(quantity)
+        best_discounts.append(best)
+    return tuple(thresholds), tuple(best_discounts)
+
+def lookup_discount_tier(discount_tiers, quantity):
+    """Descuento más alto entre los escalones compilados con umbral <= cantidad (0 si ninguno aplica)"""
+    thresholds, best_discounts = discount_tiers
+    position = bisect.bisect_right(thresholds, quantity)
+    return best_discounts[position - 1] if position else 0
+
+def calculate_totals_batch(items):
+    """Calcular descuento y total para muchos pares (cantidad, precio unitario, producto) de una vez"""
+    return [calculate_discount_and_total(quantity, unit_price, product_info)
+            for quantity, unit_price, product_info in items]
+
 def calculate_discount_and_total(quantity, unit_price, product_info=None):
     """Calcular descuento y total basado en cantidad y configuración del producto"""
     
@@ -751,21 +1975,12 @@ def calculate_discount_and_total(quantity, unit_price, product_info=None):
             'has_discount': False
         }
     
-    # Obtener descuentos escalonados desde la base de datos
-    try:
-        import json
-        bulk_discounts = json.loads(product_info.get('bulk_discounts', '{}'))
-    except:
-        bulk_discounts = {}
-    
-    # Determinar el descuento aplicable
-    discount_percent = 0
-    
-    # Buscar el descuento más alto aplicable para la cantidad
-    for qty_str, discount in bulk_discounts.items():
-        qty_threshold = int(qty_str)
-        if quantity >= qty_threshold:
-            discount_percent = max(discount_percent, discount)
+    # Descuento más alto aplicable según los escalones precompilados del producto
+    discount_tiers = product_info.get('discount_tiers')
+    if discount_tiers is None:
+        # Producto que no viene del catálogo en memoria
+        discount_tiers = compile_discount_tiers(product_info.get('bulk_discounts', '{}'))
+    discount_percent = lookup_discount_tier(discount_tiers, quantity)
     
     # Si no hay descuentos escalonados, usar el descuento base
     if discount_percent == 0:
@@ -784,29 +1999,37 @@ def calculate_discount_and_total(quantity, unit_price, product_info=None):
         'has_discount': discount_amount > 0
     }
 
-def get_bot_response(user_id, message):
-    """Generar respuesta del bot basada en el mensaje del usuario"""
+@STAGE_SECONDS.labels('response_build').time()
+def get_bot_response(user_id, message, apply_delay=True, quote=None):
+    """Generar respuesta del bot basada en el mensaje del usuario
+
+    Con apply_delay=False el llamador se encarga del retraso (ver send_message_with_typing).
+    Si se pasa `quote` (dict), se llena con la cantidad y el total cotizados para
+    guardarlos con save_conversation().
+    """
     
     # Aplicar retraso a partir del 3er mensaje del bot
-    apply_response_delay(user_id)
+    if apply_delay:
+        apply_response_delay(user_id)
     
     message_lower = message.lower().strip()
     
-    # Obtener conversaciones previas del usuario
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT message, bot_response FROM conversations 
-        WHERE user_id = ? ORDER BY timestamp DESC LIMIT 5
-    ''', (user_id,))
-    previous_conversations = cursor.fetchall()
-    conn.close()
-    
-    # Detectar número de teléfono
-    phone = detect_phone_number(message)
+    # Estado de la sesión del usuario (mantenido en user_sessions al guardar cada mensaje)
+    with STAGE_SECONDS.labels('history').time():
+        session = get_user_session(user_id)
+        last_product = get_last_product(user_id, session)
+    
+    # Teléfono, intenciones (una sola pasada, ver INTENT_KEYWORDS) y cantidad
+    with STAGE_SECONDS.labels('detection').time():
+        phone = detect_phone_number(message)
+        intents = classify_intents(message_lower)
+        quantity_in_negotiation = detect_quantity(message)
+    
     if phone:
-        # Guardar como lead
+        # Guardar como lead con los productos de las conversaciones previas
         products_mentioned = []
+        with STAGE_SECONDS.labels('history').time():
+            previous_conversations = get_recent_conversations(user_id, 5)
         for conv_msg, _ in previous_conversations:
             product_key, _ = detect_product(conv_msg)
             if product_key and product_key not in products_mentioned:
@@ -816,31 +2039,15 @@ def get_bot_response(user_id, message):
         return "Perfecto! Para coordinar entrega, escribeme por WhatsApp: wa.me/59178056048 📱", phone
     
     # Analizar contexto conversacional
-    last_bot_response = previous_conversations[0][1] if previous_conversations else ""
-    
-    # Detectar negociación/descuento (con cantidad específica)
-    negotiation_keywords = [
-        'nada menos', 'descuento', 'rebaja', 'barato', 'más barato', 'mas barato',
-        'promocion', 'promoción', 'oferta', 'menos precio', 'precio mejor',
-        'más económico', 'mas economico', 'algo menos', 'no hay descuento'
-    ]
+    last_bot_response = session['last_bot_response']
     
-    # Detectar si menciona cantidad en la negociación (ej: "nada menos? quiero 4")
-    quantity_in_negotiation = detect_quantity(message)
-    
-    if any(keyword in message_lower for keyword in negotiation_keywords):
-        # Buscar el último producto mencionado
-        last_product = None
-        for conv_msg, _ in previous_conversations:
-            product_key, product_info = detect_product(conv_msg)
-            if product_key:
-                last_product = product_info
-                break
-        
+    # Detectar negociación/descuento, con la cantidad si la menciona (ej: "nada menos? quiero 4")
+    if 'negotiation' in intents:
         if last_product:
             # Si mencionó cantidad específica en la negociación
             if quantity_in_negotiation:
                 calc = calculate_discount_and_total(quantity_in_negotiation, last_product['price'], last_product)
+                record_quote(quote, quantity_in_negotiation, calc['total'])
                 gendered_greeting = get_gendered_greeting(user_id)
                 if calc['has_discount']:
                     return f"Nada menos {gendered_greeting}, pero si lleva {quantity_in_negotiation} le hago {calc['discount_percent']}% descuento = {calc['total']}bs con envío gratis hasta el cuarto anillo", None
@@ -849,6 +2056,7 @@ def get_bot_response(user_id, message):
             else:
                 # Ofrecer la mejor opción (3 unidades con 5% descuento)
                 calc = calculate_discount_and_total(3, last_product['price'], last_product)
+                record_quote(quote, 3, calc['total'])
                 gendered_greeting = get_gendered_greeting(user_id)
                 return f"Nada menos {gendered_greeting}, pero si lleva 3 le hago {calc['discount_percent']}% descuento = {calc['total']}bs", None
         else:
@@ -856,23 +2064,19 @@ def get_bot_response(user_id, message):
             return f"Nada menos {gendered_greeting}, los descuentos se aplican a partir de 3 unidades:\n• 3 unidades: 10% descuento\n• 4-5 unidades: 12% descuento\n• 6+ unidades: 15% descuento", None
     
     # Detectar preguntas sobre delivery/entrega
-    delivery_keywords = ['entrega', 'delivery', 'domicilio', 'entregan', 'envio', 'envío', 'traen']
-    if any(keyword in message_lower for keyword in delivery_keywords):
+    if 'delivery' in intents:
         return "si, pero la entrega no incluye el precio, usted tendria que pagar por el delivery, o caso contrario podria recogerlo del almacen", None
     
     # Detectar confirmación sobre recojo
-    pickup_keywords = ['recoger', 'pasar a recoger', 'puedo pasar', 'voy a recoger', 'recojo']
-    if any(keyword in message_lower for keyword in pickup_keywords):
+    if 'pickup' in intents:
         return "ok, mandeme su numero para que le mande ubicacion", None
     
     # Detectar solicitud de teléfono del vendedor
-    phone_request_keywords = ['su telefono', 'tu telefono', 'mandeme su telefono', 'dame tu numero']
-    if any(keyword in message_lower for keyword in phone_request_keywords):
+    if 'phone_request' in intents:
         return "mejor mandeme asi yo puedo mandarle el mensajito, y coordinamos por whatsap", None
     
     # Detectar confirmación después de precio (pero solo si no menciona cantidad)
-    confirmation_keywords = ['ok', 'está bien', 'esta bien', 'bueno', 'dale', 'sale', 'si me parece', 'me parece bien']
-    if any(keyword in message_lower for keyword in confirmation_keywords):
+    if 'confirmation' in intents:
         # Verificar contexto de la conversación anterior
         if 'descuento' in last_bot_response or 'bs' in last_bot_response:
             if not detect_quantity(message):
@@ -883,40 +2087,32 @@ def get_bot_response(user_id, message):
             return "¿Cuántos quiere?", None
     
     # Detectar agradecimientos
-    thanks_keywords = ['gracias', 'graciad', 'grax', 'thank']
-    if any(keyword in message_lower for keyword in thanks_keywords):
+    if 'thanks' in intents:
         return "De nada! ¿Le interesa algún producto?", None
     
     # Detectar despedidas
-    goodbye_keywords = ['chau', 'adiós', 'adios', 'hasta luego', 'nos vemos', 'bye']
-    if any(keyword in message_lower for keyword in goodbye_keywords):
+    if 'goodbye' in intents:
         return "¡Hasta luego! Cualquier cosa me escribe", None
     
     # Detectar cantidad PRIMERO (para preguntas como "y 5 unidades en cuanto?")
     quantity = detect_quantity(message)
     if quantity:
-        # Buscar último producto mencionado para calcular precio
-        last_product = None
-        for conv_msg, _ in previous_conversations:
-            product_key, product_info = detect_product(conv_msg)
-            if product_key:
-                last_product = product_info
-                break
-        
         if last_product:
             calc = calculate_discount_and_total(quantity, last_product['price'], last_product)
             
             if quantity == 1:
                 return f"esta bien, si gusta puedo hacerle el envio o puede pasar a recogerlo", None
-            elif calc['has_discount']:
+            
+            record_quote(quote, quantity, calc['total'])
+            if calc['has_discount']:
                 # Verificar si es una consulta o compra definitiva
-                if is_quantity_inquiry(message):
+                if 'quantity_inquiry' in intents:
                     return f"{quantity} {last_product['name'].lower()} en {calc['total']}bs con descuento de {calc['discount_amount']}bs", None
                 else:
                     return f"ok si quiere {quantity} te hago un descuento de {calc['discount_amount']}bs, {quantity} {last_product['name'].lower()} en {calc['total']}bs. Deme su teléfono", None
             else:
                 # Sin descuento (2 unidades) - mencionar descuento disponible
-                if is_quantity_inquiry(message):
+                if 'quantity_inquiry' in intents:
                     return f"Ok, {quantity} {last_product['name'].lower()} en {calc['total']}bs con envío gratis hasta el cuarto anillo, se aplica descuento apartir de 3 unidades", None
                 else:
                     return f"Ok, {quantity} {last_product['name'].lower()} en {calc['total']}bs con envío gratis hasta el cuarto anillo, se aplica descuento apartir de 3 unidades. Deme su teléfono", None
@@ -924,23 +2120,15 @@ def get_bot_response(user_id, message):
             return "Ok. Deme su teléfono para coordinar", None
     
     # Detectar pregunta de precio (ahora va después de cantidad)
-    price_keywords = [
-        'precio', 'cuesta', 'vale', 'cuanto', 'cuánto', 'costa', 'costo',
-        'están', 'estan', 'cuanto sale', 'cuánto sale', 'a cuanto', 'a cuánto',
-        'que precio', 'qué precio', 'cuanto vale', 'cuánto vale', 'que cuesta',
-        'qué cuesta', 'cuanto cuesta', 'cuánto cuesta'
-    ]
-    if any(keyword in message_lower for keyword in price_keywords):
+    if 'price' in intents:
         # Primero verificar si menciona un producto específico en el mismo mensaje
         product_key, product_info = detect_product(message)
         if product_key:
             return f"{product_info['price']} bs", None
         
-        # Si no, buscar el último producto mencionado en la conversación
-        for conv_msg, _ in previous_conversations:
-            product_key, product_info = detect_product(conv_msg)
-            if product_key:
-                return f"{product_info['price']} bs", None
+        # Si no, usar el último producto mencionado en la conversación
+        if last_product:
+            return f"{last_product['price']} bs", None
         
         # Si no hay producto específico, mostrar todos los precios disponibles
         products = get_active_products()
@@ -956,12 +2144,11 @@ def get_bot_response(user_id, message):
         return f"Sí, tenemos a {product_info['price']}bs", None
     
     # Saludos directos
-    if any(word in message_lower for word in ['hola', 'buenos', 'buenas', 'saludos']):
+    if 'greeting' in intents:
         return "Hola, ¿en qué te puedo ayudar?", None
     
     # Detectar interés general
-    interest_keywords = ['busco', 'necesito', 'quiero comprar', 'me interesa', 'quisiera']
-    if any(keyword in message_lower for keyword in interest_keywords):
+    if 'interest' in intents:
         products = get_active_products()
         if products:
             product_list = ", ".join([f"{info['name']} ({info['price']}bs)" for info in products.values()])
@@ -977,15 +2164,270 @@ def get_bot_response(user_id, message):
     else:
         return "Hola, estoy actualizando mi inventario. Pronto tendré productos disponibles", None
 
+# Modo de ingesta: confirmar el webhook de inmediato y procesar en segundo plano
+WEBHOOK_ASYNC = os.getenv('WEBHOOK_ASYNC', 'False').lower() == 'true'
+MESSAGE_WORKERS = int(os.getenv('MESSAGE_WORKERS', 4))
+MESSAGE_QUEUE_SIZE = int(os.getenv('MESSAGE_QUEUE_SIZE', 1000))
+
+# Pool para generar en paralelo las respuestas de distintos remitentes de un lote
+_batch_executor = ThreadPoolExecutor(max_workers=MESSAGE_WORKERS, thread_name_prefix='batch')
+
+def extract_messenger_events(data):
+    """Extraer todos los mensajes de texto de un POST de Messenger (todas las entradas)"""
+    events = []
+    for entry in data.get('entry', []):
+        for messaging_event in entry.get('messaging', []):
+            message = messaging_event.get('message')
+            if not message or 'text' not in message or message.get('is_echo'):
+                continue
+            events.append({
+                'platform': 'facebook',
+                'sender_id': messaging_event['sender']['id'],
+                'text': message['text'],
+                'message_id': message.get('mid')
+            })
+    return events
+
+def generate_event_response(event):
+    """Generar la respuesta de un evento sin guardarla (el retraso se programa al enviar)
+
+    Devuelve (respuesta, teléfono, cotización, retraso).
+    """
+    response_delay = get_response_delay(event['sender_id'])
+    quote = {}
+    bot_response, phone = get_bot_response(event['sender_id'], event['text'], apply_delay=False, quote=quote)
+    return bot_response, phone, quote, response_delay
+
+def process_message_batch(events):
+    """Procesar un lote de mensajes: respuestas en paralelo entre remitentes, orden estricto por remitente
+
+    Se avanza por rondas: la ronda k toma el k-ésimo mensaje de cada remitente, genera
+    las respuestas en paralelo, las guarda con un único INSERT por lotes y programa los
+    envíos. Así cada mensaje ve el historial de los anteriores del mismo remitente.
+    Devuelve las respuestas en el mismo orden que los eventos recibidos.
+    """
+    by_sender = OrderedDict()
+    for index, event in enumerate(events):
+        by_sender.setdefault(event['sender_id'], []).append((index, event))
+    
+    responses = [None] * len(events)
+    round_index = 0
+    while True:
+        round_items = [sender_events[round_index] for sender_events in by_sender.values()
+                       if round_index < len(sender_events)]
+        if not round_items:
+            break
+        round_events = [event for _, event in round_items]
+        
+        if len(round_events) == 1:
+            results = [generate_event_response(round_events[0])]
+        else:
+            results = list(_batch_executor.map(generate_event_response, round_events))
+        
+        save_conversations_batch([
+            (event['sender_id'], event['text'], bot_response, phone, quote)
+            for event, (bot_response, phone, quote, _) in zip(round_events, results)
+        ])
+        
+        for (index, event), (bot_response, _, _, response_delay) in zip(round_items, results):
+            MESSAGES_TOTAL.labels(event['platform']).inc()
+            send_message_with_typing(event['platform'], event['sender_id'], bot_response, initial_delay=response_delay)
+            logging.info(f"Respuesta procesada ({event['platform']}, {event['sender_id']}): {bot_response}")
+            responses[index] = bot_response
+        
+        round_index += 1
+    
+    return responses
+
+# Deduplicación: Facebook y UltraMsg reentregan el evento si el webhook tarda en responder
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', 86400))
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', 10000))
+
+class SeenMessages:
+    """Identificadores de mensajes ya recibidos: conjunto en memoria acotado por tiempo
+    y tamaño, respaldado por la tabla processed_messages para sobrevivir reinicios"""
+    
+    PURGE_EVERY = 500
+    
+    def __init__(self, ttl=DEDUP_TTL, max_size=DEDUP_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._claims = 0
+    
+    def _seen_recently(self, message_id, now):
+        """Consultar el conjunto en memoria (llamar con el lock tomado)"""
+        received_at = self._seen.get(message_id)
+        if received_at is None:
+            return False
+        if now - received_at > self.ttl:
+            del self._seen[message_id]
+            return False
+        return True
+    
+    def _remember(self, message_id, now):
+        """Agregar al conjunto en memoria descartando los más antiguos (llamar con el lock tomado)"""
+        self._seen[message_id] = now
+        self._seen.move_to_end(message_id)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+    
+    def claim(self, platform, message_id):
+        """Registrar el mensaje; True si es nuevo, False si es una reentrega"""
+        key = f"{platform}:{message_id}"
+        now = time.time()
+        with self._lock:
+            if self._seen_recently(key, now):
+                return False
+            self._remember(key, now)
+            self._claims += 1
+            purge = self._claims % self.PURGE_EVERY == 0
+        
+        conn = get_db()
+        try:
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO processed_messages (message_id, platform, received_at)
+                VALUES (?, ?, ?)
+            ''', (key, platform, now))
+            is_new = cursor.rowcount == 1
+            if not is_new:
+                # Visto antes del reinicio: solo es duplicado si sigue dentro del TTL
+                row = conn.execute(
+                    'SELECT received_at FROM processed_messages WHERE message_id = ?', (key,)
+                ).fetchone()
+                if row is not None and now - row[0] > self.ttl:
+                    conn.execute('UPDATE processed_messages SET received_at = ? WHERE message_id = ?', (now, key))
+                    is_new = True
+            if purge:
+                conn.execute('DELETE FROM processed_messages WHERE received_at < ?', (now - self.ttl,))
+            conn.commit()
+        except sqlite3.Error as e:
+            # Sin la tabla seguimos con el conjunto en memoria antes que perder mensajes
+            conn.rollback()
+            logging.error(f"❌ Error registrando mensaje procesado {key}: {e}")
+            is_new = True
+        return is_new
+    
+    def release(self, platform, message_id):
+        """Olvidar un mensaje cuyo procesamiento falló, para que la reentrega se procese"""
+        key = f"{platform}:{message_id}"
+        with self._lock:
+            self._seen.pop(key, None)
+        
+        conn = get_db()
+        try:
+            conn.execute('DELETE FROM processed_messages WHERE message_id = ?', (key,))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logging.error(f"❌ Error liberando mensaje {key}: {e}")
+    
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+seen_messages = SeenMessages()
+
+def filter_new_events(events):
+    """Descartar eventos ya recibidos (según su message_id) antes de cualquier trabajo"""
+    new_events = []
+    for event in events:
+        message_id = event.get('message_id')
+        if message_id and not seen_messages.claim(event['platform'], message_id):
+            DUPLICATE_MESSAGES_TOTAL.labels(event['platform']).inc()
+            logging.info(f"🔁 Mensaje duplicado ignorado ({event['platform']}): {message_id}")
+            continue
+        new_events.append(event)
+    return new_events
+
+class MessageLane:
+    """Carril de procesamiento: una cola y un único hilo, de modo que los mensajes
+    de un mismo remitente se procesan estrictamente en orden de llegada"""
+    
+    def __init__(self, index, maxsize):
+        self.index = index
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self.run, name=f"message-lane-{index}", daemon=True)
+        self.thread.start()
+    
+    def submit(self, events):
+        """Encolar un lote y devolver el Future con sus respuestas"""
+        future = Future()
+        if self.queue.full():
+            # Esperar en lugar de procesar en línea: saltarse la cola rompería el orden
+            logging.warning(f"⚠️ Carril {self.index} lleno ({self.queue.maxsize}), esperando espacio")
+        self.queue.put((events, future))
+        return future
+    
+    def run(self):
+        """Consumir lotes de la cola y procesarlos uno tras otro"""
+        while True:
+            events, future = self.queue.get()
+            try:
+                future.set_result(process_message_batch(events))
+            except Exception as e:
+                logging.error(f"❌ Error procesando lote en el carril {self.index} ({len(events)} mensajes): {e}")
+                import traceback
+                logging.error(f"❌ Traceback: {traceback.format_exc()}")
+                conn = getattr(_db_local, 'conn', None)
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+                # Preferimos que el reintento de la plataforma repita alguna respuesta a perder el mensaje
+                for event in events:
+                    if event.get('message_id'):
+                        seen_messages.release(event['platform'], event['message_id'])
+                future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+_message_lanes = []
+_message_lanes_lock = threading.Lock()
+
+def start_message_workers():
+    """Arrancar los carriles de procesamiento (una sola vez)"""
+    with _message_lanes_lock:
+        while len(_message_lanes) < MESSAGE_WORKERS:
+            _message_lanes.append(MessageLane(len(_message_lanes), MESSAGE_QUEUE_SIZE))
+    return _message_lanes
+
+def lane_for_sender(sender_id):
+    """Índice de carril para un remitente (estable entre procesos: crc32, no hash())"""
+    return zlib.crc32(str(sender_id).encode('utf-8')) % MESSAGE_WORKERS
+
+def handle_incoming_events(events):
+    """Repartir el lote por carriles según el remitente y procesarlo
+
+    En modo asíncrono devuelve None de inmediato; si no, espera a los carriles y
+    devuelve las respuestas del bot en el orden de los eventos.
+    """
+    lanes = _message_lanes or start_message_workers()
+    
+    by_lane = OrderedDict()
+    for index, event in enumerate(events):
+        by_lane.setdefault(lane_for_sender(event['sender_id']), []).append((index, event))
+    
+    submitted = []
+    for lane_index, items in by_lane.items():
+        future = lanes[lane_index].submit([event for _, event in items])
+        submitted.append((items, future))
+    
+    if WEBHOOK_ASYNC:
+        return None
+    
+    responses = [None] * len(events)
+    for items, future in submitted:
+        for (index, _), bot_response in zip(items, future.result()):
+            responses[index] = bot_response
+    return responses
+
 @app.route('/webhook', methods=['GET', 'POST'])
 def webhook():
     """Webhook para Facebook Messenger"""
     
     if request.method == 'GET':
         # Verificación del webhook
-        verify_token = os.getenv('VERIFY_TOKEN', 'mi_token_secreto')
-        
-        if request.args.get('hub.verify_token') == verify_token:
+        if request.args.get('hub.verify_token') == VERIFY_TOKEN:
             logging.info("Webhook verificado correctamente")
             return request.args.get('hub.challenge')
         else:
@@ -994,33 +2436,25 @@ def webhook():
     
     elif request.method == 'POST':
         # Procesar mensaje entrante
-        data = request.get_json()
+        with STAGE_SECONDS.labels('webhook_parse').time():
+            data = request.get_json(silent=True)
+            # Facebook agrupa varios eventos en un mismo POST: procesarlos todos
+            events = extract_messenger_events(data) if isinstance(data, dict) else None
         logging.info(f"Mensaje recibido: {data}")
         
-        if 'entry' in data:
-            for entry in data['entry']:
-                if 'messaging' in entry:
-                    for messaging_event in entry['messaging']:
-                        if 'message' in messaging_event:
-                            sender_id = messaging_event['sender']['id']
-                            
-                            if 'text' in messaging_event['message']:
-                                message_text = messaging_event['message']['text']
-                                
-                                # Generar respuesta
-                                bot_response, phone = get_bot_response(sender_id, message_text)
-                                
-                                # Guardar conversación
-                                save_conversation(sender_id, message_text, bot_response, phone)
-                                
-                                # Enviar respuesta a Facebook con indicador de escritura
-                                send_message_with_typing('facebook', sender_id, bot_response)
-                                
-                                logging.info(f"Respuesta procesada: {bot_response}")
-                                
-                                return jsonify({'status': 'success', 'response': bot_response})
+        if events is None:
+            return jsonify({'status': 'error', 'error': 'payload inválido'}), 400
         
-        return jsonify({'status': 'success'})
+        events = filter_new_events(events)
+        if not events:
+            return jsonify({'status': 'success'})
+        
+        responses = handle_incoming_events(events)
+        
+        if responses is None:
+            return jsonify({'status': 'queued', 'events': len(events)})
+        
+        return jsonify({'status': 'success', 'response': responses[0], 'responses': responses})
 
 @app.route('/whatsapp_webhook', methods=['GET', 'POST'])
 def whatsapp_webhook():
@@ -1032,9 +2466,13 @@ def whatsapp_webhook():
     
     elif request.method == 'POST':
         # Procesar mensaje entrante de WhatsApp
-        data = request.get_json()
+        with STAGE_SECONDS.labels('webhook_parse').time():
+            data = request.get_json(silent=True)
         logging.info(f"📱 Mensaje WhatsApp recibido: {data}")
         
+        if not isinstance(data, dict):
+            return jsonify({'status': 'error', 'error': 'payload inválido'}), 400
+        
         try:
             # Extraer información del mensaje de UltraMsg
             if 'data' in data and 'body' in data['data']:
@@ -1048,14 +2486,21 @@ def whatsapp_webhook():
                 
                 logging.info(f"📱 WhatsApp - De: {sender_phone}, Mensaje: {message_text}")
                 
-                # Generar respuesta usando la misma lógica
-                bot_response, phone = get_bot_response(sender_phone, message_text)
+                events = filter_new_events([{
+                    'platform': 'whatsapp',
+                    'sender_id': sender_phone,
+                    'text': message_text,
+                    'message_id': message_data.get('id')
+                }])
+                if not events:
+                    return jsonify({'status': 'duplicate'})
+                
+                responses = handle_incoming_events(events)
                 
-                # Guardar conversación
-                save_conversation(sender_phone, message_text, bot_response, phone)
+                if responses is None:
+                    return jsonify({'status': 'queued'})
                 
-                # Enviar respuesta a WhatsApp con indicador de escritura
-                send_message_with_typing('whatsapp', sender_phone, bot_response)
+                bot_response = responses[0]
                 
                 logging.info(f"📱 WhatsApp respuesta enviada: {bot_response}")
                 
@@ -1139,50 +2584,355 @@ def test():
         user_id = data.get('user_id', 'test_user')
         
         # Simular tiempo de escritura realista en el test local
-        bot_response, phone = get_bot_response(user_id, message)
+        quote = {}
+        bot_response, phone = get_bot_response(user_id, message, quote=quote)
         typing_time = calculate_realistic_typing_time(bot_response)
         
         # Agregar un pequeño delay para simular escritura
         time.sleep(min(typing_time * 0.3, 2.0))  # Reducido para mejor UX en test
         
-        save_conversation(user_id, message, bot_response, phone)
+        save_conversation(user_id, message, bot_response, phone, quote)
         
         return jsonify({'response': bot_response, 'typing_time': typing_time})
 
+# Archivo de conversaciones antiguas en bases SQLite mensuales (solo lectura para las consultas)
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', 500))
+ARCHIVE_CHUNK_PAUSE = 0.05  # Respiro entre lotes para que los webhooks tomen el lock de escritura
+ARCHIVE_FILE_PATTERN = re.compile(r'^conversations_(\d{4})_(\d{2})\.db$')
+
+def archive_path(month):
+    """Ruta del archivo mensual para un mes 'YYYY-MM'"""
+    return os.path.join(ARCHIVE_DIR, f"conversations_{month.replace('-', '_')}.db")
+
+def list_archive_months():
+    """Meses archivados ('YYYY-MM'), del más reciente al más antiguo"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    months = []
+    for filename in os.listdir(ARCHIVE_DIR):
+        match = ARCHIVE_FILE_PATTERN.match(filename)
+        if match:
+            months.append(f"{match.group(1)}-{match.group(2)}")
+    return sorted(months, reverse=True)
+
+def open_archive(month):
+    """Abrir un archivo mensual en solo lectura"""
+    path = os.path.abspath(archive_path(month))
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, factory=connection_factory())
+
+def open_archive_for_write(month):
+    """Abrir (o crear) un archivo mensual para moverle conversaciones"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    conn = sqlite3.connect(archive_path(month), timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                           factory=connection_factory())
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            message BLOB NOT NULL,
+            bot_response BLOB NOT NULL,
+            timestamp DATETIME,
+            lead_captured BOOLEAN,
+            phone_number TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_user_timestamp ON conversations(user_id, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations(timestamp)')
+    return conn
+
+def compress_text(text):
+    return zlib.compress(text.encode('utf-8'))
+
+def decompress_text(data):
+    return zlib.decompress(data).decode('utf-8')
+
+def archive_conversations(older_than_days=ARCHIVE_AFTER_DAYS, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """Mover las conversaciones más antiguas que `older_than_days` a los archivos mensuales
+
+    Trabaja en lotes pequeños: cada lote se escribe y confirma primero en el archivo
+    (INSERT OR IGNORE, así un reintento tras un fallo no duplica) y después se borra
+    de la base viva en una transacción corta. Devuelve el número de filas movidas.
+    """
+    conn = get_db()
+    moved = 0
+    cutoff = conn.execute("SELECT DATETIME('now', ?)", (f'-{int(older_than_days)} days',)).fetchone()[0]
+    
+    while True:
+        rows = conn.execute('''
+            SELECT id, user_id, message, bot_response, timestamp, lead_captured, phone_number
+            FROM conversations WHERE timestamp < ?
+            ORDER BY timestamp, id LIMIT ?
+        ''', (cutoff, chunk_size)).fetchall()
+        if not rows:
+            break
+        
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row[4][:7], []).append(row)
+        
+        for month, month_rows in by_month.items():
+            archive = open_archive_for_write(month)
+            try:
+                with archive:
+                    archive.executemany('''
+                        INSERT OR IGNORE INTO conversations
+                            (id, user_id, message, bot_response, timestamp, lead_captured, phone_number)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', [(row_id, user_id, compress_text(message), compress_text(bot_response),
+                           timestamp, lead_captured, phone_number)
+                          for row_id, user_id, message, bot_response, timestamp, lead_captured, phone_number
+                          in month_rows])
+            finally:
+                archive.close()
+        
+        placeholders = ','.join('?' * len(rows))
+        try:
+            conn.execute(f'DELETE FROM conversations WHERE id IN ({placeholders})', [row[0] for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        moved += len(rows)
+        logging.info(f"📦 Archivadas {len(rows)} conversaciones (total {moved})")
+        time.sleep(ARCHIVE_CHUNK_PAUSE)
+    
+    return moved
+
+def iter_all_conversations(up_to_id=None):
+    """Recorrer (user_id, mensaje, respuesta, timestamp) de archivos y base viva, en orden de id
+
+    Con `up_to_id` la base viva se recorre solo hasta ese id.
+    """
+    seen_max_id = 0
+    for month in reversed(list_archive_months()):
+        archive = open_archive(month)
+        try:
+            for row_id, user_id, message, bot_response, timestamp in archive.execute(
+                    'SELECT id, user_id, message, bot_response, timestamp FROM conversations ORDER BY id'):
+                seen_max_id = max(seen_max_id, row_id)
+                yield user_id, decompress_text(message), decompress_text(bot_response), timestamp
+        finally:
+            archive.close()
+    
+    # Filas copiadas a un archivo pero aún no borradas (lote interrumpido): no contarlas dos veces
+    pending_ids = []
+    if seen_max_id:
+        pending_ids = [row[0] for row in get_db().execute(
+            'SELECT id FROM conversations WHERE id <= ?', (seen_max_id,))]
+    archived_ids = set()
+    for month in list_archive_months() if pending_ids else []:
+        archive = open_archive(month)
+        try:
+            for start in range(0, len(pending_ids), 500):
+                chunk = pending_ids[start:start + 500]
+                archived_ids.update(row[0] for row in archive.execute(
+                    f"SELECT id FROM conversations WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+        finally:
+            archive.close()
+    
+    if up_to_id is None:
+        live_rows = get_db().execute(
+            'SELECT id, user_id, message, bot_response, timestamp FROM conversations ORDER BY id')
+    else:
+        live_rows = get_db().execute(
+            'SELECT id, user_id, message, bot_response, timestamp FROM conversations WHERE id <= ? ORDER BY id',
+            (up_to_id,))
+    for row_id, user_id, message, bot_response, timestamp in live_rows:
+        if row_id not in archived_ids:
+            yield user_id, message, bot_response, timestamp
+
+# Paginación por cursor (keyset) sobre (timestamp, id) para los listados de administración
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 50))
+ADMIN_MAX_PAGE_SIZE = 500
+
+def encode_cursor(timestamp, row_id):
+    """Cursor opaco con la posición (timestamp, id) de la última fila de la página"""
+    return base64.urlsafe_b64encode(json.dumps([timestamp, row_id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Recuperar (timestamp, id) de un cursor; ValueError si no es válido"""
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('cursor inválido')
+    if not isinstance(timestamp, str) or not isinstance(row_id, int):
+        raise ValueError('cursor inválido')
+    return timestamp, row_id
+
+def parse_date_filter(value, name):
+    """Validar una fecha YYYY-MM-DD de los filtros; None si no se envió"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f'{name} debe tener formato YYYY-MM-DD')
+
+def fetch_page(table, columns, limit, cursor=None, filters=(), date_from=None, date_to=None, conn=None):
+    """Página de filas más recientes primero, con el cursor de la siguiente página
+
+    Usa la comparación de row values (timestamp, id) < (?, ?) para continuar desde el
+    cursor sin OFFSET, de modo que cada página cuesta lo mismo sin importar su posición.
+    """
+    conditions = []
+    params = []
+    for column, value in filters:
+        conditions.append(f'{column} = ?')
+        params.append(value)
+    if date_from:
+        conditions.append('timestamp >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append("timestamp < DATE(?, '+1 day')")
+        params.append(date_to)
+    if cursor:
+        conditions.append(PAGE_CURSOR_CONDITION)
+        params.extend(decode_cursor(cursor))
+    
+    rows = (conn or get_db()).execute(build_page_sql(table, columns, conditions),
+                                      params + [limit + 1]).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+    
+    items = [dict(zip(['id', 'timestamp'] + list(columns), row)) for row in rows]
+    return items, next_cursor
+
+def fetch_leads_page(limit=ADMIN_PAGE_SIZE, cursor=None, status=None, date_from=None, date_to=None):
+    """Página de leads, opcionalmente filtrada por estado y rango de fechas"""
+    filters = [('status', status)] if status else []
+    return fetch_page('leads', LEADS_PAGE_COLUMNS, limit, cursor, filters, date_from, date_to)
+
+def fetch_conversations_page(limit=ADMIN_PAGE_SIZE, cursor=None, user_id=None, date_from=None, date_to=None,
+                             include_archive=False):
+    """Página de conversaciones, opcionalmente filtrada por usuario y rango de fechas
+
+    Con include_archive también recorre los archivos mensuales (del más reciente al
+    más antiguo) y mezcla los resultados con el mismo orden y cursor.
+    """
+    filters = [('user_id', user_id)] if user_id else []
+    items, next_cursor = fetch_page('conversations', CONVERSATIONS_PAGE_COLUMNS,
+                                    limit, cursor, filters, date_from, date_to)
+    if not include_archive:
+        return items, next_cursor
+    
+    # Los meses son rangos disjuntos: se detiene en cuanto la página ya no puede cambiar
+    cursor_month = decode_cursor(cursor)[0][:7] if cursor else None
+    more = next_cursor is not None
+    merged = {item['id']: item for item in items}
+    for month in list_archive_months():
+        if (cursor_month and month > cursor_month) or (date_to and month > date_to[:7]):
+            continue
+        if date_from and month < date_from[:7]:
+            break
+        ordered = sorted(merged.values(), key=lambda item: (item['timestamp'], item['id']), reverse=True)
+        if len(ordered) >= limit and ordered[limit - 1]['timestamp'][:7] > month:
+            more = True
+            break
+        
+        archive = open_archive(month)
+        try:
+            archived, archive_cursor = fetch_page('conversations', CONVERSATIONS_PAGE_COLUMNS,
+                                                  limit, cursor, filters, date_from, date_to, conn=archive)
+        finally:
+            archive.close()
+        more = more or archive_cursor is not None
+        for item in archived:
+            item['message'] = decompress_text(item['message'])
+            item['bot_response'] = decompress_text(item['bot_response'])
+            item['archived'] = True
+            merged.setdefault(item['id'], item)
+    
+    ordered = sorted(merged.values(), key=lambda item: (item['timestamp'], item['id']), reverse=True)
+    if len(ordered) > limit:
+        ordered = ordered[:limit]
+        more = True
+    next_cursor = encode_cursor(ordered[-1]['timestamp'], ordered[-1]['id']) if more and ordered else None
+    return ordered, next_cursor
+
+
+def page_arguments(args):
+    """Leer limit, cursor y rango de fechas de la query string; ValueError si son inválidos"""
+    try:
+        limit = int(args.get('limit', ADMIN_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit debe ser un número entero')
+    if not 1 <= limit <= ADMIN_MAX_PAGE_SIZE:
+        raise ValueError(f'limit debe estar entre 1 y {ADMIN_MAX_PAGE_SIZE}')
+    
+    cursor = args.get('cursor') or None
+    if cursor:
+        decode_cursor(cursor)
+    
+    return {
+        'limit': limit,
+        'cursor': cursor,
+        'date_from': parse_date_filter(args.get('from'), 'from'),
+        'date_to': parse_date_filter(args.get('to'), 'to')
+    }
+
+@app.route('/api/admin/leads')
+def api_admin_leads():
+    """API paginada de leads: ?limit=&cursor=&status=&from=YYYY-MM-DD&to=YYYY-MM-DD"""
+    try:
+        page_args = page_arguments(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 400
+    
+    items, next_cursor = fetch_leads_page(status=request.args.get('status') or None, **page_args)
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/api/admin/conversations')
+def api_admin_conversations():
+    """API paginada de conversaciones: ?limit=&cursor=&user_id=&from=&to=&include_archive=1"""
+    try:
+        page_args = page_arguments(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 400
+    
+    include_archive = request.args.get('include_archive', '').lower() in ('1', 'true')
+    items, next_cursor = fetch_conversations_page(user_id=request.args.get('user_id') or None,
+                                                  include_archive=include_archive, **page_args)
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
 @app.route('/admin')
 def admin():
     """Panel de administración simple"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Obtener estadísticas
-    cursor.execute('SELECT COUNT(*) FROM conversations')
-    total_conversations = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM leads')
-    total_leads = cursor.fetchone()[0]
+    # Obtener estadísticas (agregados mantenidos al escribir)
+    totals = get_stats_totals()
+    total_conversations = totals['conversations']
+    total_leads = totals['leads']
+    unique_users = totals['unique_users']
     
-    cursor.execute('SELECT COUNT(DISTINCT user_id) FROM conversations')
-    unique_users = cursor.fetchone()[0]
-    
-    # Últimas conversaciones
-    cursor.execute('''
-        SELECT user_id, message, bot_response, timestamp 
-        FROM conversations 
-        ORDER BY timestamp DESC 
-        LIMIT 10
-    ''')
-    recent_conversations = cursor.fetchall()
+    # Listados paginados por cursor (?leads_cursor= / ?conversations_cursor=, &include_archive=1)
+    include_archive = request.args.get('include_archive', '').lower() in ('1', 'true')
+    try:
+        leads, next_leads_cursor = fetch_leads_page(cursor=request.args.get('leads_cursor') or None)
+        recent_conversations, next_conversations_cursor = fetch_conversations_page(
+            limit=10, cursor=request.args.get('conversations_cursor') or None, include_archive=include_archive)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 400
     
-    # Leads capturados
+    # Notificaciones al dueño que agotaron sus reintentos (dead letter)
     cursor.execute('''
-        SELECT user_id, phone_number, products_interested, timestamp 
-        FROM leads 
-        ORDER BY timestamp DESC
+        SELECT id, user_id, phone_number, attempts, last_error, updated_at
+        FROM notification_outbox 
+        WHERE status = 'dead'
+        ORDER BY id DESC 
+        LIMIT 50
     ''')
-    leads = cursor.fetchall()
+    dead_notifications = cursor.fetchall()
     
-    conn.close()
+    cursor.execute("SELECT COUNT(*) FROM notification_outbox WHERE status = 'pending'")
+    pending_notifications = cursor.fetchone()[0]
     
     return render_template_string('''
     <!DOCTYPE html>
@@ -1233,10 +2983,37 @@ def admin():
                 </tr>
                 {% for lead in leads %}
                 <tr>
-                    <td>{{ lead[0] }}</td>
-                    <td>{{ lead[1] }}</td>
-                    <td>{{ lead[2] }}</td>
-                    <td>{{ lead[3] }}</td>
+                    <td>{{ lead.user_id }}</td>
+                    <td>{{ lead.phone_number }}</td>
+                    <td>{{ lead.products_interested }}</td>
+                    <td>{{ lead.timestamp }}</td>
+                </tr>
+                {% endfor %}
+            </table>
+            {% if next_leads_cursor %}
+            <a href="?leads_cursor={{ next_leads_cursor }}">Siguiente página de leads →</a>
+            {% endif %}
+        </div>
+        
+        <div class="section">
+            <h2>Notificaciones Fallidas ({{ pending_notifications }} pendientes de reintento)</h2>
+            <table>
+                <tr>
+                    <th>ID</th>
+                    <th>Usuario ID</th>
+                    <th>Teléfono</th>
+                    <th>Intentos</th>
+                    <th>Último Error</th>
+                    <th>Fecha</th>
+                </tr>
+                {% for notification in dead_notifications %}
+                <tr>
+                    <td>{{ notification[0] }}</td>
+                    <td>{{ notification[1] }}</td>
+                    <td>{{ notification[2] }}</td>
+                    <td>{{ notification[3] }}</td>
+                    <td>{{ notification[4] }}</td>
+                    <td>{{ notification[5] }}</td>
                 </tr>
                 {% endfor %}
             </table>
@@ -1253,13 +3030,18 @@ def admin():
                 </tr>
                 {% for conv in recent_conversations %}
                 <tr>
-                    <td>{{ conv[0] }}</td>
-                    <td>{{ conv[1] }}</td>
-                    <td>{{ conv[2] }}</td>
-                    <td>{{ conv[3] }}</td>
+                    <td>{{ conv.user_id }}</td>
+                    <td>{{ conv.message }}</td>
+                    <td>{{ conv.bot_response }}</td>
+                    <td>{{ conv.timestamp }}</td>
                 </tr>
                 {% endfor %}
             </table>
+            {% if next_conversations_cursor %}
+            <a href="?conversations_cursor={{ next_conversations_cursor }}{% if include_archive %}&include_archive=1{% endif %}">Conversaciones anteriores →</a>
+            {% elif not include_archive %}
+            <a href="?include_archive=1">Ver también el historial archivado →</a>
+            {% endif %}
         </div>
     </body>
     </html>
@@ -1268,43 +3050,39 @@ def admin():
     total_leads=total_leads, 
     unique_users=unique_users,
     leads=leads,
-    recent_conversations=recent_conversations
+    next_leads_cursor=next_leads_cursor,
+    recent_conversations=recent_conversations,
+    next_conversations_cursor=next_conversations_cursor,
+    include_archive=include_archive,
+    dead_notifications=dead_notifications,
+    pending_notifications=pending_notifications
     )
 
 @app.route('/analytics')
 def analytics():
     """Endpoint de analytics simple"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Productos más consultados
-    cursor.execute('''
-        SELECT bot_response, COUNT(*) as count 
-        FROM conversations 
-        WHERE bot_response LIKE '%bs%'
-        GROUP BY bot_response
-        ORDER BY count DESC
-    ''')
+    # Productos más cotizados
+    cursor.execute(STATS_PRODUCT_QUOTES_SQL)
     price_queries = cursor.fetchall()
     
     # Conversaciones por día
-    cursor.execute('''
-        SELECT DATE(timestamp) as date, COUNT(*) as count 
-        FROM conversations 
-        GROUP BY DATE(timestamp)
-        ORDER BY date DESC
-        LIMIT 7
-    ''')
+    cursor.execute(STATS_DAILY_SQL)
     daily_stats = cursor.fetchall()
     
-    conn.close()
-    
     return jsonify({
         'price_queries': price_queries,
         'daily_conversations': daily_stats,
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/metrics')
+def metrics():
+    """Métricas del proceso en formato de texto de Prometheus"""
+    return Response(METRICS_REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route('/test_response', methods=['POST'])
 def test_response():
     """Endpoint para probar respuestas del bot"""
@@ -1314,8 +3092,9 @@ def test_response():
     
     # Guardar conversación y obtener respuesta
     save_conversation(user_id, message, '')
-    response, phone = get_bot_response(user_id, message)
-    save_conversation(user_id, message, response)
+    quote = {}
+    response, phone = get_bot_response(user_id, message, quote=quote)
+    save_conversation(user_id, message, response, quote=quote)
     
     return jsonify({
         'user_id': user_id,
@@ -1406,15 +3185,16 @@ def test_whatsapp():
         phone = data.get('phone', 'test_phone')
         
         # Simular proceso de WhatsApp
-        bot_response, detected_phone = get_bot_response(phone, message)
-        save_conversation(phone, message, bot_response, detected_phone)
+        quote = {}
+        bot_response, detected_phone = get_bot_response(phone, message, quote=quote)
+        save_conversation(phone, message, bot_response, detected_phone, quote)
         
         return jsonify({'response': bot_response, 'phone': detected_phone})
 
 @app.route('/products')
 def products():
     """Panel de gestión de productos"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -1426,8 +3206,6 @@ def products():
     ''')
     all_products = cursor.fetchall()
     
-    conn.close()
-    
     return render_template_string('''
     <!DOCTYPE html>
     <html>
@@ -1795,6 +3573,212 @@ def products():
     </html>
     ''', products=all_products)
 
+# Columnas editables de products, en el orden de product_params()
+PRODUCT_FIELDS = [
+    'name', 'key_name', 'price', 'stock', 'keywords', 'description', 'active',
+    'discount_enabled', 'discount_name', 'discount_min_quantity',
+    'discount_percentage', 'discount_description', 'bulk_discounts'
+]
+
+PRODUCT_IMPORT_BATCH_SIZE = int(os.getenv('PRODUCT_IMPORT_BATCH_SIZE', 1000))
+PRODUCT_IMPORT_MAX_ERRORS = 1000  # Errores detallados en la respuesta (el total siempre se informa)
+
+def parse_flag(value, default=False):
+    """Interpretar un booleano de JSON o CSV (1/0, true/false, si/no)"""
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'si', 'sí', 'yes'):
+        return True
+    if text in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f'valor booleano inválido: {value}')
+
+def product_params(data):
+    """Validar un producto (JSON o fila CSV) y devolver los valores en el orden de PRODUCT_FIELDS
+
+    Lanza ValueError con un mensaje legible si algún campo no es válido.
+    """
+    def required_text(field):
+        value = str(data.get(field) or '').strip()
+        if not value:
+            raise ValueError(f'{field} es obligatorio')
+        return value
+    
+    def number(field, cast, default=None):
+        value = data.get(field)
+        if value is None or value == '':
+            if default is None:
+                raise ValueError(f'{field} es obligatorio')
+            return default
+        try:
+            result = cast(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{field} debe ser numérico: {value}')
+        if result < 0:
+            raise ValueError(f'{field} no puede ser negativo')
+        return result
+    
+    bulk_discounts = data.get('bulk_discounts') or '{}'
+    try:
+        tiers = json.loads(bulk_discounts) if isinstance(bulk_discounts, str) else bulk_discounts
+        if not isinstance(tiers, dict):
+            raise ValueError
+        for quantity, percentage in tiers.items():
+            # Cantidades enteras y porcentajes numéricos: "10" o true romperían el cálculo del descuento
+            if not str(quantity).isdigit():
+                raise ValueError
+            if isinstance(percentage, bool) or not isinstance(percentage, (int, float)):
+                raise ValueError
+            if not 0 <= percentage <= 100:
+                raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError(f'bulk_discounts debe ser un objeto JSON {{cantidad: porcentaje}}: {bulk_discounts}')
+    
+    return (
+        required_text('name'),
+        required_text('key_name'),
+        number('price', float),
+        number('stock', int),
+        required_text('keywords'),
+        data.get('description') or '',
+        parse_flag(data.get('active'), default=True),
+        parse_flag(data.get('discount_enabled')),
+        data.get('discount_name') or '',
+        number('discount_min_quantity', int, default=3),
+        number('discount_percentage', float, default=0),
+        data.get('discount_description') or '',
+        # Se guarda el texto tal cual para no convertir 10 en 10.0 en los mensajes
+        bulk_discounts if isinstance(bulk_discounts, str) else json.dumps(tiers)
+    )
+
+def upsert_products(cursor, rows):
+    """Insertar o actualizar (por key_name) una lista de tuplas de product_params()"""
+    cursor.executemany('''
+        INSERT INTO products (name, key_name, price, stock, keywords, description, active,
+                              discount_enabled, discount_name, discount_min_quantity,
+                              discount_percentage, discount_description, bulk_discounts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(key_name) DO UPDATE SET
+            name = excluded.name, price = excluded.price, stock = excluded.stock,
+            keywords = excluded.keywords, description = excluded.description, active = excluded.active,
+            discount_enabled = excluded.discount_enabled, discount_name = excluded.discount_name,
+            discount_min_quantity = excluded.discount_min_quantity,
+            discount_percentage = excluded.discount_percentage,
+            discount_description = excluded.discount_description,
+            bulk_discounts = excluded.bulk_discounts,
+            updated_at = CURRENT_TIMESTAMP
+    ''', rows)
+
+def iter_import_rows(stream, file_format):
+    """Leer filas (número, dict) de un flujo CSV o JSONL sin cargarlo entero en memoria"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            # Número de línea en el archivo (la cabecera es la línea 1), como en una hoja de cálculo
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f'JSON inválido: {e}')
+                continue
+            yield line_number, row if isinstance(row, dict) else ValueError('cada línea debe ser un objeto JSON')
+
+def import_products(stream, file_format, batch_size=PRODUCT_IMPORT_BATCH_SIZE):
+    """Importar productos en transacciones de `batch_size` filas; devuelve el resumen con errores por fila"""
+    conn = get_db()
+    cursor = conn.cursor()
+    summary = {'processed': 0, 'imported': 0, 'failed': 0, 'errors': []}
+    
+    def record_error(row_number, key_name, message):
+        summary['failed'] += 1
+        if len(summary['errors']) < PRODUCT_IMPORT_MAX_ERRORS:
+            summary['errors'].append({'row': row_number, 'key_name': key_name, 'error': message})
+    
+    def flush(batch):
+        try:
+            upsert_products(cursor, [params for _, params in batch])
+            conn.commit()
+            summary['imported'] += len(batch)
+        except sqlite3.Error:
+            # Reintentar fila por fila para aislar la que falla
+            conn.rollback()
+            for row_number, params in batch:
+                try:
+                    upsert_products(cursor, [params])
+                    conn.commit()
+                    summary['imported'] += 1
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    record_error(row_number, params[1], str(e))
+    
+    batch = []
+    try:
+        for row_number, row in iter_import_rows(stream, file_format):
+            summary['processed'] += 1
+            if isinstance(row, Exception):
+                record_error(row_number, None, str(row))
+                continue
+            try:
+                batch.append((row_number, product_params(row)))
+            except ValueError as e:
+                record_error(row_number, row.get('key_name'), str(e))
+                continue
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    finally:
+        # Una sola invalidación del catálogo por importación
+        if summary['imported']:
+            invalidate_product_cache()
+    
+    logging.info(f"Importación de productos: {summary['imported']} importados, {summary['failed']} con error")
+    return summary
+
+def export_products(file_format):
+    """Generar el catálogo completo en CSV o JSONL, por bloques"""
+    cursor = get_db().cursor()
+    cursor.execute(f"SELECT {', '.join(PRODUCT_FIELDS)} FROM products ORDER BY id")
+    
+    if file_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(PRODUCT_FIELDS)
+    
+    while True:
+        rows = cursor.fetchmany(500)
+        if not rows:
+            break
+        if file_format == 'csv':
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            yield ''.join(json.dumps(dict(zip(PRODUCT_FIELDS, row)), ensure_ascii=False) + '\n' for row in rows)
+    
+    if file_format == 'csv' and buffer.tell():
+        yield buffer.getvalue()
+
+def request_file_format(default='jsonl'):
+    """Formato pedido: ?format=csv|jsonl, o deducido de la extensión del archivo subido"""
+    file_format = request.args.get('format')
+    if not file_format and 'file' in request.files:
+        file_format = request.files['file'].filename.rsplit('.', 1)[-1]
+    file_format = (file_format or default).lower()
+    if file_format not in ('csv', 'jsonl'):
+        raise ValueError('formato no soportado (usar csv o jsonl)')
+    return file_format
+
 @app.route('/api/products', methods=['GET', 'POST'])
 def api_products():
     """API para gestionar productos"""
@@ -1804,7 +3788,12 @@ def api_products():
     
     elif request.method == 'POST':
         data = request.get_json()
-        conn = sqlite3.connect(DATABASE)
+        try:
+            params = product_params(data or {})
+        except ValueError as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
+        
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -1812,24 +3801,10 @@ def api_products():
                                 discount_enabled, discount_name, discount_min_quantity, 
                                 discount_percentage, discount_description, bulk_discounts)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data['name'], 
-            data['key_name'], 
-            float(data['price']), 
-            int(data['stock']),
-            data['keywords'], 
-            data.get('description', ''),
-            bool(int(data.get('active', 1))),
-            bool(data.get('discount_enabled', False)),
-            data.get('discount_name', ''),
-            int(data.get('discount_min_quantity', 3)),
-            float(data.get('discount_percentage', 0)),
-            data.get('discount_description', ''),
-            data.get('bulk_discounts', '{}')
-        ))
+        ''', params)
         
         conn.commit()
-        conn.close()
+        invalidate_product_cache()
         
         logging.info(f"Producto agregado: {data['name']}")
         return jsonify({'status': 'success'})
@@ -1837,11 +3812,16 @@ def api_products():
 @app.route('/api/products/<int:product_id>', methods=['PUT', 'DELETE'])
 def api_product_detail(product_id):
     """API para editar/eliminar producto específico"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
     if request.method == 'PUT':
         data = request.get_json()
+        try:
+            params = product_params(data or {})
+        except ValueError as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
+        
         cursor.execute('''
             UPDATE products 
             SET name=?, key_name=?, price=?, stock=?, keywords=?, description=?, active=?, 
@@ -1849,25 +3829,10 @@ def api_product_detail(product_id):
                 discount_percentage=?, discount_description=?, bulk_discounts=?, 
                 updated_at=CURRENT_TIMESTAMP
             WHERE id=?
-        ''', (
-            data['name'], 
-            data['key_name'], 
-            float(data['price']), 
-            int(data['stock']),
-            data['keywords'], 
-            data.get('description', ''),
-            bool(int(data.get('active', 1))),
-            bool(data.get('discount_enabled', False)),
-            data.get('discount_name', ''),
-            int(data.get('discount_min_quantity', 3)),
-            float(data.get('discount_percentage', 0)),
-            data.get('discount_description', ''),
-            data.get('bulk_discounts', '{}'),
-            product_id
-        ))
+        ''', params + (product_id,))
         
         conn.commit()
-        conn.close()
+        invalidate_product_cache()
         
         logging.info(f"Producto actualizado: ID {product_id}")
         return jsonify({'status': 'updated'})
@@ -1875,11 +3840,38 @@ def api_product_detail(product_id):
     elif request.method == 'DELETE':
         cursor.execute('DELETE FROM products WHERE id=?', (product_id,))
         conn.commit()
-        conn.close()
+        invalidate_product_cache()
         
         logging.info(f"Producto eliminado: ID {product_id}")
         return jsonify({'status': 'deleted'})
 
+@app.route('/api/products/import', methods=['POST'])
+def api_products_import():
+    """Importación masiva de productos: CSV o JSONL (cuerpo o campo 'file'), upsert por key_name"""
+    try:
+        file_format = request_file_format()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 400
+    
+    stream = request.files['file'].stream if 'file' in request.files else request.stream
+    summary = import_products(stream, file_format)
+    return jsonify({'status': 'success' if not summary['failed'] else 'partial', **summary})
+
+@app.route('/api/products/export')
+def api_products_export():
+    """Exportación del catálogo completo en CSV o JSONL (?format=), por streaming"""
+    try:
+        file_format = request_file_format(default='csv')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 400
+    
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    return Response(
+        stream_with_context(export_products(file_format)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=productos.{file_format}'}
+    )
+
 if __name__ == '__main__':
     # Inicializar base de datos
     init_db()
@@ -1888,5 +3880,10 @@ if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     debug = os.getenv('DEBUG', 'True').lower() == 'true'
     
+    # Entregar notificaciones pendientes de ejecuciones anteriores
+    # (con el recargador de debug, solo en el proceso que atiende peticiones)
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_notification_dispatcher()
+    
     logging.info(f"🚀 Iniciando bot en puerto {port} - v1.1")
     app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script para archivar conversaciones antiguas en bases SQLite mensuales
+
+Uso: python archive_conversations.py [dias]
+
+Mueve las conversaciones con más de `dias` (por defecto ARCHIVE_AFTER_DAYS) a
+ARCHIVE_DIR/conversations_YYYY_MM.db, con los textos comprimidos. Se puede
+ejecutar con el bot en marcha: trabaja en lotes pequeños y cortos.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else app.ARCHIVE_AFTER_DAYS
+    
+    app.init_db()
+    moved = app.archive_conversations(older_than_days=days)
+    
+    print(f"=== ARCHIVO DE CONVERSACIONES ({days} días) ===")
+    print(f"Conversaciones movidas: {moved}")
+    for month in app.list_archive_months():
+        print(f"  - {app.archive_path(month)}")
+
+if __name__ == "__main__":
+    main()
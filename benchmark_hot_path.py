@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmarks del camino caliente de un mensaje
+
+Uso: python benchmark_hot_path.py [--catalogs 3,1000,50000] [--histories 10,10000,1000000,10000000]
+                                  [--max-rows N] [--iterations N] [--output bench_results.json]
+
+Mide detect_product, detect_phone_number, detect_quantity,
+calculate_discount_and_total, detect_gender_from_conversations (con la ventana
+en caché y en frío) y un turno completo de get_bot_response (sin retrasos de
+respuesta) para cada combinación de tamaño de catálogo e historial.
+
+Cada catálogo usa una base temporal propia. El historial crece por tramos, así
+cada fila se inserta una sola vez. Los historiales que superan --max-rows se
+omiten (por defecto 1.000.000; 10M filas ocupan varios GB y tardan minutos en
+generarse). El resultado es un JSON para comparar entre commits.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import logging
+import platform
+import sqlite3
+import tempfile
+import subprocess
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+
+DEFAULT_CATALOGS = [3, 1000, 50000]
+DEFAULT_HISTORIES = [10, 10000, 1000000, 10000000]
+DEFAULT_MAX_ROWS = 1000000
+DEFAULT_ITERATIONS = 2000
+INSERT_BATCH_SIZE = 50000
+BENCH_USERS = 1000  # El historial se reparte entre estos usuarios
+
+SAMPLE_MESSAGES = [
+    'hola', 'cuanto cuesta?', 'quiero 3 {keyword}', 'tienen {keyword}?', 'precio de {keyword}',
+    'nada menos? quiero 5', 'hacen delivery?', 'ok gracias', 'me llamo maria, busco {keyword}',
+    'mi numero es 71234567', 'y 6 unidades en cuanto?', 'chau'
+]
+
+def git_commit():
+    """Commit actual, para comparar resultados entre versiones"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def product_keywords(index):
+    return [f'producto{index}', f'articulo {index}', f'item{index}x']
+
+def populate_catalog(size):
+    """Reemplazar el catálogo por `size` productos sintéticos con descuentos escalonados"""
+    conn = app.get_db()
+    conn.execute('DELETE FROM products')
+    conn.executemany('''
+        INSERT INTO products (name, key_name, price, stock, keywords, description,
+                              discount_enabled, discount_min_quantity, discount_percentage, bulk_discounts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(f'Producto {i}', f'producto_{i}', 10 + i % 90, 100, ','.join(product_keywords(i)), '',
+           i % 2 == 0, 3, 5, json.dumps({'3': 10, '5': 12 + i % 5, '10': 20}))
+          for i in range(size)])
+    conn.commit()
+    app.invalidate_product_cache()
+
+def sample_message(catalog_size, rng):
+    return rng.choice(SAMPLE_MESSAGES).format(keyword=product_keywords(rng.randrange(catalog_size))[0])
+
+def grow_history(current_rows, target_rows, catalog_size, rng):
+    """Agregar filas a conversations hasta llegar a `target_rows`"""
+    conn = app.get_db()
+    while current_rows < target_rows:
+        batch = min(INSERT_BATCH_SIZE, target_rows - current_rows)
+        conn.executemany(
+            'INSERT INTO conversations (user_id, message, bot_response) VALUES (?, ?, ?)',
+            [(f'user_{(current_rows + i) % BENCH_USERS}', sample_message(catalog_size, rng), '20 bs')
+             for i in range(batch)]
+        )
+        conn.commit()
+        current_rows += batch
+    # Sesiones coherentes con el historial nuevo y caché vacía para el siguiente tramo
+    conn.execute('DELETE FROM user_sessions')
+    app.backfill_user_sessions()
+    app.conversation_cache.clear()
+    return current_rows
+
+def measure(func, inputs, setup=None):
+    """Ejecutar func(*args) por cada entrada y devolver estadísticas en microsegundos"""
+    timings = []
+    for args in inputs:
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func(*args)
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return {
+        'iterations': len(timings),
+        'mean_us': round(sum(timings) / len(timings), 3),
+        'p50_us': round(timings[len(timings) // 2], 3),
+        'p95_us': round(timings[int(len(timings) * 0.95)], 3),
+        'max_us': round(timings[-1], 3)
+    }
+
+def run_benchmarks(catalog_size, iterations, rng):
+    """Medir cada función del camino caliente con el catálogo e historial actuales"""
+    products = list(app.get_active_products().values())
+    messages = [(sample_message(catalog_size, rng),) for _ in range(iterations)]
+    quotes = [(rng.randint(1, 20), product['price'], product)
+              for product in (rng.choice(products) for _ in range(iterations))]
+    # Pocos usuarios para que la variante en caché encuentre siempre la ventana cargada
+    gender_users = [(f'user_{rng.randrange(min(BENCH_USERS, 20))}',) for _ in range(iterations)]
+    for (user_id,) in set(gender_users):
+        app.get_conversation_window(user_id)
+    # Turnos sin teléfono: un lead escribiría en leads y en el outbox en cada iteración
+    turns = [(f'user_{rng.randrange(BENCH_USERS)}', message, False)
+             for (message,) in messages if not app.detect_phone_number(message)]
+
+    def drop_gender_window():
+        app.conversation_cache.clear()
+
+    return {
+        'detect_product': measure(app.detect_product, messages),
+        'detect_phone_number': measure(app.detect_phone_number, messages),
+        'detect_quantity': measure(app.detect_quantity, messages),
+        'calculate_discount_and_total': measure(app.calculate_discount_and_total, quotes),
+        'detect_gender_from_conversations': measure(app.detect_gender_from_conversations, gender_users),
+        'detect_gender_from_conversations_cold': measure(app.detect_gender_from_conversations, gender_users,
+                                                         setup=drop_gender_window),
+        'get_bot_response': measure(app.get_bot_response, turns)
+    }
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+def main():
+    args = sys.argv[1:]
+    options = {'--catalogs': None, '--histories': None, '--max-rows': None,
+               '--iterations': None, '--output': None}
+    while args:
+        name = args.pop(0)
+        if name not in options or not args:
+            print(__doc__)
+            sys.exit(1)
+        options[name] = args.pop(0)
+
+    catalogs = parse_sizes(options['--catalogs']) if options['--catalogs'] else DEFAULT_CATALOGS
+    histories = sorted(parse_sizes(options['--histories']) if options['--histories'] else DEFAULT_HISTORIES)
+    max_rows = int(options['--max-rows'] or DEFAULT_MAX_ROWS)
+    iterations = int(options['--iterations'] or DEFAULT_ITERATIONS)
+    output = options['--output'] or 'bench_results.json'
+
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(42)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'iterations': iterations
+        },
+        'skipped': [],
+        'results': []
+    }
+
+    original_database = app.DATABASE
+    with tempfile.TemporaryDirectory() as tmp:
+        for catalog_size in catalogs:
+            app.DATABASE = os.path.join(tmp, f'bench_{catalog_size}.db')
+            app.init_db()
+            populate_catalog(catalog_size)
+            rows = 0
+
+            for history_size in histories:
+                if history_size > max_rows:
+                    report['skipped'].append({'catalog': catalog_size, 'history': history_size,
+                                              'reason': f'supera --max-rows {max_rows}'})
+                    continue
+
+                rows = grow_history(rows, history_size, catalog_size, rng)
+                print(f"Catálogo {catalog_size}, historial {history_size}...", flush=True)
+                for name, stats in run_benchmarks(catalog_size, iterations, rng).items():
+                    report['results'].append({'benchmark': name, 'catalog': catalog_size,
+                                              'history': history_size, **stats})
+
+            app.close_db()
+    app.DATABASE = original_database
+
+    with open(output, 'w', encoding='utf-8') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print(f"\n{'benchmark':40} {'catálogo':>9} {'historial':>10} {'media µs':>10} {'p95 µs':>10}")
+    for result in report['results']:
+        print(f"{result['benchmark']:40} {result['catalog']:>9} {result['history']:>10} "
+              f"{result['mean_us']:>10.1f} {result['p95_us']:>10.1f}")
+    print(f"\nResultados guardados en {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cliente HTTP compartido para las llamadas salientes (Graph API, UltraMsg, CallMeBot)
+
+Mantiene una Session con conexiones keep-alive por host, de modo que enviar
+"escribiendo...", el mensaje y "typing_off" reutiliza la misma conexión TLS.
+"""
+
+import os
+import time
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import HTTP_CLIENT_SECONDS
+
+# Tiempos de espera por defecto: (conexión, lectura) en segundos
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 10))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+
+def build_retry(retries):
+    """Reintentos seguros: errores de conexión siempre, lectura/estado solo en métodos idempotentes"""
+    return Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+        raise_on_status=False
+    )
+
+class HttpClient:
+    """Sesiones HTTP reutilizables, una por host"""
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=HTTP_RETRIES, pool_size=HTTP_POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session_for(self, url):
+        """Session compartida para el host de la URL (se crea la primera vez)"""
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=self.pool_size,
+                        max_retries=build_retry(self.retries)
+                    )
+                    session.mount(host, adapter)
+                    self._sessions[host] = session
+        return session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """Hacer la petición con la sesión del host y timeout por defecto (mide la duración)"""
+        status = 'error'
+        start = time.perf_counter()
+        try:
+            response = self.session_for(url).request(method, url, timeout=timeout or self.timeout, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            HTTP_CLIENT_SECONDS.labels(urlsplit(url).netloc, method, status).observe(time.perf_counter() - start)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+# Cliente único para todo el proceso
+http_client = HttpClient()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Métricas en memoria con exposición en formato de texto de Prometheus (/metrics)
+
+Contadores, gauges e histogramas con etiquetas, seguros entre hilos y sin
+dependencias externas. Cada proceso expone sus propias métricas.
+"""
+
+import abc
+import time
+import threading
+import functools
+
+# Buckets de latencia en segundos: de 1 ms a 30 s (cubre los retrasos artificiales)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric(abc.ABC):
+    """Base común: nombre, ayuda, etiquetas y una serie por combinación de valores"""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    @abc.abstractmethod
+    def _new_series(self):
+        """Serie vacía para una nueva combinación de etiquetas"""
+
+    def labels(self, *values, **kwargs):
+        """Serie para una combinación de etiquetas (se crea la primera vez)"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name}: se esperaban las etiquetas {self.labelnames}')
+        key = tuple(str(value) for value in values)
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(key, self._new_series())
+        return series
+
+    def _default(self):
+        return self.labels()
+
+    @abc.abstractmethod
+    def samples(self):
+        """Líneas de exposición de todas las series"""
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+class _CounterSeries:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+class Counter(Metric):
+    """Contador monótono (total de eventos)"""
+
+    type_name = 'counter'
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def samples(self):
+        for key, series in sorted(self._series.items()):
+            yield f'{self.name}{format_labels(self.labelnames, key)} {format_value(series.value)}'
+
+class _GaugeSeries(_CounterSeries):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+class Gauge(Metric):
+    """Valor que sube y baja; con `function` se calcula al leer /metrics"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, function=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = function
+
+    def _new_series(self):
+        return _GaugeSeries()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+    def samples(self):
+        if self.function is not None:
+            yield f'{self.name} {format_value(self.function())}'
+            return
+        for key, series in sorted(self._series.items()):
+            yield f'{self.name}{format_labels(self.labelnames, key)} {format_value(series.value)}'
+
+class _Timer:
+    """Cronómetro usable como context manager o decorador"""
+
+    def __init__(self, series):
+        self._series = series
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._series.observe(time.perf_counter() - self._start)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(self._series):
+                return func(*args, **kwargs)
+        return wrapper
+
+class _HistogramSeries:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    def time(self):
+        return _Timer(self)
+
+class Histogram(Metric):
+    """Distribución de valores (latencias) en buckets acumulativos"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def samples(self):
+        for key, series in sorted(self._series.items()):
+            with series._lock:
+                counts, total, count = list(series.counts), series.sum, series.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames, key, [('le', format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {format_value(total)}'
+            yield f'{self.name}_count{labels} {count}'
+
+class Registry:
+    """Conjunto de métricas que se exponen juntas"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f'Métrica duplicada: {metric.name}')
+            self._metrics.append(metric)
+
+    def render(self):
+        """Texto para /metrics (formato de exposición 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Llamadas HTTP salientes (Graph API, UltraMsg, CallMeBot), instrumentadas en http_client
+HTTP_CLIENT_SECONDS = Histogram(
+    'bot_http_client_request_seconds', 'Duración de las llamadas HTTP salientes',
+    ['host', 'method', 'status']
+)
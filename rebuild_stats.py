@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script para recalcular los agregados de /analytics y /admin desde el historial
+
+Los agregados se mantienen al guardar cada conversación y lead; este script
+solo hace falta tras importar datos a mano o si se sospecha que se desfasaron.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+
+def main():
+    app.init_db()
+    app.rebuild_stats()
+    
+    totals = app.get_stats_totals()
+    print("=== AGREGADOS RECALCULADOS ===")
+    print(f"Conversaciones: {totals['conversations']}")
+    print(f"Leads: {totals['leads']}")
+    print(f"Usuarios únicos: {totals['unique_users']}")
+    
+    for product_key, quotes in app.get_db().execute(
+            'SELECT product_key, quotes FROM stats_product_quotes ORDER BY quotes DESC'):
+        print(f"  - {product_key}: {quotes} cotizaciones")
+
+if __name__ == "__main__":
+    main()
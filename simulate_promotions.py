@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Simulador de promociones: ingresos proyectados de distintos descuentos escalonados
+
+Uso: python simulate_promotions.py [configuraciones.json] [--top N]
+Requiere NumPy: pip install -r requirements-tools.txt
+
+Extrae del historial de conversaciones (base viva y archivos mensuales) cada
+pedido (producto, cantidad) con detect_product/detect_quantity y evalúa sobre
+esa demanda muchas configuraciones de bulk_discounts a la vez con NumPy.
+
+La demanda extraída se guarda en promotion_demand.npz y en cada ejecución solo
+se procesan las conversaciones nuevas. Si cambian las palabras clave del catálogo
+se vuelve a extraer todo.
+
+El archivo de configuraciones es una lista JSON de objetos:
+    {"name": "agresiva", "products": ["tappers"], "min_quantity": 3,
+     "discount_percentage": 10, "bulk_discounts": {"3": 12, "5": 18}}
+"products" es opcional (por defecto todos); los demás productos mantienen su
+configuración actual. Sin archivo se evalúa una grilla de escalones estándar.
+"""
+
+import sys
+import os
+import json
+import hashlib
+import itertools
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+import app
+
+DEMAND_CACHE = 'promotion_demand.npz'
+MAX_QUANTITY = 1000      # Cantidades mayores casi siempre son teléfonos u otros números
+READ_BATCH_SIZE = 5000
+CONFIG_CHUNK_SIZE = 256  # Configuraciones evaluadas por bloque (acota la memoria)
+
+def load_catalog():
+    """Todos los productos (activos o no) con precio y configuración de descuentos actual"""
+    rows = app.get_db().execute('''
+        SELECT key_name, price, keywords, discount_enabled, discount_min_quantity,
+               discount_percentage, bulk_discounts
+        FROM products ORDER BY key_name
+    ''').fetchall()
+    return [{
+        'key': key_name,
+        'price': price,
+        'keywords': keywords,
+        'discount_enabled': bool(discount_enabled),
+        'min_quantity': discount_min_quantity or 3,
+        'discount_percentage': discount_percentage or 0,
+        'bulk_discounts': bulk_discounts or '{}'
+    } for key_name, price, keywords, discount_enabled, discount_min_quantity, discount_percentage, bulk_discounts
+        in rows]
+
+def catalog_signature(catalog):
+    """Huella de las palabras clave: si cambia, la demanda ya extraída deja de ser válida"""
+    text = json.dumps([(product['key'], product['keywords']) for product in catalog])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def iter_sources():
+    """Conexiones a recorrer: archivos mensuales (solo lectura) y la base viva"""
+    for month in reversed(app.list_archive_months()):
+        archive = app.open_archive(month)
+        try:
+            yield archive, True
+        finally:
+            archive.close()
+    yield app.get_db(), False
+
+def extract_demand(last_id, product_index):
+    """Pedidos (producto, cantidad) de las conversaciones con id > last_id"""
+    products = []
+    quantities = []
+    max_id = last_id
+
+    for conn, compressed in iter_sources():
+        cursor = conn.execute('SELECT id, message FROM conversations WHERE id > ? ORDER BY id', (last_id,))
+        while True:
+            rows = cursor.fetchmany(READ_BATCH_SIZE)
+            if not rows:
+                break
+            for row_id, message in rows:
+                max_id = max(max_id, row_id)
+                if compressed:
+                    message = app.decompress_text(message)
+                product_key, _ = app.detect_product(message)
+                if product_key not in product_index:
+                    continue
+                quantity = app.detect_quantity(message)
+                if not quantity or quantity > MAX_QUANTITY:
+                    continue
+                products.append(product_index[product_key])
+                quantities.append(quantity)
+
+    return np.array(products, dtype=np.int32), np.array(quantities, dtype=np.int32), max_id
+
+def load_demand(catalog, cache_path=DEMAND_CACHE):
+    """Demanda histórica como arrays (índice de producto, cantidad), actualizando el caché .npz"""
+    signature = catalog_signature(catalog)
+    product_index = {product['key']: index for index, product in enumerate(catalog)}
+
+    products = np.empty(0, dtype=np.int32)
+    quantities = np.empty(0, dtype=np.int32)
+    last_id = 0
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if str(cached['signature']) == signature:
+            products, quantities, last_id = cached['products'], cached['quantities'], int(cached['last_id'])
+
+    new_products, new_quantities, max_id = extract_demand(last_id, product_index)
+    if max_id != last_id or not os.path.exists(cache_path):
+        products = np.concatenate([products, new_products])
+        quantities = np.concatenate([quantities, new_quantities])
+        np.savez(cache_path, products=products, quantities=quantities,
+                 last_id=np.int64(max_id), signature=np.str_(signature))
+
+    return products, quantities
+
+def tier_arrays(compiled_tiers, width):
+    """Escalones compilados (umbrales, mejor descuento acumulado) rellenados hasta `width`"""
+    thresholds, best_discounts = compiled_tiers
+    padded_thresholds = np.full(width, np.iinfo(np.int32).max, dtype=np.int64)
+    padded_best = np.zeros(width + 1, dtype=np.float64)
+    padded_thresholds[:len(thresholds)] = thresholds
+    padded_best[1:len(best_discounts) + 1] = best_discounts
+    return padded_thresholds, padded_best
+
+def build_config_tables(configs, catalog):
+    """Tablas (configuración x producto) con la misma semántica que calculate_discount_and_total()"""
+    product_index = {product['key']: index for index, product in enumerate(catalog)}
+
+    # Cada configuración de escalones se compila y rellena una sola vez
+    product_tiers = [app.compile_discount_tiers(product['bulk_discounts']) for product in catalog]
+    config_tiers = [app.compile_discount_tiers(json.dumps(config.get('bulk_discounts', {}))) for config in configs]
+    width = max([1] + [len(thresholds) for thresholds, _ in product_tiers + config_tiers])
+    product_tiers = [tier_arrays(tiers, width) for tiers in product_tiers]
+    config_tiers = [tier_arrays(tiers, width) for tiers in config_tiers]
+
+    shape = (len(configs), len(catalog))
+    enabled = np.zeros(shape, dtype=bool)
+    min_quantity = np.zeros(shape, dtype=np.int64)
+    base_discount = np.zeros(shape, dtype=np.float64)
+    thresholds = np.zeros(shape + (width,), dtype=np.int64)
+    best = np.zeros(shape + (width + 1,), dtype=np.float64)
+
+    for c, config in enumerate(configs):
+        targets = {product_index[key] for key in config.get('products', product_index) if key in product_index}
+        for p, product in enumerate(catalog):
+            if p in targets:
+                enabled[c, p] = True
+                # Sin min_quantity en la configuración se mantiene el mínimo del producto (3 por defecto)
+                min_quantity[c, p] = config.get('min_quantity', product['min_quantity'])
+                base_discount[c, p] = config.get('discount_percentage', 0)
+                thresholds[c, p], best[c, p] = config_tiers[c]
+            else:
+                enabled[c, p] = product['discount_enabled']
+                min_quantity[c, p] = product['min_quantity']
+                base_discount[c, p] = product['discount_percentage']
+                thresholds[c, p], best[c, p] = product_tiers[p]
+
+    return enabled, min_quantity, base_discount, thresholds, best
+
+def evaluate(configs, catalog, products, quantities, chunk_size=CONFIG_CHUNK_SIZE):
+    """Ingresos y costo de descuento por configuración, sin bucles de Python por pedido"""
+    # Millones de pedidos se reducen a pares únicos (producto, cantidad) con su frecuencia
+    pairs, counts = np.unique(np.stack([products, quantities], axis=1), axis=0, return_counts=True) \
+        if len(products) else (np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.int64))
+    pair_products = pairs[:, 0]
+    pair_quantities = pairs[:, 1].astype(np.int64)
+    prices = np.array([product['price'] for product in catalog], dtype=np.float64)
+    subtotals = pair_quantities * prices[pair_products]
+
+    revenue = np.zeros(len(configs))
+    discount_cost = np.zeros(len(configs))
+    discounted_requests = np.zeros(len(configs), dtype=np.int64)
+
+    for start in range(0, len(configs), chunk_size):
+        chunk = configs[start:start + chunk_size]
+        enabled, min_quantity, base_discount, thresholds, best = build_config_tables(chunk, catalog)
+
+        # Escalón aplicable: cuántos umbrales son <= cantidad (equivale a bisect_right)
+        pair_thresholds = thresholds[:, pair_products, :]
+        position = (pair_thresholds <= pair_quantities[None, :, None]).sum(axis=2)
+        discount = np.take_along_axis(best[:, pair_products, :], position[:, :, None], axis=2)[:, :, 0]
+        discount = np.where(discount == 0, base_discount[:, pair_products], discount)
+        applies = enabled[:, pair_products] & (pair_quantities[None, :] >= min_quantity[:, pair_products])
+        discount = np.where(applies, discount, 0)
+
+        # round() de Python y np.round redondean igual (mitades al par)
+        totals = np.round(subtotals[None, :] - subtotals[None, :] * discount / 100)
+        end = start + len(chunk)
+        revenue[start:end] = totals @ counts
+        discount_cost[start:end] = (subtotals[None, :] - totals) @ counts
+        discounted_requests[start:end] = (discount > 0).astype(np.int64) @ counts
+
+    return revenue, discount_cost, discounted_requests
+
+def default_grid():
+    """Grilla de escalones 3/5/10 con descuentos crecientes"""
+    steps = [0, 5, 10, 15, 20, 25, 30]
+    configs = []
+    for first, second, third in itertools.product(steps, repeat=3):
+        if first <= second <= third and third > 0:
+            configs.append({
+                'name': f'3:{first}% 5:{second}% 10:{third}%',
+                'min_quantity': 3,
+                'bulk_discounts': {'3': first, '5': second, '10': third}
+            })
+    return configs
+
+def main():
+    args = sys.argv[1:]
+    top = 20
+    if '--top' in args:
+        position = args.index('--top')
+        top = int(args[position + 1])
+        del args[position:position + 2]
+
+    configs = default_grid()
+    if args:
+        with open(args[0], encoding='utf-8') as config_file:
+            configs = json.load(config_file)
+
+    catalog = load_catalog()
+    products, quantities = load_demand(catalog)
+
+    # La configuración actual del catálogo es la referencia
+    configs = [{'name': 'actual', 'products': []}] + configs
+    revenue, discount_cost, discounted_requests = evaluate(configs, catalog, products, quantities)
+
+    print(f"=== SIMULACIÓN DE PROMOCIONES ({len(products)} pedidos históricos, {len(configs) - 1} configuraciones) ===")
+    print(f"Actual: ingresos {revenue[0]:.0f}bs, descuentos {discount_cost[0]:.0f}bs\n")
+
+    order = np.argsort(-revenue[1:])[:top] + 1
+    for index in order:
+        delta = revenue[index] - revenue[0]
+        print(f"- {configs[index].get('name', index)}: ingresos {revenue[index]:.0f}bs ({delta:+.0f}bs), "
+              f"descuentos {discount_cost[index]:.0f}bs, pedidos con descuento {discounted_requests[index]}")
+
+if __name__ == "__main__":
+    main()
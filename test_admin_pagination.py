@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de la paginación por cursor de los listados de administración
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def admin_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'admin.db'))
+    app.init_db()
+    conn = app.get_db()
+    # Tres conversaciones por segundo: el id desempata los timestamps iguales
+    conn.executemany(
+        'INSERT INTO conversations (user_id, message, bot_response, timestamp) VALUES (?, ?, ?, ?)',
+        [(f'u{i % 2}', f'mensaje {i}', 'ok', f'2024-01-{1 + i // 3:02d} 10:00:00') for i in range(9)]
+    )
+    conn.executemany(
+        'INSERT INTO leads (user_id, phone_number, products_interested, timestamp, status) VALUES (?, ?, ?, ?, ?)',
+        [(f'u{i}', f'7000000{i}', 'vasos', f'2024-02-0{1 + i}', 'new' if i % 2 else 'contacted') for i in range(5)]
+    )
+    conn.commit()
+
+def all_pages(fetch, **kwargs):
+    """Recorrer todas las páginas siguiendo next_cursor"""
+    pages = []
+    cursor = None
+    while True:
+        items, cursor = fetch(cursor=cursor, **kwargs)
+        pages.append(items)
+        if cursor is None:
+            return pages
+
+def test_pages_cover_every_row_once(admin_db):
+    """Las filas con el mismo timestamp no se pierden ni se repiten entre páginas"""
+    pages = all_pages(app.fetch_conversations_page, limit=2)
+
+    assert [len(page) for page in pages] == [2, 2, 2, 2, 1]
+    messages = [item['message'] for page in pages for item in page]
+    assert messages == [f'mensaje {i}' for i in reversed(range(9))]
+
+def test_filters_are_applied_on_every_page(admin_db):
+    pages = all_pages(app.fetch_conversations_page, limit=2, user_id='u1')
+    assert {item['user_id'] for page in pages for item in page} == {'u1'}
+    assert sum(len(page) for page in pages) == 4
+
+    items, _ = app.fetch_leads_page(status='new', date_from='2024-02-02', date_to='2024-02-03')
+    assert [item['user_id'] for item in items] == ['u1']
+
+def test_api_pages_with_cursor(admin_db):
+    client = app.app.test_client()
+    first = client.get('/api/admin/leads?limit=3').get_json()
+    second = client.get(f"/api/admin/leads?limit=3&cursor={first['next_cursor']}").get_json()
+
+    assert [item['user_id'] for item in first['items']] == ['u4', 'u3', 'u2']
+    assert [item['user_id'] for item in second['items']] == ['u1', 'u0']
+    assert second['next_cursor'] is None
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=abc', 'cursor=no-es-un-cursor', 'from=01/02/2024'])
+def test_api_rejects_invalid_arguments(admin_db, query):
+    response = app.app.test_client().get(f'/api/admin/conversations?{query}')
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'error'
+
+def test_admin_links_to_next_page(admin_db):
+    """/admin muestra la primera página de conversaciones y enlaza la siguiente"""
+    for i in range(9, 12):
+        app.save_conversation('u2', f'mensaje {i}', 'ok')
+
+    html = app.app.test_client().get('/admin').get_data(as_text=True)
+    assert 'mensaje 11' in html and 'mensaje 1<' not in html
+    assert '?conversations_cursor=' in html
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
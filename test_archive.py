@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del archivo mensual de conversaciones y la paginación que lo incluye
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def archived_db(tmp_path, monkeypatch):
+    """30 conversaciones de 2020 archivadas en tres meses y una reciente en la base viva"""
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'archive.db'))
+    monkeypatch.setattr(app, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.setattr(app, 'ARCHIVE_CHUNK_PAUSE', 0)
+    app.init_db()
+
+    conn = app.get_db()
+    conn.executemany(
+        'INSERT INTO conversations (user_id, message, bot_response, timestamp) VALUES (?, ?, ?, ?)',
+        [(f'user{i % 3}', f'precio platos {i}', '20.0 bs', '2020-%02d-%02d 10:00:00' % (1 + i // 10, 1 + i % 10))
+         for i in range(30)]
+    )
+    conn.execute("INSERT INTO conversations (user_id, message, bot_response) VALUES ('nuevo', 'hola', 'hola')")
+    conn.commit()
+
+    assert app.archive_conversations(older_than_days=30, chunk_size=7) == 30
+    return conn
+
+def test_archive_and_paginate_across_months(archived_db):
+    """Las conversaciones archivadas se recorren una sola vez y en orden con include_archive"""
+    assert app.list_archive_months() == ['2020-03', '2020-02', '2020-01']
+    assert archived_db.execute('SELECT COUNT(*) FROM conversations').fetchone()[0] == 1
+
+    keys = []
+    cursor = None
+    while True:
+        items, cursor = app.fetch_conversations_page(limit=4, cursor=cursor, include_archive=True)
+        keys.extend((item['timestamp'], item['id']) for item in items)
+        if not cursor:
+            break
+
+    assert len(keys) == 31
+    assert keys == sorted(set(keys), reverse=True)
+
+    # Los agregados reconstruidos siguen contando lo archivado
+    app.rebuild_stats()
+    assert app.get_stats_totals()['conversations'] == 31
+
+def test_iter_all_conversations_stops_at_live_id(archived_db):
+    """up_to_id limita la base viva pero no los archivos"""
+    live_id = archived_db.execute('SELECT id FROM conversations').fetchone()[0]
+    archived_db.execute("INSERT INTO conversations (user_id, message, bot_response) VALUES ('otro', 'hola', 'hola')")
+    archived_db.commit()
+
+    messages = [message for _, message, _, _ in app.iter_all_conversations(up_to_id=live_id)]
+
+    assert len(messages) == 31
+    assert messages[:2] == ['precio platos 0', 'precio platos 1']
+    assert len(list(app.iter_all_conversations())) == 32
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
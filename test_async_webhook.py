@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de la ingesta asíncrona del webhook
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def async_webhook(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'async.db'))
+    monkeypatch.setattr(app, 'WEBHOOK_ASYNC', True)
+    monkeypatch.setattr(app, 'apply_response_delay', lambda user_id: None)
+    sent = []
+    monkeypatch.setattr(app, 'send_message_with_typing',
+                        lambda platform, recipient_id, text, **kwargs: sent.append((platform, recipient_id, text)))
+    app.init_db()
+    return sent
+
+def whatsapp_payload(sender, body):
+    return {'data': {'from': f'591{sender}@c.us', 'body': body}}
+
+def wait_for_lanes():
+    for lane in app._message_lanes:
+        lane.queue.join()
+
+def test_webhook_is_acknowledged_before_processing(async_webhook):
+    """El webhook responde 'queued' y un carril guarda y envía la respuesta"""
+    client = app.app.test_client()
+    response = client.post('/whatsapp_webhook', json=whatsapp_payload('70000001', 'hola'))
+    assert response.get_json()['status'] == 'queued'
+
+    wait_for_lanes()
+
+    assert [(platform, recipient) for platform, recipient, _ in async_webhook] == [('whatsapp', '70000001')]
+    row = app.get_db().execute(
+        'SELECT message, bot_response FROM conversations WHERE user_id = ?', ('70000001',)
+    ).fetchone()
+    assert row == ('hola', async_webhook[0][2])
+
+def test_sync_mode_returns_the_response(async_webhook, monkeypatch):
+    """Sin WEBHOOK_ASYNC la petición espera al carril y devuelve la respuesta"""
+    monkeypatch.setattr(app, 'WEBHOOK_ASYNC', False)
+
+    client = app.app.test_client()
+    data = client.post('/whatsapp_webhook', json=whatsapp_payload('70000002', 'hola')).get_json()
+
+    assert data['status'] == 'success'
+    assert async_webhook == [('whatsapp', '70000002', data['response'])]
+
+def test_sender_always_uses_the_same_lane():
+    """El carril depende solo del remitente (crc32, estable entre procesos)"""
+    assert app.lane_for_sender('70000001') == app.lane_for_sender('70000001')
+    assert {app.lane_for_sender(str(sender)) for sender in range(100)} == set(range(app.MESSAGE_WORKERS))
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
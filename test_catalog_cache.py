@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del caché en memoria del catálogo de productos
+"""
+
+import sys
+import os
+import sqlite3
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def catalog_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'catalog.db'))
+    app.init_db()
+
+def test_catalog_is_cached_until_products_change(catalog_db):
+    """Sin cambios se devuelve el mismo catálogo; un POST a /api/products lo recarga"""
+    products = app.get_active_products()
+    assert app.get_active_products() is products
+
+    client = app.app.test_client()
+    client.post('/api/products', json={
+        'name': 'Jarras', 'key_name': 'jarras', 'price': 30, 'stock': 5, 'keywords': 'jarra,jarras'
+    })
+    assert 'jarras' in app.get_active_products()
+
+def test_failed_catalog_load_is_retried(catalog_db, monkeypatch):
+    """Un error transitorio al cargar no deja el catálogo vacío hasta la próxima edición"""
+    products = app.get_active_products()
+    assert products
+
+    load_active_products = app.load_active_products
+
+    def fail_once():
+        monkeypatch.setattr(app, 'load_active_products', load_active_products)
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(app, 'load_active_products', fail_once)
+    app.invalidate_product_cache()
+    assert app.get_active_products() == products  # Se sigue usando el catálogo anterior
+    assert app.get_active_products() is not products  # Y la siguiente llamada sí recarga
+
+def test_writes_from_other_processes_reload_catalog(catalog_db, monkeypatch):
+    """Un cambio de precio hecho con otra conexión (setup_promotions.py) se ve sin reiniciar"""
+    monkeypatch.setattr(app, 'CATALOG_CHECK_INTERVAL', 0)
+    assert app.get_active_products()['vasos']['price'] == 12
+
+    other = sqlite3.connect(app.DATABASE)
+    other.execute("UPDATE products SET price = 15 WHERE key_name = 'vasos'")
+    other.commit()
+    other.close()
+
+    assert app.get_active_products()['vasos']['price'] == 15
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del caché de historial reciente por usuario
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+from app import ConversationCache
+
+@pytest.fixture
+def history_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'history.db'))
+    app.init_db()
+
+def test_save_updates_cached_window(history_db):
+    """Los turnos guardados se agregan a la ventana en memoria, el más reciente primero"""
+    app.save_conversation('u1', 'hola', 'Hola, ¿en qué le ayudo?')
+    assert [tuple(turn) for turn in app.get_recent_conversations('u1')] == [('hola', 'Hola, ¿en qué le ayudo?')]
+
+    app.save_conversation('u1', 'precio vasos', 'Los vasos están a 12bs')
+    turns = app.get_recent_conversations('u1', 1)
+    assert [(turn.message, turn.bot_response) for turn in turns] == [('precio vasos', 'Los vasos están a 12bs')]
+
+def test_hot_user_is_served_without_queries(history_db, monkeypatch):
+    """Un usuario en caché no vuelve a consultar la base de datos"""
+    app.save_conversation('u1', 'hola', 'Hola')
+    app.get_recent_conversations('u1')
+
+    def no_db():
+        raise AssertionError('consulta inesperada a la base de datos')
+
+    monkeypatch.setattr(app, 'get_db', no_db)
+    assert [turn.message for turn in app.get_recent_conversations('u1')] == ['hola']
+
+def test_window_is_capped(history_db):
+    """La ventana no crece más allá de HISTORY_WINDOW turnos"""
+    app.get_recent_conversations('u1')
+    for i in range(app.HISTORY_WINDOW + 5):
+        app.save_conversation('u1', f'mensaje {i}', 'ok')
+
+    turns = app.get_recent_conversations('u1')
+    assert len(turns) == app.HISTORY_WINDOW
+    assert turns[0].message == f'mensaje {app.HISTORY_WINDOW + 4}'
+
+def test_least_recently_used_user_is_evicted():
+    """Con el límite de usuarios alcanzado se descarta el menos usado"""
+    cache = ConversationCache(max_users=2, ttl_seconds=60)
+    cache.put('a', [])
+    cache.put('b', [])
+    cache.get('a')  # 'a' pasa a ser el más reciente
+    cache.put('c', [])
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+
+def test_idle_session_expires():
+    """Una sesión inactiva más de ttl_seconds se vuelve a cargar desde la base"""
+    cache = ConversationCache(max_users=10, ttl_seconds=60)
+    session = cache.put('a', [('hola', 'Hola')])
+    session.touched_at -= 61
+
+    assert cache.get('a') is None
+
+def test_append_ignores_users_not_in_cache():
+    """Guardar un turno de un usuario sin sesión no crea una ventana incompleta"""
+    cache = ConversationCache(max_users=10, ttl_seconds=60)
+    cache.append('a', 'hola', 'Hola')
+
+    assert cache.get('a') is None
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de la capa de conexión SQLite por hilo
+"""
+
+import sys
+import os
+import threading
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'conn.db'))
+    app.init_db()
+    yield
+    app.close_db()
+
+def test_connection_is_reused_within_thread(db):
+    """El mismo hilo recibe siempre la misma conexión, ya configurada"""
+    conn = app.get_db()
+    assert app.get_db() is conn
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == app.SQLITE_BUSY_TIMEOUT_MS
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+
+def test_each_thread_gets_its_own_connection(db):
+    """Los hilos de trabajo no comparten la conexión del hilo principal"""
+    other = {}
+
+    def worker():
+        other['conn'] = app.get_db()
+        other['reused'] = app.get_db() is other['conn']
+        app.close_db()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+
+    assert other['reused']
+    assert other['conn'] is not app.get_db()
+
+def test_connection_follows_database_path(db, tmp_path, monkeypatch):
+    """Cambiar DATABASE (tests, scripts) abre una conexión nueva a la otra base"""
+    conn = app.get_db()
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'other.db'))
+    assert app.get_db() is not conn
+
+def test_failed_request_does_not_leave_transaction_open(db):
+    """El teardown descarta la transacción que dejó abierta un handler con error"""
+    with pytest.raises(RuntimeError):
+        with app.app.test_request_context('/webhook'):
+            app.get_db().execute("UPDATE products SET price = 99 WHERE key_name = 'vasos'")
+            raise RuntimeError('fallo a mitad de transacción')
+
+    conn = app.get_db()
+    assert not conn.in_transaction
+    price = conn.execute("SELECT price FROM products WHERE key_name = 'vasos'").fetchone()[0]
+    assert price == 12
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de la deduplicación de webhooks reentregados
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'dedup.db'))
+    app.init_db()
+
+def messenger_payload(mid, text='hola'):
+    return {'object': 'page', 'entry': [{'messaging': [
+        {'sender': {'id': 'dedup_user'}, 'message': {'mid': mid, 'text': text}}
+    ]}]}
+
+def test_duplicates_are_rejected(fresh_db):
+    """La reentrega del mismo mid no se procesa, ni en memoria ni tras un reinicio"""
+    assert app.seen_messages.claim('facebook', 'm1') is True
+    assert app.seen_messages.claim('facebook', 'm1') is False
+    assert app.seen_messages.claim('whatsapp', 'm1') is True
+
+    app.seen_messages.clear()  # Reinicio: solo queda la tabla processed_messages
+    assert app.seen_messages.claim('facebook', 'm1') is False
+
+def test_claims_expire_after_ttl(fresh_db, monkeypatch):
+    """Pasado DEDUP_TTL el mismo id vuelve a procesarse"""
+    seen = app.SeenMessages(ttl=60, max_size=100)
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+
+    assert seen.claim('facebook', 'm2') is True
+    now[0] += 30
+    assert seen.claim('facebook', 'm2') is False
+    now[0] += 61
+    assert seen.claim('facebook', 'm2') is True
+
+    now[0] += 61
+    seen.clear()  # También expira el registro persistido
+    assert seen.claim('facebook', 'm2') is True
+
+def test_failed_processing_releases_claim(fresh_db, monkeypatch):
+    """Si el carril falla, el reintento de Facebook se procesa en lugar de descartarse"""
+    monkeypatch.setattr(app, 'WEBHOOK_ASYNC', False)
+    client = app.app.test_client()
+
+    def fail(events):
+        raise RuntimeError('fallo simulado')
+
+    with monkeypatch.context() as failing:
+        failing.setattr(app, 'process_message_batch', fail)
+        assert client.post('/webhook', json=messenger_payload('m3')).status_code == 500
+
+    response = client.post('/webhook', json=messenger_payload('m3'))
+    assert response.status_code == 200
+    assert response.get_json()['responses']
+
+    response = client.post('/webhook', json=messenger_payload('m3'))
+    assert 'responses' not in response.get_json()
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del planificador de envíos diferidos
+"""
+
+import sys
+import os
+import threading
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+from app import DeliveryScheduler
+
+def test_events_run_in_due_order():
+    """Los eventos se ejecutan por hora de vencimiento, no por orden de registro"""
+    scheduler = DeliveryScheduler(1)
+    calls = []
+    done = threading.Event()
+
+    scheduler.schedule(0.10, calls.append, 'tercero')
+    scheduler.schedule(0.05, calls.append, 'segundo')
+    scheduler.schedule(0, calls.append, 'primero')
+    scheduler.schedule(0.15, done.set)
+
+    assert done.wait(2)
+    assert calls == ['primero', 'segundo', 'tercero']
+    assert scheduler.pending() == 0
+
+def test_earlier_event_wakes_scheduler():
+    """Un evento más próximo no espera a que venza el que ya estaba programado"""
+    scheduler = DeliveryScheduler(1)
+    done = threading.Event()
+
+    scheduler.schedule(60, done.set)
+    scheduler.schedule(0.01, done.set)
+
+    assert done.wait(2)
+    assert scheduler.pending() == 1
+
+def test_failing_event_does_not_stop_scheduler():
+    """Un error en un envío se registra y los siguientes eventos siguen ejecutándose"""
+    scheduler = DeliveryScheduler(1)
+    done = threading.Event()
+
+    def fail():
+        raise RuntimeError('fallo de red')
+
+    scheduler.schedule(0, fail)
+    scheduler.schedule(0.01, done.set)
+
+    assert done.wait(2)
+
+def test_typing_and_message_are_scheduled_after_delay(monkeypatch):
+    """send_message_with_typing programa 'escribiendo...' y el texto sin dormir el hilo"""
+    scheduled = []
+
+    class RecordingScheduler:
+        def schedule_at(self, due, func, *args):
+            scheduled.append((due, func, args))
+
+    monkeypatch.setattr(app, 'delivery_scheduler', RecordingScheduler())
+    monkeypatch.setattr(app, '_last_delivery_due', {})
+
+    before = time.monotonic()
+    assert app.send_message_with_typing('whatsapp', '70000001', 'Sí, tenemos a 35bs', initial_delay=4)
+    (typing_due, typing_func, typing_args), (send_due, send_func, send_args) = scheduled
+    assert (typing_func, typing_args) == (app.send_whatsapp_typing_indicator, ('70000001', 'typing'))
+    assert (send_func, send_args) == (app.send_whatsapp_response, ('70000001', 'Sí, tenemos a 35bs'))
+    assert before + 4 <= typing_due < send_due  # El texto sale después del tiempo de escritura
+    assert not app.send_message_with_typing('telegram', '70000001', 'hola')
+
+def test_replies_to_one_sender_keep_order(tmp_path, monkeypatch):
+    """Una respuesta corta a un mensaje posterior no adelanta a la respuesta larga anterior"""
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'order.db'))
+    app.init_db()
+    scheduled = []
+    monkeypatch.setattr(app.delivery_scheduler, 'schedule_at',
+                        lambda due, func, *args: scheduled.append((due, func.__name__, args)))
+
+    app.handle_incoming_events([{'platform': 'facebook', 'sender_id': 's1', 'text': 'necesito algo', 'message_id': None}])
+    app.handle_incoming_events([{'platform': 'facebook', 'sender_id': 's1', 'text': 'ok', 'message_id': None}])
+
+    texts = [(due, args[1]) for due, name, args in scheduled if name == 'deliver_facebook_message']
+    assert len(texts) == 2
+    delivered = [text for _, text in sorted(texts)]
+    assert delivered == [text for _, text in texts]
+
+    # "escribiendo..." de la segunda respuesta empieza después del texto de la primera
+    typing = [due for due, name, _ in scheduled if name == 'send_facebook_typing_indicator']
+    assert typing[1] > texts[0][0]
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
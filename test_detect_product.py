@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de detección de productos con el autómata de palabras clave
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from app import KeywordAutomaton, detect_product, classify_intents
+
+def test_automaton_finds_overlapping_keywords():
+    """El autómata reporta todas las coincidencias, incluidas las solapadas"""
+    automaton = KeywordAutomaton([('he', 'he'), ('she', 'she'), ('hers', 'hers')])
+    matches = sorted(automaton.find_all('ushers'))
+    assert matches == [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')]
+
+def test_longest_keyword_wins(tmp_path, monkeypatch):
+    """'platos hondos' gana sobre 'platos' aunque ambos productos coincidan"""
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'test.db'))
+    app.init_db()
+
+    client = app.app.test_client()
+    client.post('/api/products', json={
+        'name': 'Plato Hondo', 'key_name': 'plato_hondo', 'price': 25, 'stock': 10,
+        'keywords': 'platos hondos'
+    })
+
+    assert detect_product('quiero 2 platos hondos')[0] == 'plato_hondo'
+    assert detect_product('quiero un plato')[0] == 'platos'
+    assert detect_product('tienen tuppers?')[0] == 'tappers'
+    assert detect_product('hola') == (None, None)
+
+def test_classify_intents_single_pass():
+    """Todas las intenciones en una pasada; las palabras cortas solo como palabra completa"""
+    assert classify_intents('hola, cuanto sale?') >= {'greeting', 'price', 'confirmation'}
+    assert 'confirmation' in classify_intents('ok gracias')
+    assert 'greeting' in classify_intents('holaaa')
+    assert 'confirmation' not in classify_intents('tok')
+    assert classify_intents('el salero de valeria') == set()
+
+def test_classify_intents_chat_variants():
+    """Las variantes habituales de chat siguen reconociéndose"""
+    for message in ('okay', 'oki', 'okis', 'okey'):
+        assert 'confirmation' in classify_intents(message)
+    for message in ('holas', 'holi', 'holiii'):
+        assert 'greeting' in classify_intents(message)
+    for message in ('chaucito', 'goodbye', 'byebye', 'bye bye', 'byee', 'byeee', 'chauuu'):
+        assert 'goodbye' in classify_intents(message)
+    assert 'goodbye' not in classify_intents('maybe')
+
+if __name__ == "__main__":
+    test_automaton_finds_overlapping_keywords()
+    test_classify_intents_single_pass()
+    test_classify_intents_chat_variants()
+    print("OK")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de los descuentos escalonados precompilados contra el cálculo original
+"""
+
+import sys
+import os
+import json
+import random
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+def original_discount_and_total(quantity, unit_price, product_info):
+    """Cálculo anterior: json.loads y recorrido de todos los escalones en cada llamada"""
+    subtotal = quantity * unit_price
+    if not product_info.get('discount_enabled') or quantity < product_info.get('discount_min_quantity', 3):
+        return {'discount_percent': 0, 'discount_amount': 0, 'subtotal': subtotal,
+                'total': round(subtotal), 'has_discount': False}
+
+    discount_percent = 0
+    for qty_str, discount in json.loads(product_info.get('bulk_discounts', '{}')).items():
+        if quantity >= int(qty_str):
+            discount_percent = max(discount_percent, discount)
+    if discount_percent == 0:
+        discount_percent = product_info.get('discount_percentage', 0)
+
+    discount_amount = (subtotal * discount_percent) / 100
+    return {'discount_percent': discount_percent, 'discount_amount': round(discount_amount),
+            'subtotal': subtotal, 'total': round(subtotal - discount_amount),
+            'has_discount': discount_percent > 0}
+
+def test_batch_matches_original_loop():
+    """calculate_totals_batch da lo mismo que el bucle original, con y sin escalones compilados"""
+    rng = random.Random(7)
+    products = []
+    for index in range(50):
+        tiers = {str(rng.randint(2, 30)): rng.choice([5, 10, 12.5, 20, 8]) for _ in range(rng.randint(0, 4))}
+        product = {
+            'discount_enabled': index % 5 != 0,
+            'discount_min_quantity': rng.randint(1, 5),
+            'discount_percentage': rng.choice([0, 5, 7]),
+            'bulk_discounts': json.dumps(tiers)
+        }
+        if index % 2:
+            # Como en el catálogo en memoria
+            product['discount_tiers'] = app.compile_discount_tiers(product['bulk_discounts'])
+        products.append(product)
+
+    items = [(rng.randint(1, 40), rng.choice([12, 20, 35.5]), rng.choice(products)) for _ in range(2000)]
+    expected = [original_discount_and_total(*item) for item in items]
+    results = app.calculate_totals_batch(items)
+
+    for result, reference in zip(results, expected):
+        for key, value in reference.items():
+            assert result[key] == value, key
+    assert len(results) == len(expected)
+
+def test_string_percentages_are_coerced():
+    """Escalones guardados como texto ({"3": "10"}) se aplican como números"""
+    product = {'discount_enabled': True, 'discount_min_quantity': 3, 'bulk_discounts': '{"3": "10", "6": "12.5"}'}
+
+    assert app.compile_discount_tiers(product['bulk_discounts']) == ((3, 6), (10, 12.5))
+    totals = app.calculate_discount_and_total(3, 20, product)
+    assert (totals['discount_percent'], totals['total']) == (10, 54)
+    assert f"{totals['discount_percent']}%" == '10%'
+
+def test_invalid_tiers_are_skipped():
+    """Un escalón mal escrito no anula los demás"""
+    assert app.compile_discount_tiers('{"3": "mucho", "tres": 5, "5": 15}') == ((5,), (15,))
+    assert app.compile_discount_tiers('[10, 15]') == ((), ())
+    assert app.compile_discount_tiers('no es json') == ((), ())
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de la detección de género con el léxico de nombres
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+from app import UserSession, ConversationTurn, count_name_hits
+
+@pytest.fixture
+def gender_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'gender.db'))
+    app.init_db()
+
+def test_names_match_whole_words_only():
+    """'ana' no coincide dentro de 'mañana' o 'semana'"""
+    assert count_name_hits('te escribo mañana o la otra semana') == (0, 0)
+    assert count_name_hits('soy ana') == (1, 0)
+
+def test_accents_and_case_are_ignored():
+    """'María' y 'JUAN' se reconocen igual que en el léxico"""
+    assert count_name_hits('Hola, soy María') == (1, 0)
+    assert count_name_hits('JUAN aquí') == (0, 1)
+
+def test_session_totals_follow_the_window(monkeypatch):
+    """Los turnos que salen de la ventana dejan de contar"""
+    monkeypatch.setattr(app, 'HISTORY_WINDOW', 2)
+    session = UserSession([ConversationTurn('soy maria', '')])
+    assert session.gender() == 'female'
+
+    session.add_turn(ConversationTurn('hola', ''))
+    session.add_turn(ConversationTurn('de parte de juan', ''))  # 'soy maria' sale de la ventana
+    assert (session.female_hits, session.male_hits) == (0, 1)
+    assert session.gender() == 'male'
+
+def test_gender_is_kept_in_session(gender_db, monkeypatch):
+    """Tras cargar la sesión, los mensajes nuevos actualizan el género sin consultar la base"""
+    app.save_conversation('u1', 'hola, soy carlos', 'Hola')
+    assert app.detect_gender_from_conversations('u1') == 'male'
+
+    app.save_conversation('u1', 'bueno, mejor pregunta mi esposa ana', 'Claro')
+    app.save_conversation('u1', 'ana y maria quieren vasos', 'Perfecto')
+
+    def no_db():
+        raise AssertionError('consulta inesperada a la base de datos')
+
+    monkeypatch.setattr(app, 'get_db', no_db)
+    assert app.detect_gender_from_conversations('u1') == 'female'
+
+def test_no_names_is_neutral(gender_db):
+    app.save_conversation('u1', 'cuánto cuestan los vasos mañana?', 'A 12bs')
+    assert app.detect_gender_from_conversations('u1') == 'neutral'
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
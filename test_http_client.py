@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del cliente HTTP compartido
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+import requests
+
+import app
+from http_client import HttpClient, build_retry
+
+class FakeResponse:
+    status_code = 200
+    text = 'ok'
+
+    def json(self):
+        return {'sent': 'true'}
+
+@pytest.fixture
+def recorded_requests(monkeypatch):
+    """Registrar las peticiones en vez de enviarlas: (sesión, método, url, kwargs)"""
+    calls = []
+
+    def fake_request(session, method, url, **kwargs):
+        calls.append((session, method, url, kwargs))
+        return FakeResponse()
+
+    monkeypatch.setattr(requests.Session, 'request', fake_request)
+    return calls
+
+def test_one_session_per_host(recorded_requests):
+    """Las llamadas al mismo host reutilizan la sesión (y su pool keep-alive)"""
+    client = HttpClient()
+    client.post('https://graph.facebook.com/v18.0/me/messages', json={})
+    client.post('https://graph.facebook.com/v18.0/me/messages', json={})
+    client.get('https://api.callmebot.com/whatsapp.php')
+
+    sessions = [session for session, _, _, _ in recorded_requests]
+    assert sessions[0] is sessions[1]
+    assert sessions[2] is not sessions[0]
+    client.close()
+
+def test_default_timeout_can_be_overridden(recorded_requests):
+    client = HttpClient(timeout=(1, 2))
+    client.get('https://example.com/a')
+    client.get('https://example.com/b', timeout=(1, 5))
+
+    assert [kwargs['timeout'] for _, _, _, kwargs in recorded_requests] == [(1, 2), (1, 5)]
+    client.close()
+
+def test_posts_are_not_retried_after_sending():
+    """Errores de lectura o 5xx solo se reintentan en métodos idempotentes"""
+    retry = build_retry(2)
+    assert retry.is_retry('GET', 503)
+    assert not retry.is_retry('POST', 503)
+    assert not retry.is_retry('GET', 500)
+    assert retry.connect == 2  # Fallar al conectar sí se reintenta siempre
+
+def test_graph_token_is_sent_as_param(recorded_requests, monkeypatch):
+    """El token de la página no va en la URL (no queda en logs de excepciones)"""
+    monkeypatch.setattr(app, 'PAGE_ACCESS_TOKEN', 'token-de-prueba')
+
+    assert app.send_facebook_message('123', 'hola')
+
+    [(_, method, url, kwargs)] = recorded_requests
+    assert (method, url) == ('POST', app.GRAPH_API_MESSAGES_URL)
+    assert 'token-de-prueba' not in url
+    assert kwargs['params'] == {'access_token': 'token-de-prueba'}
+    assert kwargs['json'] == {'recipient': {'id': '123'}, 'message': {'text': 'hola'}}
+
+def test_unconfigured_channels_do_not_send(recorded_requests, monkeypatch):
+    monkeypatch.setattr(app, 'PAGE_ACCESS_TOKEN', '')
+    monkeypatch.setattr(app, 'ULTRAMSG_TOKEN', '')
+
+    assert not app.send_facebook_message('123', 'hola')
+    assert not app.send_whatsapp_response('70000001', 'hola')
+    assert recorded_requests == []
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
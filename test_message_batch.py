@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del procesamiento por lotes del webhook de Messenger
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def batch_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'batch.db'))
+    monkeypatch.setattr(app, 'WEBHOOK_ASYNC', False)
+    sent = []
+    monkeypatch.setattr(app, 'send_message_with_typing',
+                        lambda platform, recipient_id, text, **kwargs: sent.append((recipient_id, text)))
+    app.init_db()
+    return sent
+
+def messaging(sender, text, **message):
+    return {'sender': {'id': sender}, 'message': {'text': text, **message}}
+
+def test_extract_events_from_every_entry():
+    """Se toman todos los mensajes de texto de todas las entradas, sin ecos ni adjuntos"""
+    data = {'entry': [
+        {'messaging': [messaging('a', 'hola', mid='m1'), messaging('page', 'eco', is_echo=True)]},
+        {'messaging': [{'sender': {'id': 'b'}, 'message': {'attachments': []}}, messaging('b', 'vasos?')]},
+    ]}
+
+    events = app.extract_messenger_events(data)
+
+    assert [(event['sender_id'], event['text'], event['message_id']) for event in events] == [
+        ('a', 'hola', 'm1'), ('b', 'vasos?', None)
+    ]
+
+def test_webhook_answers_every_event_in_order(batch_db):
+    """Un POST con varios eventos responde a todos y respeta el orden de cada remitente"""
+    client = app.app.test_client()
+    response = client.post('/webhook', json={'entry': [
+        {'messaging': [messaging('a', 'tienen vasos?'), messaging('b', 'hola')]},
+        {'messaging': [messaging('a', 'quiero 5')]},
+    ]})
+    data = response.get_json()
+
+    assert data['status'] == 'success'
+    assert len(data['responses']) == 3
+    assert sorted(recipient for recipient, _ in batch_db) == ['a', 'a', 'b']
+
+    rows = app.get_db().execute(
+        "SELECT message FROM conversations WHERE user_id = 'a' ORDER BY id"
+    ).fetchall()
+    assert rows == [('tienen vasos?',), ('quiero 5',)]
+
+    # El segundo mensaje de 'a' ve el producto del primero y su cotización queda en la sesión
+    assert '5 vasos' in [text for recipient, text in batch_db if recipient == 'a'][1]
+    assert app.get_user_session('a')['last_quantity'] == 5
+    assert app.get_user_session('b')['last_quantity'] is None
+
+def test_batch_is_saved_in_one_transaction_per_round(batch_db, monkeypatch):
+    """Cada ronda se guarda con una sola llamada a save_conversations_batch"""
+    saved = []
+    save_batch = app.save_conversations_batch
+
+    def recording_save(rows):
+        saved.append([row[0] for row in rows])
+        save_batch(rows)
+
+    monkeypatch.setattr(app, 'save_conversations_batch', recording_save)
+    app.process_message_batch([
+        {'platform': 'facebook', 'sender_id': sender, 'text': text, 'message_id': None}
+        for sender, text in [('a', 'hola'), ('b', 'hola'), ('a', 'precio?'), ('c', 'hola')]
+    ])
+
+    assert saved == [['a', 'b', 'c'], ['a']]
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
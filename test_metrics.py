@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de las métricas expuestas en /metrics
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+from metrics import Metric, Histogram, Registry
+
+def test_histogram_buckets_are_cumulative():
+    """Cada bucket cuenta las observaciones menores o iguales a su límite"""
+    histogram = Histogram('test_seconds', 'Prueba', ['stage'], registry=Registry(), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.labels('parse').observe(value)
+
+    lines = list(histogram.samples())
+    assert 'test_seconds_bucket{stage="parse",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="parse",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="parse",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="parse"} 3' in lines
+
+def test_metric_subclasses_must_define_series():
+    """Una métrica sin _new_series ni samples falla al crearla, no al exponer /metrics"""
+    class Incomplete(Metric):
+        type_name = 'gauge'
+
+    with pytest.raises(TypeError):
+        Incomplete('test_incompleta', 'Prueba', registry=Registry())
+
+def test_metrics_endpoint_reports_stages(tmp_path, monkeypatch):
+    """Un turno registra sus etapas y /metrics las expone en formato Prometheus"""
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'metrics.db'))
+    app.init_db()
+    app.get_bot_response('metrics_user', 'precio platos', apply_delay=False)
+
+    response = app.app.test_client().get('/metrics')
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert 'bot_stage_seconds_count{stage="detection"}' in body
+    assert 'bot_stage_seconds_count{stage="response_build"}' in body
+    assert 'bot_in_flight_requests' in body
+
+@pytest.fixture
+def profiled_app(tmp_path, monkeypatch):
+    """DB_PROFILE activo con umbral 0 y el log de consultas lentas en tmp_path"""
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'profile.db'))
+    monkeypatch.setattr(app, 'SLOW_QUERY_LOG', str(tmp_path / 'slow.log'))
+    monkeypatch.setattr(app, 'DB_PROFILE', True)
+    monkeypatch.setattr(app, 'SLOW_QUERY_MS', 0)
+    monkeypatch.setattr(app, '_slow_query_logger', None)
+    app.init_db()
+    yield
+    # El logger 'slow_queries' es global: quitarle el handler que apunta a tmp_path
+    logger = app.get_slow_query_logger()
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+    app.close_db()
+
+def test_db_profile_counts_queries_and_logs_slow_ones(profiled_app):
+    """Con DB_PROFILE cada petición informa sus consultas y las lentas van al log con su plan"""
+    response = app.app.test_client().get('/analytics')
+    assert int(response.headers['X-DB-Queries']) >= 2
+
+    body = app.app.test_client().get('/metrics').get_data(as_text=True)
+    assert 'bot_db_queries_per_request_count{endpoint="analytics"} 1' in body
+
+    for handler in app.get_slow_query_logger().handlers:
+        handler.flush()
+    with open(app.SLOW_QUERY_LOG, encoding='utf-8') as log_file:
+        assert 'SCAN stats_daily' in log_file.read()
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
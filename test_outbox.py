@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del outbox de notificaciones de leads
+"""
+
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def outbox_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'outbox.db'))
+    monkeypatch.setattr(app, 'start_notification_dispatcher', lambda: None)
+    urgent = []
+    monkeypatch.setattr(app, 'write_urgent_lead_file', lambda phone, products: urgent.append((phone, products)))
+    app.init_db()
+    return urgent
+
+def outbox_rows():
+    return app.get_db().execute(
+        'SELECT status, attempts, channel, last_error, next_attempt_at FROM notification_outbox'
+    ).fetchall()
+
+def failing_channel(message):
+    raise RuntimeError('timeout')
+
+def test_lead_is_queued_with_its_notification(outbox_db):
+    """save_lead deja la notificación pendiente en la misma transacción, sin enviarla"""
+    app.save_lead('u1', '70000001', ['vasos'])
+
+    assert app.get_db().execute('SELECT phone_number FROM leads').fetchall() == [('70000001',)]
+    [(status, attempts, channel, _, _)] = outbox_rows()
+    assert (status, attempts, channel) == ('pending', 0, None)
+
+def test_dispatch_uses_first_configured_channel(outbox_db, monkeypatch):
+    """Un canal sin configurar se salta y el siguiente entrega la notificación"""
+    sent = []
+    monkeypatch.setattr(app, 'NOTIFICATION_CHANNELS', [
+        ('ultramsg', lambda message: None),
+        ('callmebot', lambda message: sent.append(message) or True),
+    ])
+    app.save_lead('u1', '70000001', ['vasos'])
+
+    app.dispatch_outbox_once()
+
+    [(status, attempts, channel, last_error, _)] = outbox_rows()
+    assert (status, attempts, channel, last_error) == ('sent', 1, 'callmebot', None)
+    assert '70000001' in sent[0]
+
+def test_failed_delivery_is_retried_with_backoff(outbox_db, monkeypatch):
+    """Un error deja la notificación pendiente con espera exponencial"""
+    monkeypatch.setattr(app, 'NOTIFICATION_CHANNELS', [('ultramsg', failing_channel)])
+    app.save_lead('u1', '70000001', ['vasos'])
+
+    before = time.time()
+    wait_time = app.dispatch_outbox_once()
+
+    [(status, attempts, _, last_error, next_attempt_at)] = outbox_rows()
+    assert (status, attempts) == ('pending', 1)
+    assert 'timeout' in last_error
+    assert next_attempt_at >= before + app.OUTBOX_BASE_BACKOFF
+    assert 0 < wait_time <= app.OUTBOX_POLL_INTERVAL
+
+    # Antes de vencer la espera no se vuelve a intentar
+    app.dispatch_outbox_once()
+    assert outbox_rows()[0][1] == 1
+
+def test_exhausted_notification_goes_to_dead_letter(outbox_db, monkeypatch):
+    """Tras OUTBOX_MAX_ATTEMPTS fallos queda 'dead' y el lead va al archivo de urgencias"""
+    monkeypatch.setattr(app, 'NOTIFICATION_CHANNELS', [('ultramsg', failing_channel)])
+    app.save_lead('u1', '70000001', ['vasos'])
+    conn = app.get_db()
+    conn.execute('UPDATE notification_outbox SET attempts = ?', (app.OUTBOX_MAX_ATTEMPTS - 1,))
+    conn.commit()
+
+    app.dispatch_outbox_once()
+
+    [(status, attempts, _, _, _)] = outbox_rows()
+    assert (status, attempts) == ('dead', app.OUTBOX_MAX_ATTEMPTS)
+    assert outbox_db == [('70000001', ['vasos'])]
+
+def test_no_channels_configured_is_dead_immediately(outbox_db, monkeypatch):
+    """Sin canales configurados no tiene sentido reintentar"""
+    monkeypatch.setattr(app, 'NOTIFICATION_CHANNELS', [('ultramsg', lambda message: None)])
+    app.save_lead('u1', '70000001', ['vasos'])
+
+    app.dispatch_outbox_once()
+
+    [(status, attempts, _, last_error, _)] = outbox_rows()
+    assert (status, attempts, last_error) == ('dead', 1, 'sin canales configurados')
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
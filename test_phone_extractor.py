@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del extractor de teléfonos bolivianos
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import detect_phone_number, extract_phone_candidates
+
+def test_phone_formats():
+    """Formatos con y sin +591, espacios y guiones"""
+    assert detect_phone_number("mi numero es 78056048") == "78056048"
+    assert detect_phone_number("+591 78056048") == "78056048"
+    assert detect_phone_number("591-7805-6048") == "78056048"
+    assert detect_phone_number("7805 6048") == "78056048"
+    assert detect_phone_number("00591 68056048") == "68056048"
+    assert detect_phone_number("fijo +591 3 3456789") == "33456789"
+
+def test_quantities_are_not_phones():
+    """Cantidades y precios no se confunden con teléfonos"""
+    assert detect_phone_number("quiero 3") is None
+    assert detect_phone_number("precio 1200") is None
+    assert detect_phone_number("dame 3 78056048") == "78056048"
+
+def test_dates_amounts_and_lists_are_not_phones():
+    """Fechas, montos con puntos y listas de números no forman un teléfono"""
+    assert detect_phone_number("entrega el 15-10-2025") is None
+    assert detect_phone_number("el 15.10.2025") is None
+    assert detect_phone_number("presupuesto 12.500.000 bs") is None
+    assert detect_phone_number("tengo 20 30 40 50 vasos") is None
+
+def test_candidates_have_confidence():
+    """Cada candidato trae tipo y confianza"""
+    candidates = extract_phone_candidates("llamar al 78056048 o al 3345678")
+    assert [c['number'] for c in candidates] == ["78056048", "3345678"]
+    assert candidates[0]['type'] == 'mobile'
+    assert candidates[0]['confidence'] > candidates[1]['confidence']
+
+if __name__ == "__main__":
+    test_phone_formats()
+    test_quantities_are_not_phones()
+    test_dates_amounts_and_lists_are_not_phones()
+    test_candidates_have_confidence()
+    print("OK")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de la validación de productos y la importación/exportación masiva
+"""
+
+import sys
+import os
+import io
+import json
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'products.db'))
+    app.init_db()
+    return app.app.test_client()
+
+def product(key_name, **overrides):
+    data = {
+        'name': key_name.title(), 'key_name': key_name, 'price': 20, 'stock': 10,
+        'keywords': key_name, 'discount_enabled': True, 'discount_min_quantity': 3,
+        'bulk_discounts': '{"3": 10, "5": 15}'
+    }
+    data.update(overrides)
+    return data
+
+def test_bulk_discounts_are_stored_as_given(client):
+    """Los porcentajes enteros no se convierten en 15.0 en los mensajes al cliente"""
+    assert client.post('/api/products', json=product('jarras')).get_json()['status'] == 'success'
+
+    stored = app.get_db().execute("SELECT bulk_discounts FROM products WHERE key_name = 'jarras'").fetchone()[0]
+    assert stored == '{"3": 10, "5": 15}'
+    totals = app.calculate_discount_and_total(5, 20, app.get_active_products()['jarras'])
+    assert f"{totals['discount_percent']}%" == '15%'
+
+def test_invalid_products_are_rejected(client):
+    """Campos obligatorios, números y escalones inválidos devuelven 400 con el motivo"""
+    for overrides in ({'price': 'caro'}, {'stock': -1}, {'name': ''},
+                      {'bulk_discounts': '[10, 15]'}, {'bulk_discounts': '{"tres": 10}'},
+                      {'bulk_discounts': '{"3": "mucho"}'}, {'bulk_discounts': '{"3": "10"}'},
+                      {'bulk_discounts': '{"3": true}'}, {'bulk_discounts': '{"3.5": 10}'},
+                      {'bulk_discounts': '{"3": 150}'}):
+        response = client.post('/api/products', json=product('vasos', **overrides))
+        assert response.status_code == 400
+        assert response.get_json()['status'] == 'error'
+
+def test_csv_round_trip_and_row_errors(client):
+    """Lo exportado en CSV se vuelve a importar igual; las filas inválidas se informan sin frenar el resto"""
+    lines = [json.dumps(product('platos')), json.dumps(product('tazas', price=12.5, active=False)),
+             'no es json', json.dumps(product('ollas', price='caro'))]
+    summary = client.post('/api/products/import?format=jsonl', data='\n'.join(lines)).get_json()
+    assert summary['imported'] == 2
+    assert [error['row'] for error in summary['errors']] == [3, 4]
+
+    def snapshot():
+        # CSV no distingue NULL de texto vacío
+        rows = app.get_db().execute(
+            f"SELECT {', '.join(app.PRODUCT_FIELDS)} FROM products ORDER BY key_name").fetchall()
+        return [tuple('' if value is None else value for value in row) for row in rows]
+
+    before = snapshot()
+    exported = client.get('/api/products/export?format=csv').get_data()
+    assert exported.decode('utf-8').splitlines()[0] == ','.join(app.PRODUCT_FIELDS)
+
+    app.get_db().execute('DELETE FROM products')
+    app.get_db().commit()
+    summary = client.post('/api/products/import', data={'file': (io.BytesIO(exported), 'productos.csv')}).get_json()
+    assert summary['status'] == 'success'
+    assert summary['imported'] == len(before)
+    assert snapshot() == before
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
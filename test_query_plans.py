@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de planes de consulta: las consultas calientes deben usar índices
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import app
+
+def test_hot_queries_use_indexes(tmp_path, monkeypatch):
+    """Ninguna consulta de HOT_QUERIES debe caer en un recorrido completo"""
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'plans.db'))
+    app.init_db()
+
+    problems = app.audit_query_plans()
+    assert problems == [], f"Consultas sin índice: {problems}"
+
+def test_history_breaks_timestamp_ties_by_id(tmp_path, monkeypatch):
+    """Mensajes guardados en el mismo segundo salen en orden de inserción inverso"""
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'ties.db'))
+    app.init_db()
+    conn = app.get_db()
+    conn.executemany(
+        "INSERT INTO conversations (user_id, message, bot_response, timestamp) VALUES (?, ?, ?, '2025-01-01 10:00:00')",
+        [('u1', f'mensaje {i}', 'ok') for i in range(5)]
+    )
+    conn.commit()
+
+    rows = conn.execute(app.RECENT_HISTORY_SQL, ('u1', 3)).fetchall()
+    assert [message for message, _ in rows] == ['mensaje 4', 'mensaje 3', 'mensaje 2']
+
+def test_audit_detects_full_scans(tmp_path):
+    """El detector marca recorridos completos y ordenamientos temporales"""
+    assert app.is_full_scan('SCAN conversations')
+    assert app.is_full_scan('USE TEMP B-TREE FOR ORDER BY')
+    assert not app.is_full_scan('SEARCH conversations USING INDEX idx_conversations_user_timestamp (user_id=?)')
+    assert not app.is_full_scan('SCAN leads USING INDEX idx_leads_timestamp')
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    import pytest
+    with tempfile.TemporaryDirectory() as tmp, pytest.MonkeyPatch.context() as monkeypatch:
+        test_hot_queries_use_indexes(pathlib.Path(tmp), monkeypatch)
+    print("OK")
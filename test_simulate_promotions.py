@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test del simulador de promociones contra calculate_discount_and_total()
+"""
+
+import sys
+import os
+import json
+import random
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import app
+import simulate_promotions
+
+CATALOG = [
+    {'key': 'platos', 'price': 20.0, 'keywords': 'platos', 'discount_enabled': True, 'min_quantity': 3,
+     'discount_percentage': 5, 'bulk_discounts': '{"3": 10, "6": 15}'},
+    {'key': 'tappers', 'price': 35.5, 'keywords': 'tappers', 'discount_enabled': False, 'min_quantity': 5,
+     'discount_percentage': 0, 'bulk_discounts': '{}'},
+    {'key': 'vasos', 'price': 12.0, 'keywords': 'vasos', 'discount_enabled': True, 'min_quantity': 2,
+     'discount_percentage': 0, 'bulk_discounts': '{"10": 12.5}'},
+]
+
+CONFIGS = [
+    {'name': 'actual', 'products': []},
+    {'name': 'sin mínimo', 'bulk_discounts': {'3': 8, '5': 18}},
+    {'name': 'tappers', 'products': ['tappers'], 'min_quantity': 2, 'discount_percentage': 7},
+    {'name': 'escalones', 'min_quantity': 4, 'bulk_discounts': {'4': 5, '8': 10, '12': 20}},
+]
+
+def product_info(config, product):
+    """Producto tal como lo vería calculate_discount_and_total() con la configuración aplicada"""
+    if product['key'] in config.get('products', [item['key'] for item in CATALOG]):
+        return {'discount_enabled': True,
+                'discount_min_quantity': config.get('min_quantity', product['min_quantity']),
+                'discount_percentage': config.get('discount_percentage', 0),
+                'bulk_discounts': json.dumps(config.get('bulk_discounts', {}))}
+    return {'discount_enabled': product['discount_enabled'],
+            'discount_min_quantity': product['min_quantity'],
+            'discount_percentage': product['discount_percentage'],
+            'bulk_discounts': product['bulk_discounts']}
+
+def test_evaluate_matches_calculate_discount_and_total():
+    """Ingresos y costo de descuento iguales al cálculo por pedido del bot"""
+    rng = random.Random(3)
+    demand = [(rng.randrange(len(CATALOG)), rng.randint(1, 15)) for _ in range(500)]
+    products = np.array([product for product, _ in demand], dtype=np.int32)
+    quantities = np.array([quantity for _, quantity in demand], dtype=np.int32)
+
+    revenue, discount_cost, discounted_requests = simulate_promotions.evaluate(
+        CONFIGS, CATALOG, products, quantities, chunk_size=3)
+
+    for c, config in enumerate(CONFIGS):
+        results = [app.calculate_discount_and_total(quantity, CATALOG[p]['price'], product_info(config, CATALOG[p]))
+                   for p, quantity in demand]
+        assert revenue[c] == sum(result['total'] for result in results), config['name']
+        assert discount_cost[c] == pytest.approx(sum(result['subtotal'] - result['total'] for result in results))
+        assert discounted_requests[c] == sum(result['discount_percent'] > 0 for result in results)
+
+def test_config_without_min_quantity_keeps_product_minimum():
+    _, min_quantity, _, _, _ = simulate_promotions.build_config_tables([CONFIGS[1]], CATALOG)
+    assert min_quantity.tolist() == [[3, 5, 2]]
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
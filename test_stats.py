@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de los agregados de /analytics y /admin (tablas stats_*)
+"""
+
+import sys
+import os
+import sqlite3
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def stats_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'stats.db'))
+    monkeypatch.setattr(app, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.setattr(app, 'start_notification_dispatcher', lambda: None)
+    app.init_db()
+
+def stats_snapshot():
+    conn = app.get_db()
+    return (
+        app.get_stats_totals(),
+        sorted(conn.execute('SELECT day, conversations, quotes, leads FROM stats_daily').fetchall()),
+        sorted(conn.execute('SELECT product_key, quotes FROM stats_product_quotes').fetchall()),
+    )
+
+def save_sample_history():
+    app.save_conversation('u1', 'tienen vasos?', 'Sí, tenemos a 12bs')
+    app.save_conversation('u1', 'y para 5?', 'Serían 60 bs')
+    app.save_conversation('u2', 'hola', 'Hola, ¿en qué te ayudo?')
+    app.save_conversation('u2', 'cuanto los platos', 'A 20bs')
+    app.save_lead('u2', '70000001', ['platos'])
+
+def test_counters_are_updated_on_save(stats_db):
+    """Cada conversación y lead suma a los totales; la cotización va al producto en conversación"""
+    save_sample_history()
+
+    totals, daily, product_quotes = stats_snapshot()
+    assert totals == {'conversations': 4, 'leads': 1, 'unique_users': 2}
+    [(_, conversations, quotes, leads)] = daily
+    assert (conversations, quotes, leads) == (4, 3, 1)
+    # 'Serían 60 bs' no nombra el producto pero se atribuye a vasos
+    assert product_quotes == [('platos', 1), ('vasos', 2)]
+
+def test_analytics_reads_the_rollups(stats_db):
+    save_sample_history()
+
+    data = app.app.test_client().get('/analytics').get_json()
+
+    assert data['price_queries'] == [['vasos', 2], ['platos', 1]]
+    assert [conversations for _, conversations in data['daily_conversations']] == [4]
+
+def test_rebuild_matches_incremental_counters(stats_db):
+    """Recalcular desde el historial da lo mismo que los contadores incrementales"""
+    save_sample_history()
+    incremental = stats_snapshot()
+
+    conn = app.get_db()
+    conn.execute('DELETE FROM stats_product_quotes')
+    conn.execute("UPDATE stats_totals SET value = 0")
+    conn.commit()
+    app.rebuild_stats()
+
+    assert stats_snapshot() == incremental
+
+def test_rebuild_stats_does_not_block_writers(stats_db, monkeypatch):
+    """Durante el recorrido otra conexión puede escribir, y lo escrito entra en los agregados"""
+    conn = app.get_db()
+    conn.executemany('INSERT INTO conversations (user_id, message, bot_response) VALUES (?, ?, ?)',
+                     [(f'user{i}', 'precio platos', '20 bs') for i in range(5)])
+    conn.commit()
+
+    detect_product = app.detect_product
+    writes = []
+
+    def detect_and_write(message):
+        if not writes:
+            # Sin espera: fallaría con "database is locked" si el recorrido tuviera el bloqueo
+            writer = sqlite3.connect(app.DATABASE, timeout=0)
+            writer.execute("INSERT INTO conversations (user_id, message, bot_response) VALUES ('tarde', 'hola', 'hola')")
+            writer.commit()
+            writer.close()
+            writes.append(True)
+        return detect_product(message)
+
+    monkeypatch.setattr(app, 'detect_product', detect_and_write)
+    app.rebuild_stats()
+    assert app.get_stats_totals()['conversations'] == 6
+    assert app.get_stats_totals()['unique_users'] == 6
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
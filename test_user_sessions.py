@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test de la sesión por usuario (user_sessions)
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def session_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'sessions.db'))
+    app.init_db()
+
+def reply(user_id, message):
+    """Responder y guardar como lo hace el webhook, devolviendo (respuesta, cotización)"""
+    quote = {}
+    response, phone = app.get_bot_response(user_id, message, apply_delay=False, quote=quote)
+    app.save_conversation(user_id, message, response, phone, quote)
+    return response, quote
+
+def test_quote_is_saved_with_its_own_conversation(session_db):
+    """La cantidad cotizada viaja con la respuesta y no queda en estado global"""
+    reply('u1', 'tienen vasos?')
+    response, quote = reply('u1', 'quiero 5')
+
+    assert quote == {'quantity': 5, 'total': quote['total']}
+    assert '5 vasos' in response
+    assert app.get_user_session('u1')['last_quantity'] == 5
+
+    # Otro usuario que no cotizó no hereda la cantidad
+    reply('u2', 'hola')
+    assert app.get_user_session('u2')['last_quantity'] is None
+
+def test_last_product_expires_after_five_messages(session_db):
+    """El último producto solo cuenta si se mencionó en los últimos 5 mensajes"""
+    app.save_conversation('u1', 'tienen vasos?', 'Sí, tenemos a 12bs')
+    for _ in range(4):
+        app.save_conversation('u1', 'mmm', 'Ok')
+    vasos_price = f"{app.get_active_products()['vasos']['price']} bs"
+    assert app.get_bot_response('u1', 'precio?', apply_delay=False)[0] == vasos_price
+
+    app.save_conversation('u1', 'mmm', 'Ok')
+    response = app.get_bot_response('u1', 'precio?', apply_delay=False)[0]
+    assert response != vasos_price
+    assert 'Tappers' in response  # Lista completa de precios
+
+def test_inactive_last_product_falls_back_to_history(session_db):
+    """Si el producto guardado se desactivó, se usa otro mencionado en los mensajes recientes"""
+    app.save_conversation('u1', 'tienen platos?', 'Sí, tenemos a 20bs')
+    app.save_conversation('u1', 'y vasos?', 'Sí, tenemos a 12bs')
+    assert app.get_user_session('u1')['last_product_key'] == 'vasos'
+
+    conn = app.get_db()
+    conn.execute("UPDATE products SET active = FALSE WHERE key_name = 'vasos'")
+    conn.commit()
+    app.invalidate_product_cache()
+
+    platos_price = f"{app.get_active_products()['platos']['price']} bs"
+    assert app.get_bot_response('u1', 'precio?', apply_delay=False)[0] == platos_price
+
+def test_routing_reads_last_bot_response_from_session(session_db, monkeypatch):
+    """Las respuestas fuera del caso del teléfono no leen el historial"""
+    app.save_conversation('u1', 'tienen vasos?', 'Sí, tenemos a 12bs')
+
+    def no_history(user_id, limit=app.HISTORY_WINDOW):
+        raise AssertionError('consulta inesperada al historial')
+
+    monkeypatch.setattr(app, 'get_recent_conversations', no_history)
+    assert app.get_bot_response('u1', 'ok', apply_delay=False)[0] == 'va querer 1 o 3?'
+
+def test_sessions_are_backfilled_from_history(session_db):
+    """Una base sin user_sessions se migra desde las conversaciones existentes"""
+    conn = app.get_db()
+    conn.executemany(
+        'INSERT INTO conversations (user_id, message, bot_response) VALUES (?, ?, ?)',
+        [('u1', 'tienen platos?', 'Sí, tenemos a 20bs'),
+         ('u1', 'y vasos?', 'Sí, tenemos a 12bs'),
+         ('u1', 'mmm', ''),
+         ('u1', 'ok', 'va querer 1 o 3?')]
+    )
+    conn.execute('DROP TABLE user_sessions')
+    conn.commit()
+
+    app.init_db()
+
+    session = app.get_user_session('u1')
+    assert session['message_count'] == 4
+    assert session['bot_message_count'] == 3
+    assert session['last_product_key'] == 'vasos'
+    assert session['last_product_at'] == 2
+    assert session['last_bot_response'] == 'va querer 1 o 3?'
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))